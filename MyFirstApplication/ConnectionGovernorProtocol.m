@@ -14,6 +14,7 @@
 #import "BannedViewController.h"
 #import "UniqueId.h"
 #import "SocialState.h"
+#import "Threading.h"
 
 // Session hash has timed out, you need a fresh session.
 #define REJECT_HASH_TIMEOUT 1
@@ -37,6 +38,9 @@
 // Client has been inactive (not accepting or rejecting conversations) for too long.
 #define INACTIVE_TIMOUT 6
 
+// Server is handling too many logons at once, and tells us how many milliseconds to wait before retrying.
+#define REJECT_OVERLOADED 7
+
 @implementation ConnectionGovernorProtocol {
     id <NewPacketDelegate> _recvDelegate;
     ConnectionManagerUdp *_udpConnection;
@@ -332,6 +336,21 @@
     } else if (rejectCode == INACTIVE_TIMOUT) {
         [self terminateWithConnectionStatus:P_NOT_CONNECTED withDescription:rejectDescription];
         [_connectionStatusDelegate onInactivityRejection];
+    } else if (rejectCode == REJECT_OVERLOADED) {
+        // Laid out like a ban, the magnitude is unused.
+        [packet getUnsignedInteger8];
+        uint retryAfterMs = [packet getUnsignedInteger];
+
+        // Wait as long as the server asks, instead of reconnecting straight away along with everyone else it turned away.
+        NSLog(@"Server is overloaded, reconnecting in %u milliseconds", retryAfterMs);
+        [self shutdownWithDescription:rejectDescription];
+        if (_reconnectEnabled) {
+            dispatch_async_main(^{
+                if (_alive && _connectionStatus == P_NOT_CONNECTED) {
+                    [self reconnect];
+                }
+            }, retryAfterMs);
+        }
     }
 }
 
@@ -0,0 +1,267 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import socket
+import struct
+from twisted.internet import reactor
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+MSG_DONTWAIT = 0x40
+
+# Linux structures used by recvmmsg and sendmmsg, IPv4 only.
+class IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class SockAddrIn(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort),
+                ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint32),
+                ('sin_zero', ctypes.c_char * 8)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IoVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+def _loadLibc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError, TypeError) as e:
+        logger.warn("Batched UDP I/O is not available on this platform: %s" % e)
+        return None
+
+_libc = _loadLibc()
+
+def isBatchedUdpSupported():
+    return _libc is not None
+
+# UDP port which receives datagrams with recvmmsg, many at a time, and
+# sends all datagrams written during a reactor iteration with sendmmsg.
+#
+# Behaves like a Twisted UDP port from the protocol's perspective,
+# transport.write(data, address) queues the datagram.
+class BatchedUdpPort(object):
+    # Number of datagrams received or sent per system call.
+    BATCH_SIZE = 64
+
+    # Largest datagram we accept, anything bigger is truncated.
+    MAX_DATAGRAM_SIZE = 65536
+
+    # Avoid starving other file descriptors when flooded.
+    MAX_BATCHES_PER_READ = 16
+
+    # Bound on the address -> sockaddr cache.
+    MAX_CACHED_ADDRESSES = 10000
+
+    # Datagrams held while the socket's send buffer is full, beyond this they are dropped.
+    MAX_QUEUED_DATAGRAMS = 4096
+
+    def __init__(self, sock, datagramProtocol, reactor=reactor):
+        assert isBatchedUdpSupported()
+
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.fd = sock.fileno()
+        self.protocol = datagramProtocol
+        self.reactor = reactor
+
+        self.send_queue = list()
+        self.scheduled_flush = None
+
+        # Set while the send buffer is full, the queue is flushed once the socket is writable.
+        self.is_waiting_for_writable = False
+        self.sockaddr_by_address = dict()
+
+        # Receive buffers are allocated once and reused for every call.
+        self.receive_buffers = [ctypes.create_string_buffer(BatchedUdpPort.MAX_DATAGRAM_SIZE) for n in range(BatchedUdpPort.BATCH_SIZE)]
+        self.receive_addresses = (SockAddrIn * BatchedUdpPort.BATCH_SIZE)()
+        self.receive_iovecs = (IoVec * BatchedUdpPort.BATCH_SIZE)()
+        self.receive_messages = (MMsgHdr * BatchedUdpPort.BATCH_SIZE)()
+        for n in range(BatchedUdpPort.BATCH_SIZE):
+            self.receive_iovecs[n].iov_base = ctypes.addressof(self.receive_buffers[n])
+            self.receive_iovecs[n].iov_len = BatchedUdpPort.MAX_DATAGRAM_SIZE
+
+            header = self.receive_messages[n].msg_hdr
+            header.msg_name = ctypes.addressof(self.receive_addresses[n])
+            header.msg_iov = ctypes.pointer(self.receive_iovecs[n])
+            header.msg_iovlen = 1
+
+        self.send_addresses = (SockAddrIn * BatchedUdpPort.BATCH_SIZE)()
+        self.send_iovecs = (IoVec * BatchedUdpPort.BATCH_SIZE)()
+        self.send_messages = (MMsgHdr * BatchedUdpPort.BATCH_SIZE)()
+        for n in range(BatchedUdpPort.BATCH_SIZE):
+            header = self.send_messages[n].msg_hdr
+            header.msg_name = ctypes.addressof(self.send_addresses[n])
+            header.msg_namelen = ctypes.sizeof(SockAddrIn)
+            header.msg_iov = ctypes.pointer(self.send_iovecs[n])
+            header.msg_iovlen = 1
+
+        self.packets_received = 0
+        self.receive_calls = 0
+        self.packets_sent = 0
+        self.send_calls = 0
+        self.packets_dropped = 0
+
+    def startListening(self):
+        self.protocol.makeConnection(self)
+        self.reactor.addReader(self)
+
+    def stopListening(self):
+        self.reactor.removeReader(self)
+        self._stopWaitingForWritable()
+        self.flush()
+        self.socket.close()
+        self.protocol.doStop()
+
+    # Used by the reactor.
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return "BatchedUdpPort"
+
+    def connectionLost(self, reason):
+        self.reactor.removeReader(self)
+        self._stopWaitingForWritable()
+
+    # Used by the reactor, once the send buffer has room again.
+    def doWrite(self):
+        self._stopWaitingForWritable()
+        self.flush()
+
+    def _stopWaitingForWritable(self):
+        if self.is_waiting_for_writable:
+            self.is_waiting_for_writable = False
+            self.reactor.removeWriter(self)
+
+    def doRead(self):
+        for batch in xrange(BatchedUdpPort.MAX_BATCHES_PER_READ):
+            for n in xrange(BatchedUdpPort.BATCH_SIZE):
+                self.receive_messages[n].msg_hdr.msg_namelen = ctypes.sizeof(SockAddrIn)
+
+            count = _libc.recvmmsg(self.fd, self.receive_messages, BatchedUdpPort.BATCH_SIZE, MSG_DONTWAIT, None)
+            self.receive_calls += 1
+            if count < 0:
+                error = ctypes.get_errno()
+                if error not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNREFUSED):
+                    logger.error("Failed to receive datagrams, error: [%s]" % errno.errorcode.get(error, error))
+                break
+
+            self.packets_received += count
+            for n in xrange(count):
+                data = ctypes.string_at(self.receive_buffers[n], self.receive_messages[n].msg_len)
+                address = self.receive_addresses[n]
+                remoteAddress = (socket.inet_ntoa(struct.pack("=I", address.sin_addr)), socket.ntohs(address.sin_port))
+                self.protocol.datagramReceived(data, remoteAddress)
+
+            if count < BatchedUdpPort.BATCH_SIZE:
+                # Socket has been drained.
+                break
+
+        # Everything forwarded as a result of this read goes out together.
+        self.flush()
+
+    def write(self, data, address):
+        if self.is_waiting_for_writable:
+            if len(self.send_queue) >= BatchedUdpPort.MAX_QUEUED_DATAGRAMS:
+                self.packets_dropped += 1
+                return
+
+            # Flushed by doWrite.
+            self.send_queue.append((data, address))
+            return
+
+        self.send_queue.append((data, address))
+        if self.scheduled_flush is None:
+            self.scheduled_flush = self.reactor.callLater(0, self.flush)
+
+    def _getSockAddr(self, address):
+        sockAddr = self.sockaddr_by_address.get(address)
+        if sockAddr is None:
+            if len(self.sockaddr_by_address) >= BatchedUdpPort.MAX_CACHED_ADDRESSES:
+                self.sockaddr_by_address.clear()
+
+            sockAddr = SockAddrIn(socket.AF_INET, socket.htons(address[1]),
+                                  struct.unpack("=I", socket.inet_aton(address[0]))[0])
+            self.sockaddr_by_address[address] = sockAddr
+        return sockAddr
+
+    def flush(self):
+        if self.scheduled_flush is not None:
+            if self.scheduled_flush.active():
+                self.scheduled_flush.cancel()
+            self.scheduled_flush = None
+
+        queue = self.send_queue
+        if len(queue) == 0 or self.is_waiting_for_writable:
+            return
+        self.send_queue = list()
+
+        position = 0
+        while position < len(queue):
+            batch = queue[position:position + BatchedUdpPort.BATCH_SIZE]
+            for n, (data, address) in enumerate(batch):
+                ctypes.memmove(ctypes.addressof(self.send_addresses[n]), ctypes.addressof(self._getSockAddr(address)), ctypes.sizeof(SockAddrIn))
+                self.send_iovecs[n].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+                self.send_iovecs[n].iov_len = len(data)
+
+            sent = _libc.sendmmsg(self.fd, self.send_messages, len(batch), 0)
+            self.send_calls += 1
+            if sent <= 0:
+                error = ctypes.get_errno() if sent < 0 else None
+                if error == errno.EINTR:
+                    continue
+
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Send buffer is full, keep the rest until the socket is writable.
+                    self.send_queue = queue[position:position + BatchedUdpPort.MAX_QUEUED_DATAGRAMS]
+                    self.packets_dropped += len(queue) - position - len(self.send_queue)
+                    self.is_waiting_for_writable = True
+                    self.reactor.addWriter(self)
+                    return
+
+                # UDP is unreliable anyway, drop what we could not send rather than buffering. Also when
+                # nothing was sent without an error, so that we never retry the same batch forever.
+                self.packets_dropped += len(queue) - position
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Failed to send %d datagrams, error: [%s]" % (len(queue) - position, errno.errorcode.get(error, error)))
+                return
+
+            self.packets_sent += sent
+            position += sent
+
+    # Average number of datagrams per system call for receiving and sending, and the number of datagrams
+    # dropped because they could not be sent, since last called.
+    def getTransportStatistics(self):
+        receiveRate = float(self.packets_received) / self.receive_calls if self.receive_calls > 0 else 0.0
+        sendRate = float(self.packets_sent) / self.send_calls if self.send_calls > 0 else 0.0
+        droppedCount = self.packets_dropped
+
+        self.packets_received = 0
+        self.receive_calls = 0
+        self.packets_sent = 0
+        self.send_calls = 0
+        self.packets_dropped = 0
+        return receiveRate, sendRate, droppedCount
+
+# Bind to a UDP port, using batched I/O with the specified protocol.
+def listenBatchedUdp(sock, datagramProtocol):
+    port = BatchedUdpPort(sock, datagramProtocol)
+    port.startListening()
+    return port
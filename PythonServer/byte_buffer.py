@@ -1,4 +1,5 @@
 import struct
+from threading import Lock
 
 __author__ = 'pryormic'
 
@@ -6,26 +7,44 @@ import unittest
 from utility import DataConstants
 
 class ByteBuffer(object):
-    def __init__(self):
+    __slots__ = ('buffer', '_used_size', '_cursor_position', '_memory_size')
+
+    def __init__(self, capacity=0):
         super(ByteBuffer, self).__init__()
-        self.buffer = bytearray()
+        self.buffer = bytearray(capacity)
         self._used_size = 0
         self._cursor_position = 0
 
+        # Logical size, the underlying buffer may be larger so that it can grow without copying each time.
+        self._memory_size = 0
+
     @classmethod
     def buildFromIterable(cls, theString):
         obj = cls()
         obj.buffer = bytearray(theString)
+        obj._memory_size = len(obj.buffer)
         obj._used_size = obj.memory_size
         obj._cursor_position = 0
         return obj
 
+    # Wraps a memoryview without copying it, the data is copied the first time it is written to.
+    @classmethod
+    def buildFromView(cls, view):
+        assert isinstance(view, memoryview)
+        obj = cls()
+        obj.buffer = view
+        obj._memory_size = len(view)
+        obj._used_size = len(view)
+        obj._cursor_position = 0
+        return obj
+
     @classmethod
     def buildFromByteBuffer(cls, theByteBuffer):
         assert isinstance(theByteBuffer, ByteBuffer)
         obj = cls()
         obj.buffer = bytearray(theByteBuffer.buffer)
-        obj._used_size = obj._used_size
+        obj._memory_size = theByteBuffer.memory_size
+        obj._used_size = theByteBuffer.used_size
         obj._cursor_position = theByteBuffer.cursor_position
         return obj
 
@@ -55,35 +74,57 @@ class ByteBuffer(object):
 
     @property
     def memory_size(self):
-        return len(self.buffer)
+        return self._memory_size
 
     @memory_size.setter
     def memory_size(self, newSize):
         self.setMemorySize(newSize, True)
 
+    @property
+    def capacity(self):
+        return len(self.buffer)
+
     def increaseMemorySize(self, size):
-        if size > self.memory_size:
+        if size > self._memory_size:
             self.memory_size = size
 
 
     def setMemorySize(self, newSize, retainContents):
-        if newSize == self.memory_size:
+        if newSize == self._memory_size:
             return
 
-        if retainContents:
-            amountToCopy = len(self.buffer)
-            if amountToCopy > newSize:
-                amountToCopy = newSize
-        else:
-            amountToCopy = 0
-
-        self.old_buffer = self.buffer
-        self.buffer = bytearray(newSize)
-        if amountToCopy > 0:
-            self.buffer[0:amountToCopy] = self.old_buffer
+        if not retainContents:
+            self.buffer = bytearray(newSize)
+        elif newSize > len(self.buffer):
+            # Double capacity, so that a sequence of writes only copies the buffer a logarithmic number of times.
+            oldBuffer = self.buffer
+            self.buffer = bytearray(max(newSize, len(oldBuffer) * 2))
+            self.buffer[0:self._memory_size] = oldBuffer[0:self._memory_size]
 
+        self._memory_size = newSize
         self.enforceBounds()
 
+    # Views share memory with the buffer they were read from, take our own copy before modifying.
+    def ensureWritable(self):
+        if isinstance(self.buffer, memoryview):
+            self.buffer = bytearray(self.buffer)
+
+    def getView(self):
+        if isinstance(self.buffer, memoryview):
+            return self.buffer
+        return memoryview(self.buffer)
+
+    # View of the data written so far, valid until the buffer is next modified.
+    def getUsedView(self):
+        return self.getView()[:self._used_size]
+
+    # Empty the buffer, keeping its memory for reuse.
+    def reset(self):
+        self.ensureWritable()
+        self._used_size = 0
+        self._cursor_position = 0
+        self._memory_size = 0
+
     def getUnreadDataFromCursor(self):
         return self.used_size - self.cursor_position
 
@@ -100,6 +141,7 @@ class ByteBuffer(object):
 
     def addValueAtPosition(self, value, startPosition, valueDataSize):
         endPosition = startPosition + valueDataSize
+        self.ensureWritable()
         self.increaseMemorySize(endPosition)
         self.buffer[startPosition:endPosition] = value
         return endPosition
@@ -107,17 +149,52 @@ class ByteBuffer(object):
     def addValue(self, value, valueDataSize):
         self.cursor_position = self.addValueAtPosition(value, self.cursor_position, valueDataSize)
 
+    # Packs directly into the buffer, without building an intermediate string.
+    def packAtPosition(self, theStruct, value, position):
+        endPosition = position + theStruct.size
+        self.ensureWritable()
+        self.increaseMemorySize(endPosition)
+        theStruct.pack_into(self.buffer, position, value)
+        return endPosition
+
+    def pack(self, theStruct, value):
+        endPosition = self.packAtPosition(theStruct, value, self._cursor_position)
+        if endPosition > self._used_size:
+            self._used_size = endPosition
+        self._cursor_position = endPosition
+
+    # Packs several values with one struct, e.g. a run of fields compiled by message_schema.
+    def packValues(self, theStruct, values):
+        position = self._cursor_position
+        endPosition = position + theStruct.size
+        self.ensureWritable()
+        self.increaseMemorySize(endPosition)
+        theStruct.pack_into(self.buffer, position, *values)
+        if endPosition > self._used_size:
+            self._used_size = endPosition
+        self._cursor_position = endPosition
+
+    # Counterpart of packValues, returns None if there is not enough data.
+    def unpackValues(self, theStruct):
+        position = self._cursor_position
+        endPosition = position + theStruct.size
+        if endPosition > self._used_size:
+            return None
+
+        self._cursor_position = endPosition
+        return theStruct.unpack_from(self.buffer, position)
+
     def addUnsignedInteger(self, data):
-        self.addValue(struct.pack(DataConstants.ULONG_FORMAT, data), DataConstants.ULONG_SIZE)
+        self.pack(DataConstants.ULONG_STRUCT, data)
 
     def addFloat(self, data):
-        self.addValue(struct.pack(DataConstants.FLOAT_FORMAT, data), DataConstants.FLOAT_SIZE)
+        self.pack(DataConstants.FLOAT_STRUCT, data)
 
     def addUnsignedInteger8(self, data):
-        self.addValue(struct.pack(DataConstants.UBYTE_FORMAT, data), DataConstants.UBYTE_SIZE)
+        self.pack(DataConstants.UBYTE_STRUCT, data)
 
     def addUnsignedIntegerAtPosition8(self, data, position):
-        return self.addValueAtPosition(struct.pack(DataConstants.UBYTE_FORMAT, data), position, DataConstants.UBYTE_SIZE)
+        return self.packAtPosition(DataConstants.UBYTE_STRUCT, data, position)
 
     def getValueAtPosition(self, startPosition, valueDataSize):
         endPosition = startPosition + valueDataSize
@@ -131,107 +208,152 @@ class ByteBuffer(object):
         return value
 
     def getFloatFromData(self, data):
-        return struct.unpack(DataConstants.FLOAT_FORMAT, data)[0]
+        return DataConstants.FLOAT_STRUCT.unpack(data)[0]
 
     def getUnsignedIntegerFromData(self, data):
-        return struct.unpack(DataConstants.ULONG_FORMAT, data)[0]
+        return DataConstants.ULONG_STRUCT.unpack(data)[0]
 
     def getUnsignedIntegerFromData8(self, data):
-        return struct.unpack(DataConstants.UBYTE_FORMAT, data)[0]
+        return DataConstants.UBYTE_STRUCT.unpack(data)[0]
+
+    # Unpacks directly from the buffer, without slicing it.
+    def unpackAtPosition(self, theStruct, position):
+        endPosition = position + theStruct.size
+        if endPosition > self._used_size:
+            return self._used_size, theStruct.unpack("0" * theStruct.size)[0]
+
+        return endPosition, theStruct.unpack_from(self.buffer, position)[0]
+
+    def unpack(self, theStruct):
+        self.cursor_position, value = self.unpackAtPosition(theStruct, self._cursor_position)
+        return value
 
     def getUnsignedInteger(self):
-        rawData = self.getValue(DataConstants.ULONG_SIZE)
-        return self.getUnsignedIntegerFromData(rawData)
+        return self.unpack(DataConstants.ULONG_STRUCT)
 
     def getFloat(self):
-        rawData = self.getValue(DataConstants.FLOAT_SIZE)
-        return self.getFloatFromData(rawData)
+        return self.unpack(DataConstants.FLOAT_STRUCT)
 
     def getUnsignedIntegerAtPosition(self, position):
-        endPosition, rawData = self.getValueAtPosition(position, DataConstants.ULONG_SIZE)
-        return self.getUnsignedIntegerFromData(rawData)
+        endPosition, value = self.unpackAtPosition(DataConstants.ULONG_STRUCT, position)
+        return value
 
     def getUnsignedInteger8(self):
-        rawData = self.getValue(DataConstants.UBYTE_SIZE)
-        return self.getUnsignedIntegerFromData8(rawData)
+        return self.unpack(DataConstants.UBYTE_STRUCT)
 
     def getUnsignedIntegerAtPosition8(self, position):
-        endPosition, rawData = self.getValueAtPosition(position, DataConstants.UBYTE_SIZE)
-        return self.getUnsignedIntegerFromData8(rawData)
+        endPosition, value = self.unpackAtPosition(DataConstants.UBYTE_STRUCT, position)
+        return value
 
     def addVariableLengthData(self, data, dataSize, includePrefix = True):
-        newSize = self.cursor_position + dataSize
+        startPosition = self._cursor_position
         if includePrefix:
-            newSize += DataConstants.ULONG_SIZE
-        self.increaseMemorySize(newSize)
-        if includePrefix:
-            self.addUnsignedInteger(dataSize)
+            startPosition = self.packAtPosition(DataConstants.ULONG_STRUCT, dataSize, startPosition)
+
+        endPosition = startPosition + dataSize
+        self.ensureWritable()
+        self.increaseMemorySize(endPosition)
+        self.buffer[startPosition:endPosition] = data
 
-        self.buffer[self.cursor_position:newSize] = data
-        self.moveCursorForwards(dataSize)
+        if endPosition > self._used_size:
+            self._used_size = endPosition
+        self._cursor_position = endPosition
 
     def addByteBuffer(self, sourceBuffer, includePrefix = True):
         assert isinstance(sourceBuffer, ByteBuffer)
-        self.addVariableLengthData(sourceBuffer.buffer, sourceBuffer.used_size, includePrefix)
+        self.addVariableLengthData(sourceBuffer.getUsedView(), sourceBuffer.used_size, includePrefix)
 
     def addString(self, theString):
         assert isinstance(theString, basestring)
         self.addVariableLengthData(theString, len(theString))
 
     def getVariableLengthData(self, dataHandlerFunc, dataSize):
+        position = self._cursor_position
         if dataSize == 0:
-            prefixSize = DataConstants.ULONG_SIZE
-            if self.getUnreadDataFromCursor() < prefixSize:
+            if self._used_size - position < DataConstants.ULONG_SIZE:
                 return
 
-            dataSize = self.getUnsignedIntegerAtPosition(self.cursor_position)
-        else:
-            prefixSize = 0
+            dataSize = DataConstants.ULONG_STRUCT.unpack_from(self.buffer, position)[0]
+            position += DataConstants.ULONG_SIZE
 
-        if self.getUnreadDataFromCursor() < prefixSize + dataSize:
+        if self._used_size - position < dataSize:
             return
-        self.cursor_position += prefixSize
 
-        result = dataHandlerFunc(self.buffer[self.cursor_position:], dataSize)
-        self.cursor_position += dataSize
+        # A view of just the data we need, no copy is made.
+        endPosition = position + dataSize
+        result = dataHandlerFunc(self.getView()[position:endPosition], dataSize)
+        self._cursor_position = endPosition
         return result
 
-    def getStringWithLength(self, length):
-        def handlerFunc(theBuffer, dataSize):
-            return "".join(map(chr, theBuffer[:dataSize]))
+    @staticmethod
+    def _viewToString(theBuffer, dataSize):
+        return theBuffer.tobytes()
 
-        return self.getVariableLengthData(handlerFunc, length)
+    @staticmethod
+    def _viewToHexString(theBuffer, dataSize):
+        return theBuffer.tobytes().encode('hex')
 
+    @staticmethod
+    def _viewToByteBuffer(theBuffer, dataSize):
+        return ByteBuffer.buildFromView(theBuffer)
+
+    def getStringWithLength(self, length):
+        return self.getVariableLengthData(ByteBuffer._viewToString, length)
+
+    # Single copy of the used data, ready to be handed to a transport.
     def convertToString(self):
-        old_cursor = self.cursor_position
-        self.cursor_position = 0
-        a = self.getStringWithLength(self.used_size)
-        self.cursor_position = old_cursor
-        return a
+        return self.getUsedView().tobytes()
 
 
     def getString(self):
         return self.getStringWithLength(0)
 
     def getHexStringWithLength(self, length):
-        def handlerFunc(theBuffer, dataSize):
-            return ''.join('{:02x}'.format(x) for x in theBuffer[:dataSize])
-
-        return self.getVariableLengthData(handlerFunc, length)
+        return self.getVariableLengthData(ByteBuffer._viewToHexString, length)
 
     def getHexString(self):
         return self.getHexStringWithLength(0)
 
+    # The returned buffer is a view of this one.
     def getByteBufferWithLength(self, length):
-        def handlerFunc(theBuffer, dataSize):
-            return ByteBuffer.buildFromIterable(theBuffer[:dataSize])
-
-        return self.getVariableLengthData(handlerFunc, length)
+        return self.getVariableLengthData(ByteBuffer._viewToByteBuffer, length)
 
     def getByteBuffer(self):
         return self.getByteBufferWithLength(0)
 
 
+# Reusable buffers for packets which are built frequently, saving the cost of growing a fresh buffer each time.
+# Buffers must not be used after being released.
+class ByteBufferPool(object):
+    def __init__(self, maxBuffers=32, initialCapacity=256):
+        super(ByteBufferPool, self).__init__()
+        self.max_buffers = maxBuffers
+        self.initial_capacity = initialCapacity
+        self.buffers = list()
+        self._lock = Lock()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if len(self.buffers) > 0:
+                return self.buffers.pop()
+        finally:
+            self._lock.release()
+
+        return ByteBuffer(self.initial_capacity)
+
+    def release(self, byteBuffer):
+        assert isinstance(byteBuffer, ByteBuffer)
+        byteBuffer.reset()
+
+        self._lock.acquire()
+        try:
+            if len(self.buffers) < self.max_buffers:
+                self.buffers.append(byteBuffer)
+        finally:
+            self._lock.release()
+
+
 class ByteBufferTest(unittest.TestCase):
     def testTheBasics(self):
         a = ByteBuffer()
@@ -271,4 +393,65 @@ class ByteBufferTest(unittest.TestCase):
         self.assertEquals(a.memory_size, 42)
         self.assertEquals(a.cursor_position, 42)
 
+    def testViews(self):
+        inner = ByteBuffer()
+        inner.addUnsignedInteger8(7)
+        inner.addFloat(1.5)
+        inner.addString("picture")
+
+        a = ByteBuffer()
+        a.addUnsignedInteger(1)
+        a.addByteBuffer(inner)
+        a.addString("\xab\xcd")
+        a.cursor_position = 0
+
+        self.assertEquals(a.getUnsignedInteger(), 1)
+        b = a.getByteBuffer()
+        self.assertIsInstance(b.buffer, memoryview)
+        self.assertEquals(b.used_size, inner.used_size)
+        self.assertEquals(a.getHexString(), "abcd")
+
+        self.assertEquals(b.getUnsignedInteger8(), 7)
+        self.assertEquals(b.getFloat(), 1.5)
+        self.assertEquals(b.getString(), "picture")
+
+        # Copied on write, the original is left untouched.
+        b.addUnsignedInteger(5)
+        self.assertIsInstance(b.buffer, bytearray)
+        a.cursor_position = 4
+        self.assertEquals(a.getByteBuffer().convertToString(), inner.convertToString())
+
+    def testShortRead(self):
+        a = ByteBuffer.buildFromIterable("\x01\x02")
+        self.assertEquals(a.getUnsignedInteger(), DataConstants.ULONG_STRUCT.unpack("0000")[0])
+        self.assertEquals(a.cursor_position, 2)
+        self.assertIsNone(a.getString())
+
+    def testGrowth(self):
+        a = ByteBuffer()
+        for n in range(100):
+            a.addUnsignedInteger(n)
+
+        self.assertEquals(a.used_size, 400)
+        self.assertEquals(a.memory_size, 400)
+        self.assertTrue(a.capacity >= 400)
+        self.assertEquals(len(a.convertToString()), 400)
+
+        a.cursor_position = 396
+        self.assertEquals(a.getUnsignedInteger(), 99)
+
+    def testPool(self):
+        pool = ByteBufferPool(maxBuffers=1)
+        a = pool.acquire()
+        a.addString("Hello world")
+        pool.release(a)
+
+        b = pool.acquire()
+        self.assertIs(a, b)
+        self.assertEquals(b.used_size, 0)
+        self.assertEquals(b.convertToString(), "")
+
+        b.addUnsignedInteger8(1)
+        self.assertEquals(b.convertToString(), "\x01")
+
 
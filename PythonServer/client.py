@@ -1,19 +1,22 @@
 import logging
 from multiprocessing import Lock
-from byte_buffer import ByteBuffer
+from byte_buffer import ByteBuffer, ByteBufferPool
 from protocol_client import ClientTcp, ClientUdp
-from utility import getEpoch
-from twisted.internet import task
+from twisted.internet import defer
 from twisted.internet.error import AlreadyCalled, AlreadyCancelled
 from special_collections import OrderedSet
 from collections import namedtuple
 from database.blocking import Blocking
 import uuid
 import random
-from database.karma_leveled import KarmaLeveled
+import time
+from database.karma_ledger import KarmaLedger
 from database.persisted_ids import PersistedIds
 from utility import htons, inet_addr
 from remote_notification import RemoteNotification
+from forwarding_table import ForwardingTable
+from logon_admission import LogonAdmission
+from message_schema import MessageSchema, MessageDispatcher, Field, FieldType
 
 __author__ = 'pryormic'
 
@@ -34,6 +37,14 @@ class Client(object):
     # Client has 60 seconds to accept or reject match.
     ACCEPTING_MATCH_EXPIRY = 60
 
+    # Stages of logon which are timed, see LatencyHistogram. Database lookups run concurrently, session is the
+    # processing which follows them, total is until the logon is accepted or rejected and first card is until
+    # the first match is advised.
+    LOGON_STAGES = ['persisted_id', 'karma', 'session', 'total', 'first_card']
+
+    # Per match section of match information packets, see adviseMatchDetails.
+    match_details_packet_pool = ByteBufferPool()
+
     class ConnectionStatus:
         WAITING_LOGON = 1
         WAITING_UDP = 2
@@ -43,6 +54,9 @@ class Client(object):
     class UdpOperationCodes:
         OP_UDP_HASH = 4
 
+        # Optional prefix to media datagrams, see ForwardingTable.
+        OP_CONNECTION_ID = ForwardingTable.OP_CONNECTION_ID
+
     class TcpOperationCodes:
         OP_REJECT_LOGON = 1
         OP_ACCEPT_LOGON = 2
@@ -77,6 +91,10 @@ class Client(object):
         PERSISTED_ID_CLASH = 5
         INACTIVE_TIMEOUT = 6
 
+        # Too many logons at once, expiry time is the number of milliseconds to wait before retrying,
+        # magnitude is unused (always 0) so that the packet is laid out as for REJECT_BANNED.
+        REJECT_OVERLOADED = 7
+
     class ConversationRating:
         BLOCK = 2
         GOOD = 3
@@ -126,6 +144,18 @@ class Client(object):
             self.profile_picture = profilePicture
             self.profile_picture_orientation = profilePictureOrientation
 
+            # Parts of the match information packet describing us, which are the same whoever we are matched with.
+            # The profile picture is by far the largest thing we send, so we only want to serialize it once.
+            self.card_head = None
+            self.card_tail = None
+
+        # Called once details are final, i.e. at logon or when synthesizing an offline client.
+        def encodeCard(self):
+            if self.card_head is None:
+                self.card_head = TcpMessages.MATCH_CARD_HEAD.encode(self.short_name, self.age).convertToString()
+                self.card_tail = TcpMessages.MATCH_CARD_TAIL.encode(self.card_text, self.profile_picture, self.profile_picture_orientation).convertToString()
+            return self.card_head, self.card_tail
+
         def __hash__(self):
             return hash(self.unique_id)
 
@@ -144,7 +174,7 @@ class Client(object):
                                                         random.randint(0, 180), random.randint(0, 90), None, None, None)
         return item
 
-    def __init__(self, reactor, tcp, onCloseFunc, udpConnectionLinker, house, karmaDatabase, paymentVerifier, persistedIdsVerifier, remoteNotification):
+    def __init__(self, reactor, tcp, onCloseFunc, udpConnectionLinker, house, karmaDatabase, paymentVerifier, persistedIdsVerifier, remoteNotification, logonLatency=None, logonAdmission=None):
         super(Client, self).__init__()
         if tcp is not None:
             assert isinstance(tcp, ClientTcp)
@@ -152,10 +182,13 @@ class Client(object):
         assert isinstance(persistedIdsVerifier, PersistedIds)
 
         if karmaDatabase is not None:
-            assert isinstance(karmaDatabase, KarmaLeveled)
+            assert isinstance(karmaDatabase, KarmaLedger)
 
         assert isinstance(remoteNotification, RemoteNotification)
 
+        if logonAdmission is not None:
+            assert isinstance(logonAdmission, LogonAdmission)
+
         self.cleanup_immediate = False
         self.login_details = None
         self.reactor = reactor
@@ -170,18 +203,22 @@ class Client(object):
         self.udp_hash = None
         self.house = house
 
+        # Assigned once connected via UDP, clients which prefix their datagrams with it
+        # are routed by ID rather than by source address.
+        self.connection_id = None
+        self.connection_id_tag = None
+        self.uses_connection_id = False
+
         self.last_received_data = None
         self.payment_verifier = paymentVerifier
         self.persisted_ids_verifier = persistedIdsVerifier
 
-        if self.tcp is not None:
-            self.client_matcher = task.LoopingCall(self.house.aquireMatch, self)
-        else:
-            self.client_matcher = None
-
         def timeoutCheck():
+            # Checked every two seconds until the TCP connection is lost.
+            self.timeout_check = self.house.timing_wheel.callLater(2.0, timeoutCheck)
+
             if self.last_received_data is not None:
-                timeDiff = getEpoch() - self.last_received_data
+                timeDiff = self.house.timing_wheel.now - self.last_received_data
                 if timeDiff > 5.0:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.debug("Dropping client [%s] which has been inactive for %.2f seconds" % (self, timeDiff))
@@ -191,8 +228,7 @@ class Client(object):
                     # logger.debug("Client [%s] last pinged %.2f seconds ago" % (self, timeDiff))
 
         if self.tcp is not None:
-            self.timeout_check = task.LoopingCall(timeoutCheck)
-            self.timeout_check.start(2.0)
+            self.timeout_check = self.house.timing_wheel.callLater(2.0, timeoutCheck)
         else:
             self.timeout_check = None
 
@@ -206,7 +242,7 @@ class Client(object):
         self.karma_database = karmaDatabase
 
         # Need SocialID in order to do lookup, so preset with default value.
-        self.karma_rating = KarmaLeveled.KARMA_MAXIMUM
+        self.karma_rating = KarmaLedger.KARMA_MAXIMUM
 
         self.social_share_information_packet = None
         self.has_shared_social_information = False
@@ -221,6 +257,21 @@ class Client(object):
         self.remote_notification = remoteNotification
         self.has_been_notified = False
 
+        # Block and skip relations are held in memory while we are connected.
+        self.has_loaded_relations = False
+
+        # Logon is processed across database calls, further logon packets are dropped meanwhile.
+        self.is_logon_in_progress = False
+
+        # Logon stage -> LatencyHistogram, shared by all clients.
+        self.logon_latency = logonLatency
+
+        # Time that logon started, until the first card is advised.
+        self.logon_start_time = None
+
+        # Shared by all clients, decides when our logon is processed.
+        self.logon_admission = logonAdmission
+
     def transitionState(self, startState, endState):
         if startState == endState:
             return
@@ -259,10 +310,8 @@ class Client(object):
         if self.state != Client.State.MATCHED:
             return
 
-        packet = ByteBuffer()
-        packet.addUnsignedInteger8(Client.TcpOperationCodes.OP_NAT_PUNCHTHROUGH_ADDRESS)
-        packet.addUnsignedInteger(inet_addr(sourceClient.udp.remote_address[0]))
-        packet.addUnsignedInteger(htons(sourceClient.udp.remote_address[1]))
+        packet = TcpMessages.NAT_PUNCHTHROUGH_ADDRESS.encode(inet_addr(sourceClient.udp.remote_address[0]),
+                                                            htons(sourceClient.udp.remote_address[1]))
         self.transitionState(Client.State.ACCEPTING_MATCH, Client.State.MATCHED)
 
         if self.tcp is not None:
@@ -280,35 +329,38 @@ class Client(object):
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Scheduled new accepting match expiry for client [%s] in [%s] seconds" % (self, Client.ACCEPTING_MATCH_EXPIRY))
-        self.accepting_match_expiry_action = self.reactor.callLater(Client.ACCEPTING_MATCH_EXPIRY, self.doSkipTimedOut)
+        self.accepting_match_expiry_action = self.house.timing_wheel.callLater(Client.ACCEPTING_MATCH_EXPIRY, self.doSkipTimedOut)
 
     def adviseMatchDetails(self, sourceClient, distance, reconnectingClient = False):
-        packet = ByteBuffer()
-        packet.addUnsignedInteger8(Client.TcpOperationCodes.OP_ADVISE_MATCH_INFORMATION)
-        packet.addString(sourceClient.login_details.short_name)
-        packet.addUnsignedInteger(sourceClient.login_details.age)
-        packet.addUnsignedInteger(distance)
-        packet.addUnsignedInteger(Client.WAITING_FOR_RATING_TIMEOUT)
-        packet.addUnsignedInteger(KarmaLeveled.KARMA_MAXIMUM)
-        packet.addUnsignedInteger(Client.ACCEPTING_MATCH_EXPIRY)
-        packet.addUnsignedInteger(self.karma_rating)
-        packet.addString(sourceClient.login_details.card_text)
-        packet.addByteBuffer(sourceClient.login_details.profile_picture)
-        packet.addUnsignedInteger(sourceClient.login_details.profile_picture_orientation)
-        packet.addUnsignedInteger8(1 if reconnectingClient else 0)
-        packet.addUnsignedInteger8(1 if sourceClient.connection_status == Client.ConnectionStatus.CONNECTED else 0) # Informs whether the match is online or offline.
+        if self.logon_start_time is not None:
+            self._recordLogonLatency('first_card', self.logon_start_time)
+            self.logon_start_time = None
+
+        cardHead, cardTail = sourceClient.login_details.encodeCard()
+
+        details = Client.match_details_packet_pool.acquire()
+        TcpMessages.MATCH_DETAILS.encodeInto(details,
+                                             distance,
+                                             Client.WAITING_FOR_RATING_TIMEOUT,
+                                             KarmaLedger.KARMA_MAXIMUM,
+                                             Client.ACCEPTING_MATCH_EXPIRY,
+                                             self.karma_rating)
+        status = TcpMessages.MATCH_STATUS.encode(1 if reconnectingClient else 0,
+                                                 1 if sourceClient.connection_status == Client.ConnectionStatus.CONNECTED else 0) # Informs whether the match is online or offline.
+        parts = [cardHead, details.convertToString(), cardTail, status.convertToString()]
+        Client.match_details_packet_pool.release(details)
 
         self.transitionState(Client.State.MATCHING, Client.State.ACCEPTING_MATCH)
         self.startExpectingMatchExpiry()
 
 
         if self.tcp is not None:
-            self.tcp.sendByteBuffer(packet)
+            self.tcp.sendParts(parts)
         else:
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Not advising match details to offline client: %s" % self)
 
-            self.udp_connection_linker.clients_by_udp_hash[self.udp_hash] = self
+            self.udp_connection_linker.holdSession(self.udp_hash, self)
 
     def cancelAcceptingMatchExpiry(self):
         try:
@@ -327,7 +379,12 @@ class Client(object):
 
     # Just a way of passing the TCP disconnection to the governor, do not use directly.
     def onTcpSocketDisconnect(self):
-        self.timeout_check.stop()
+        if self.timeout_check.active():
+            self.timeout_check.cancel()
+
+        if self.has_loaded_relations:
+            self.house.unloadRelations(self)
+            self.has_loaded_relations = False
 
         if self.udp_hash is not None:
             if self.udp_connection_linker is not None:
@@ -346,7 +403,7 @@ class Client(object):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("UDP socket has connected: [%s]" % unicode(clientUdp))
         self.udp = clientUdp;
-        self.client_matcher.start(0.5)
+        self.house.addToMatchmaking(self)
 
         # don't need this anymore.
         self.udp_connection_linker = None
@@ -372,66 +429,123 @@ class Client(object):
     def getRejectBannedArguments(self, banMagnitude, expiryTime):
         return Client.RejectCodes.REJECT_BANNED, "You have run out of karma, please wait to regenerate\nMaximum wait time is: %.1f minutes" % (float(expiryTime) / 60.0), banMagnitude, expiryTime
 
+    def getRejectOverloadedArguments(self, retryAfterMs):
+        return Client.RejectCodes.REJECT_OVERLOADED, "Server is busy, please retry in %.1f seconds" % (float(retryAfterMs) / 1000.0), 0, retryAfterMs
+
+    # Returns a Deferred firing with (reject code, data string, magnitude, expiry time), or with None
+    # if the client disconnected while the logon was processed.
     def handleLogon(self, packet):
         assert isinstance(packet, ByteBuffer)
 
         isSessionHash = packet.getUnsignedInteger8() > 0
         if isSessionHash:
             # Reconnection attempt, UDP hash included in logon.
-            self.udp_hash = packet.getString()
-            if self.udp_hash not in self.udp_connection_linker.clients_by_udp_hash:
-                return Client.RejectCodes.REJECT_HASH_TIMEOUT, "Hash timed out, please reconnect fresh", None, None
-
-            # This indicates that a logon ACK should be sent via TCP.
-            self.udp_hash = self.udp_connection_linker.registerInterestGenerated(self, self.udp_hash)
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Reconnect accepted, hash: %s", self.udp_hash)
+            sessionHash = packet.getString()
         else:
-            self.udp_hash = self.udp_connection_linker.registerInterestGenerated(self)
+            sessionHash = None
+
+        logon = TcpMessages.LOGON.decode(packet)
 
         # Versioning.
-        version = packet.getUnsignedInteger()
-        if version < Client.MINIMUM_VERSION:
-            rejectText = "Invalid version %d vs required %d" % (version, Client.MINIMUM_VERSION)
-            return Client.RejectCodes.REJECT_VERSION, rejectText, None, None
+        if logon.version < Client.MINIMUM_VERSION:
+            rejectText = "Invalid version %d vs required %d" % (logon.version, Client.MINIMUM_VERSION)
+            return defer.succeed((Client.RejectCodes.REJECT_VERSION, rejectText, None, None))
 
         # See hologram login on app side.
-        isNewId = packet.getUnsignedInteger8()
-        persistedUniqueId = packet.getString()
+        persistedUniqueId = logon.persisted_id
+        if persistedUniqueId is None:
+            return defer.succeed((Client.RejectCodes.PERSISTED_ID_CLASH, "ID already in use", None, None))
+
+        startTime = time.time()
+        self.logon_start_time = startTime
+
+        # Lookups don't depend on each other, so run at the same time.
+        if logon.is_new_id:
+            validated = self.house.async_database.run(self.persisted_ids_verifier.validateId, persistedUniqueId)
+            validated.addCallback(self._onLogonStageComplete, 'persisted_id', startTime)
+        else:
+            validated = defer.succeed(True)
+
+        karma = self.house.async_database.runSerialized(persistedUniqueId, self.karma_database.getKarmaAndBanOfId, persistedUniqueId)
+        karma.addCallback(self._onLogonStageComplete, 'karma', startTime)
+
+        result = defer.DeferredList([validated, karma], fireOnOneErrback=True, consumeErrors=True)
+        result.addCallback(self._onLogonLookupsComplete, logon, sessionHash, startTime)
+        return result
+
+    def _recordLogonLatency(self, stage, startTime):
+        if self.logon_latency is not None:
+            self.logon_latency[stage].record(time.time() - startTime)
+
+    def _onLogonStageComplete(self, result, stage, startTime):
+        self._recordLogonLatency(stage, startTime)
+        return result
+
+    def _onLogonLookupsComplete(self, results, logon, sessionHash, startTime):
+        # Any failure has already been raised via the errback.
+        isValidId = results[0][1]
+        karma = results[1][1]
+
+        sessionStartTime = time.time()
+        result = self._onLogonLookups(isValidId, karma, logon, sessionHash)
+        self._recordLogonLatency('session', sessionStartTime)
+
+        if result is not None:
+            self._recordLogonLatency('total', startTime)
+        return result
 
-        if persistedUniqueId is None or (isNewId and not self.persisted_ids_verifier.validateId(persistedUniqueId)):
+    def _onLogonLookups(self, isValidId, karma, logon, sessionHash):
+        if self.connection_status != Client.ConnectionStatus.WAITING_LOGON:
+            return None
+
+        if not isValidId:
             return Client.RejectCodes.PERSISTED_ID_CLASH, "ID already in use", None, None
 
-        fullName = packet.getString()
-        shortName = packet.getString()
-        shortName = shortName[:50] # Restrict to 50 characters.
-        age = packet.getUnsignedInteger()
-        gender = packet.getUnsignedInteger()
-        interestedIn = packet.getUnsignedInteger()
+        persistedUniqueId = logon.persisted_id
+        isSessionHash = sessionHash is not None
+        if isSessionHash:
+            # Hashes are signed, so we can accept reconnects for sessions we no longer hold
+            # in memory, e.g. after a restart, as long as the hash has not expired.
+            isKnownHash = sessionHash in self.udp_connection_linker.clients_by_udp_hash
+            if not self.udp_connection_linker.session_hash_signer.verifyHash(sessionHash, persistedUniqueId, checkExpiry=not isKnownHash):
+                return Client.RejectCodes.REJECT_HASH_TIMEOUT, "Hash timed out, please reconnect fresh", None, None
+
+            # This indicates that a logon ACK should be sent via TCP.
+            self.udp_hash = self.udp_connection_linker.registerInterestGenerated(self, persistedUniqueId, sessionHash)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Reconnect accepted, hash: %s, known session: %s", self.udp_hash, isKnownHash)
+        else:
+            self.udp_hash = self.udp_connection_linker.registerInterestGenerated(self, persistedUniqueId)
+
+        fullName = logon.full_name
+        shortName = logon.short_name[:50] # Restrict to 50 characters.
+        age = logon.age
+        gender = logon.gender
+        interestedIn = logon.interested_in
 
-        latitude = packet.getFloat()
-        longitude = packet.getFloat()
+        latitude = logon.latitude
+        longitude = logon.longitude
 
-        karmaRegenerationReceipt = packet.getByteBuffer()
+        karmaRegenerationReceipt = logon.karma_regeneration_receipt
         assert isinstance(karmaRegenerationReceipt, ByteBuffer)
 
         if karmaRegenerationReceipt.used_size == 0:
             karmaRegenerationReceipt = None
 
-        cardText = packet.getString()
-        profilePicture = packet.getByteBuffer()
-        profilePictureOrientation = packet.getUnsignedInteger()
+        cardText = logon.card_text
+        profilePicture = logon.profile_picture
+        profilePictureOrientation = logon.profile_picture_orientation
 
         self.login_details = Client.LoginDetails(self.udp_hash, persistedUniqueId, fullName, shortName, age, gender, interestedIn, longitude, latitude, cardText, profilePicture, profilePictureOrientation)
+        self.login_details.encodeCard()
 
-        banMagnitude, banTime = self.karma_database.getBanMagnitudeAndExpirationTime(self)
+        self.karma_rating, banMagnitude, banTime = karma
         if banTime is not None and karmaRegenerationReceipt is None:
             return self.getRejectBannedArguments(banMagnitude, banTime)
 
-        self.karma_rating = self.karma_database.getKarma(self)
-
+        loginDetails = self.login_details
         if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("(Full details) Login processed with details, udp hash: [%s], full name: [%s], short name: [%s], age: [%d], gender [%d], interested in [%d], GPS: [(%d,%d)], Karma [%d]" % (self.udp_hash, fullName, shortName, age, gender, interestedIn, longitude, latitude, self.karma_rating))
+            logger.debug("(Full details) Login processed with details, udp hash: [%s], full name: [%s], short name: [%s], age: [%d], gender [%d], interested in [%d], GPS: [(%d,%d)], Karma [%d]" % (self.udp_hash, loginDetails.name, loginDetails.short_name, loginDetails.age, loginDetails.gender, loginDetails.interested_in, loginDetails.longitude, loginDetails.latitude, self.karma_rating))
         logger.info("Client %s login accepted with udp hash: [%s]" % (self.login_details, self.udp_hash))
 
         return Client.RejectCodes.SUCCESS, self.udp_hash, karmaRegenerationReceipt, None
@@ -443,16 +557,7 @@ class Client(object):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Logon rejected, closing connection, reject code [%d], reject reason [%s]" % (rejectCode, dataString))
 
-        response.addUnsignedInteger8(Client.TcpOperationCodes.OP_REJECT_LOGON)
-        response.addUnsignedInteger8(rejectCode)
-        response.addString(dataString)
-        if magnitude is not None:
-            response.addUnsignedInteger8(magnitude)
-
-        if expiryTime is not None:
-            response.addUnsignedInteger(expiryTime)
-
-        return response
+        return TcpMessages.REJECT_LOGON.encodeInto(response, rejectCode, dataString, magnitude, expiryTime)
 
     def onLoginSuccess(self, dataString):
         if self.connection_status != Client.ConnectionStatus.WAITING_LOGON:
@@ -460,13 +565,15 @@ class Client(object):
 
         self.connection_status = Client.ConnectionStatus.WAITING_UDP
 
+        if not self.has_loaded_relations:
+            self.house.loadRelations(self)
+            self.has_loaded_relations = True
+
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Logon accepted, waiting for UDP connection")
             logger.debug("Sending acceptance response to TCP client: %s", self.tcp)
 
-        response = ByteBuffer()
-        response.addUnsignedInteger8(Client.TcpOperationCodes.OP_ACCEPT_LOGON)
-        response.addString(dataString)  # the UDP hash code.
+        response = TcpMessages.ACCEPT_LOGON.encode(dataString)  # the UDP hash code.
         self.tcp.sendByteBuffer(response)
 
     def onLoginFailure(self, rejectCode, dataString, magnitude = None, expiryTime = None):
@@ -484,17 +591,22 @@ class Client(object):
     def handleTcpPacket(self, packet):
         assert isinstance(packet, ByteBuffer)
         if self.connection_status == Client.ConnectionStatus.WAITING_LOGON:
-            rejectCode, dataString, magnitude, expiryTime = self.handleLogon(packet)
-            rejected = rejectCode != Client.RejectCodes.SUCCESS
-            if not rejected:
-                if magnitude is None:
-                    self.onLoginSuccess(dataString)
-                else:
-                    # magnitude is the karma regeneration transaction which needs to be verified.
-                    # It is a ByteBuffer object.
-                    self.payment_verifier.pushEvent(magnitude, self, dataString)
-            else:
-                self.onLoginFailure(rejectCode, dataString, magnitude, expiryTime)
+            if self.is_logon_in_progress:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("TCP packet received while logon is in progress, dropping packet")
+                return
+
+            self.is_logon_in_progress = True
+            if self.logon_admission is None:
+                self._startLogon(packet, None)
+                return
+
+            # Peek at whether a session hash is presented, without moving past it.
+            isReconnect = packet.getUnsignedIntegerAtPosition8(packet.cursor_position) > 0
+            retryAfterMs = self.logon_admission.request(self.tcp.remote_address.host, isReconnect,
+                                                        lambda retryAfterMs: self._startLogon(packet, retryAfterMs))
+            if retryAfterMs is not None:
+                self._rejectOverloaded(retryAfterMs)
 
         elif self.connection_status == Client.ConnectionStatus.WAITING_UDP:
             if logger.isEnabledFor(logging.DEBUG):
@@ -507,6 +619,55 @@ class Client(object):
             logger.error("Client in unsupported connection state: %d" % self.connection_status)
             self.closeConnection()
 
+    # Called once admitted, or with the number of milliseconds to wait before retrying if turned away.
+    def _startLogon(self, packet, retryAfterMs):
+        if retryAfterMs is not None:
+            self._rejectOverloaded(retryAfterMs)
+            return
+
+        # Disconnected while waiting to be admitted.
+        if self.connection_status != Client.ConnectionStatus.WAITING_LOGON:
+            self._releaseLogonAdmission(None)
+            return
+
+        result = defer.maybeDeferred(self.handleLogon, packet)
+        if self.logon_admission is not None:
+            result.addBoth(self._releaseLogonAdmission)
+        result.addCallback(self._onLogonHandled)
+        result.addErrback(self._onLogonError)
+
+    def _releaseLogonAdmission(self, result):
+        self.logon_admission.release()
+        return result
+
+    def _rejectOverloaded(self, retryAfterMs):
+        self.is_logon_in_progress = False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Too many logons in progress, asking client [%s] to retry in [%d] milliseconds" % (self, retryAfterMs))
+        self.onLoginFailure(*self.getRejectOverloadedArguments(retryAfterMs))
+
+    def _onLogonHandled(self, logonResult):
+        self.is_logon_in_progress = False
+        if logonResult is None:
+            return
+
+        rejectCode, dataString, magnitude, expiryTime = logonResult
+        rejected = rejectCode != Client.RejectCodes.SUCCESS
+        if not rejected:
+            if magnitude is None:
+                self.onLoginSuccess(dataString)
+            else:
+                # magnitude is the karma regeneration transaction which needs to be verified.
+                # It is a ByteBuffer object.
+                self.payment_verifier.pushEvent(magnitude, self, dataString)
+        else:
+            self.onLoginFailure(rejectCode, dataString, magnitude, expiryTime)
+
+    def _onLogonError(self, failure):
+        self.is_logon_in_progress = False
+        logger.error("Failed to process logon of client [%s], closing connection: %s" % (self, failure.getErrorMessage()))
+        self.closeConnection()
+
     def handleUdpPacket(self, packet):
         if self.connection_status != Client.ConnectionStatus.CONNECTED:
             if logger.isEnabledFor(logging.DEBUG):
@@ -557,63 +718,67 @@ class Client(object):
     def onFriendlyPacketTcp(self, packet):
         assert isinstance(packet, ByteBuffer)
 
-        opCode = packet.getUnsignedInteger8()
-        if opCode == Client.TcpOperationCodes.OP_PING:
-            self.last_received_data = getEpoch()
-        elif opCode == Client.TcpOperationCodes.OP_SKIP_PERSON:
-            self.doSkip()
-        elif opCode == Client.TcpOperationCodes.OP_RATING:
-            if self.client_most_recently_matched_with is None:
+        if not Client.tcp_dispatcher.dispatch(self, packet):
+            # Must be debug in case rogue client sends us garbage data
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Unknown TCP packet received from client [%s]" % self)
+            self.closeConnection()
+
+    def onPing(self, message):
+        self.last_received_data = self.house.timing_wheel.now
+
+    def onSkipPerson(self, message):
+        self.doSkip()
+
+    def onRating(self, message):
+        if self.client_most_recently_matched_with is None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("No previous conversation to rate")
+            return
+
+        rating = message.rating
+
+        # Only needed in accepting match because need to close the room in the house.
+        # The other case where rating is received, is after a conversation has finished,
+        # and after the room has already been released.
+        self.house.house_lock.acquire()
+        try:
+            if self.state == Client.State.ACCEPTING_MATCH:
                 if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("No previous conversation to rate")
+                    logger.debug("Retrieved match during ACCEPTING_MATCH stage, [%s] has blocked [%s]" % (self, self.client_most_recently_matched_with))
+                self.client_most_recently_matched_with.handleRating(rating)
+                self.doSkip()
                 return
+        finally:
+            self.house.house_lock.release()
 
-            rating = packet.getUnsignedInteger8()
+        self.setRatingOfOtherClient(rating)
 
-            # Only needed in accepting match because need to close the room in the house.
-            # The other case where rating is received, is after a conversation has finished,
-            # and after the room has already been released.
-            self.house.house_lock.acquire()
-            try:
-                if self.state == Client.State.ACCEPTING_MATCH:
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Retrieved match during ACCEPTING_MATCH stage, [%s] has blocked [%s]" % (self, self.client_most_recently_matched_with))
-                    self.client_most_recently_matched_with.handleRating(rating)
-                    self.doSkip()
-                    return
-            finally:
-                self.house.house_lock.release()
+    def onPermDisconnect(self, message):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Client [%s] has permanently disconnected with immediate impact" % self)
 
-            self.setRatingOfOtherClient(rating)
+        # This closes the UDP session, without giving the client a chance to reconnect. It's important so that
+        # rooms dont get released later if an offline profile is loaded.
+        if self.should_notify_on_match_accept:
+            self.cleanup_immediate = True
 
-        elif opCode == Client.TcpOperationCodes.OP_PERM_DISCONNECT:
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Client [%s] has permanently disconnected with immediate impact" % self)
+        self.house.releaseRoom(self, self.house.disconnected_permanent)
+        self.closeConnection()
 
-            # This closes the UDP session, without giving the client a chance to reconnect. It's important so that
-            # rooms dont get released later if an offline profile is loaded.
-            if self.should_notify_on_match_accept:
-                self.cleanup_immediate = True
+    def onAcceptedConversation(self, message):
+        logger.info("Client %s accepted the card" % self.login_details)
+        self.clearInactivityCounter()
+        if not self.house.onAcceptConversation(self):
+            self.doSkip()
 
-            self.house.releaseRoom(self, self.house.disconnected_permanent)
-            self.closeConnection()
-        elif opCode == Client.TcpOperationCodes.OP_ACCEPTED_CONVERSATION:
-            logger.info("Client %s accepted the card" % self.login_details)
-            self.clearInactivityCounter()
-            if not self.house.onAcceptConversation(self):
-                self.doSkip()
-        elif opCode == Client.TcpOperationCodes.OP_REQUEST_NOTIFICATION:
-            self.remote_notification_payload = packet.getHexString()
+    def onRequestNotification(self, message):
+        self.remote_notification_payload = message.payload
 
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Received remote notification request from client [%s], payload: %s" % (self, self.remote_notification_payload))
-            logger.info("Client %s requested that it be notified" % self.login_details)
-            self.house.enableRemoteNotification(self)
-        else:
-            # Must be debug in case rogue client sends us garbage data
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Unknown TCP packet received from client [%s]" % self)
-            self.closeConnection()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received remote notification request from client [%s], payload: %s" % (self, self.remote_notification_payload))
+        logger.info("Client %s requested that it be notified" % self.login_details)
+        self.house.enableRemoteNotification(self)
 
     # If forced, we will transition state even if we are not waiting to receive a rating from the client.
     def setRatingOfOtherClient(self, rating, forced=False):
@@ -664,12 +829,13 @@ class Client(object):
         try:
             currentKarma = [self.karma_rating]
 
-            def sendBannedMessage():
+            # Karma is adjusted in memory straight away, the database is updated on a database thread.
+            def getBan():
                 banMagnitude, banTime = self.karma_database.getBanMagnitudeAndExpirationTime(self)
                 if banTime is None:
-                    return
+                    return None
 
-                self.sendBanMessage(banMagnitude, banTime)
+                return banMagnitude, banTime
 
             def deductKarma():
                 deductSize = 2
@@ -678,25 +844,38 @@ class Client(object):
                     deductSize += currentKarma[0]
                     currentKarma[0] = 0
 
-                for n in range(0,deductSize):
-                    isBanned = self.karma_database.deductKarma(self, currentKarma[0])
-                    if isBanned:
-                        sendBannedMessage()
-                        return
+                karmaAfterDeduction = currentKarma[0]
+                def pushDeductions():
+                    for n in range(0,deductSize):
+                        isBanned = self.karma_database.deductKarma(self, karmaAfterDeduction)
+                        if isBanned:
+                            return getBan()
+                    return None
+
+                return pushDeductions
 
             def incrementKarma():
                 incrementSize = 1
+                incrementCount = 0
                 for n in range(0,incrementSize):
                     currentKarma[0] += incrementSize
-                    if currentKarma[0] > KarmaLeveled.KARMA_MAXIMUM:
-                        currentKarma[0] = KarmaLeveled.KARMA_MAXIMUM
+                    if currentKarma[0] > KarmaLedger.KARMA_MAXIMUM:
+                        currentKarma[0] = KarmaLedger.KARMA_MAXIMUM
                     else:
+                        incrementCount += 1
+
+                def pushIncrements():
+                    for n in range(0,incrementCount):
                         self.karma_database.incrementKarma(self)
+                    return None
+
+                return pushIncrements
 
+            pushRating = None
             if rating == Client.ConversationRating.BLOCK:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Block for client [%s] received from [%s]" % (self, self.client_most_recently_matched_with))
-                deductKarma()
+                pushRating = deductKarma()
                 self.house.pushBlock(self.client_most_recently_matched_with, self)
 
                 if self.client_most_recently_matched_with is not None:
@@ -704,23 +883,37 @@ class Client(object):
             elif rating == Client.ConversationRating.GOOD:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Good rating for client [%s] received" % self)
-                incrementKarma()
+                pushRating = incrementKarma()
 
                 if self.client_most_recently_matched_with is not None:
                     logger.info("Client %s received good rating from %s" % (self.login_details, self.client_most_recently_matched_with.login_details))
             elif rating == Client.ConversationRating.AUDIT:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Audited client [%s] for bans" % self)
-                sendBannedMessage()
+                pushRating = getBan
             else:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Invalid rating received, dropping client: %d" % rating)
                 self.closeConnection()
 
             self.karma_rating = currentKarma[0]
+
+            if pushRating is not None:
+                result = self.house.async_database.runSerialized(self.login_details.persisted_unique_id, pushRating)
+                result.addCallbacks(self._onRatingPushed, self._onRatingPushFailure)
         finally:
             self.house.house_lock.release()
 
+    def _onRatingPushed(self, ban):
+        if ban is None:
+            return
+
+        banMagnitude, banTime = ban
+        self.sendBanMessage(banMagnitude, banTime)
+
+    def _onRatingPushFailure(self, failure):
+        logger.error("Failed to update karma of client [%s]: %s" % (self, failure.getErrorMessage()))
+
     def auditBans(self):
         self.handleRating(Client.ConversationRating.AUDIT)
 
@@ -734,7 +927,7 @@ class Client(object):
             if not self.transitionState(Client.State.MATCHED, Client.State.RATING_MATCH):
                 return
 
-            self.waiting_for_rating_task = self.reactor.callLater(Client.WAITING_FOR_RATING_ABSOLUTE_TIMEOUT, self._onWaitingForRatingTimeout)
+            self.waiting_for_rating_task = self.house.timing_wheel.callLater(Client.WAITING_FOR_RATING_ABSOLUTE_TIMEOUT, self._onWaitingForRatingTimeout)
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Client [%s] is waiting for rating from previous conversation with client [%s]" % (self, clientFromPreviousConversation))
         finally:
@@ -845,7 +1038,7 @@ class Client(object):
             if self.tcp is None:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Manually adding offline client to UDP network store: [%s]" % self)
-                self.udp_connection_linker.clients_by_udp_hash[self.udp_hash] = self
+                self.udp_connection_linker.holdSession(self.udp_hash, self)
         finally:
             self.house.house_lock.release()
 
@@ -858,14 +1051,15 @@ class Client(object):
 
                 try:
                     del self.udp_connection_linker.clients_by_udp_hash[self.udp_hash]
+                    self.udp_connection_linker.releaseSession(self.udp_hash)
                 except KeyError:
                     logger.error("Closing room involving offline client, could not find in clients_by_udp_hash [%s], hash [%s]" % (self, self.udp_hash))
         finally:
             self.house.house_lock.release()
 
     def clearKarma(self):
-        self.karma_database.clearKarma(self)
-        self.karma_rating = KarmaLeveled.KARMA_MAXIMUM
+        self.house.async_database.runInBackground(self.login_details.persisted_unique_id, self.karma_database.clearKarma, self)
+        self.karma_rating = KarmaLedger.KARMA_MAXIMUM
 
     def onFriendlyPacketUdp(self, packet):
         self.house.handleUdpPacket(self, packet)
@@ -916,4 +1110,81 @@ class Client(object):
         return self.udp_hash == other.udp_hash
 
     def __hash__(self):
-        return hash(self.udp_hash)
\ No newline at end of file
+        return hash(self.udp_hash)
+
+
+# Wire format of every TCP message, see message_schema.
+class TcpMessages:
+    # Client -> server, the logon packet has no op code and starts with the optional session hash,
+    # which is read separately.
+    LOGON = MessageSchema("Logon", None, [Field("version", FieldType.UINT32),
+                                          Field("is_new_id", FieldType.UINT8),
+                                          Field("persisted_id", FieldType.STRING),
+                                          Field("full_name", FieldType.STRING),
+                                          Field("short_name", FieldType.STRING),
+                                          Field("age", FieldType.UINT32),
+                                          Field("gender", FieldType.UINT32),
+                                          Field("interested_in", FieldType.UINT32),
+                                          Field("latitude", FieldType.FLOAT),
+                                          Field("longitude", FieldType.FLOAT),
+                                          Field("karma_regeneration_receipt", FieldType.BYTES),
+                                          Field("card_text", FieldType.STRING),
+                                          Field("profile_picture", FieldType.BYTES),
+                                          Field("profile_picture_orientation", FieldType.UINT32)])
+
+    PING = MessageSchema("Ping", Client.TcpOperationCodes.OP_PING, [])
+    SKIP_PERSON = MessageSchema("SkipPerson", Client.TcpOperationCodes.OP_SKIP_PERSON, [])
+    RATING = MessageSchema("Rating", Client.TcpOperationCodes.OP_RATING, [Field("rating", FieldType.UINT8)])
+    PERM_DISCONNECT = MessageSchema("PermDisconnect", Client.TcpOperationCodes.OP_PERM_DISCONNECT, [])
+    ACCEPTED_CONVERSATION = MessageSchema("AcceptedConversation", Client.TcpOperationCodes.OP_ACCEPTED_CONVERSATION, [])
+    REQUEST_NOTIFICATION = MessageSchema("RequestNotification", Client.TcpOperationCodes.OP_REQUEST_NOTIFICATION, [Field("payload", FieldType.HEX)])
+
+    # Server -> client.
+    REJECT_LOGON = MessageSchema("RejectLogon", Client.TcpOperationCodes.OP_REJECT_LOGON, [Field("reject_code", FieldType.UINT8),
+                                                                                          Field("reason", FieldType.STRING),
+                                                                                          Field("magnitude", FieldType.UINT8, optional=True),
+                                                                                          Field("expiry_time", FieldType.UINT32, optional=True)])
+
+    ACCEPT_LOGON = MessageSchema("AcceptLogon", Client.TcpOperationCodes.OP_ACCEPT_LOGON, [Field("udp_hash", FieldType.STRING)])
+
+    # Clients which do not support connection IDs ignore it. Those that do tag it with their
+    # session hash, see ForwardingTable.getConnectionIdTag.
+    ACCEPT_UDP = MessageSchema("AcceptUdp", Client.TcpOperationCodes.OP_ACCEPT_UDP, [Field("connection_id", FieldType.UINT32)])
+
+    NAT_PUNCHTHROUGH_ADDRESS = MessageSchema("NatPunchthroughAddress", Client.TcpOperationCodes.OP_NAT_PUNCHTHROUGH_ADDRESS, [Field("address", FieldType.UINT32),
+                                                                                                                            Field("port", FieldType.UINT32)])
+
+    # Historically these have a 4 byte op code.
+    NAT_PUNCHTHROUGH_CLIENT_DISCONNECT = MessageSchema("NatPunchthroughClientDisconnect", Client.TcpOperationCodes.OP_NAT_PUNCHTHROUGH_CLIENT_DISCONNECT, [], opCodeType=FieldType.UINT32)
+    TEMP_DISCONNECT = MessageSchema("TempDisconnect", Client.TcpOperationCodes.OP_TEMP_DISCONNECT, [], opCodeType=FieldType.UINT32)
+    PERM_DISCONNECT_ADVICE = MessageSchema("PermDisconnectAdvice", Client.TcpOperationCodes.OP_PERM_DISCONNECT, [], opCodeType=FieldType.UINT32)
+    SKIPPED_DISCONNECT = MessageSchema("SkippedDisconnect", Client.TcpOperationCodes.OP_SKIPPED_DISCONNECT, [], opCodeType=FieldType.UINT32)
+
+    ADVISE_MATCH_INFORMATION = MessageSchema("AdviseMatchInformation", Client.TcpOperationCodes.OP_ADVISE_MATCH_INFORMATION, [Field("short_name", FieldType.STRING),
+                                                                                                                             Field("age", FieldType.UINT32),
+                                                                                                                             Field("distance", FieldType.UINT32),
+                                                                                                                             Field("waiting_for_rating_timeout", FieldType.UINT32),
+                                                                                                                             Field("karma_maximum", FieldType.UINT32),
+                                                                                                                             Field("accepting_match_expiry", FieldType.UINT32),
+                                                                                                                             Field("karma", FieldType.UINT32),
+                                                                                                                             Field("card_text", FieldType.STRING),
+                                                                                                                             Field("profile_picture", FieldType.BYTES),
+                                                                                                                             Field("profile_picture_orientation", FieldType.UINT32),
+                                                                                                                             Field("reconnecting", FieldType.UINT8),
+                                                                                                                             Field("online", FieldType.UINT8)])
+
+    # ADVISE_MATCH_INFORMATION split into the parts which are cached per client (head and tail)
+    # and the parts which are specific to the match, concatenated they are the same packet.
+    MATCH_CARD_HEAD = MessageSchema("MatchCardHead", Client.TcpOperationCodes.OP_ADVISE_MATCH_INFORMATION, ADVISE_MATCH_INFORMATION.fields[0:2])
+    MATCH_DETAILS = MessageSchema("MatchDetails", None, ADVISE_MATCH_INFORMATION.fields[2:7])
+    MATCH_CARD_TAIL = MessageSchema("MatchCardTail", None, ADVISE_MATCH_INFORMATION.fields[7:10])
+    MATCH_STATUS = MessageSchema("MatchStatus", None, ADVISE_MATCH_INFORMATION.fields[10:12])
+
+# Messages accepted from clients once fully connected.
+Client.tcp_dispatcher = MessageDispatcher()
+Client.tcp_dispatcher.register(TcpMessages.PING, Client.onPing)
+Client.tcp_dispatcher.register(TcpMessages.SKIP_PERSON, Client.onSkipPerson)
+Client.tcp_dispatcher.register(TcpMessages.RATING, Client.onRating)
+Client.tcp_dispatcher.register(TcpMessages.PERM_DISCONNECT, Client.onPermDisconnect)
+Client.tcp_dispatcher.register(TcpMessages.ACCEPTED_CONVERSATION, Client.onAcceptedConversation)
+Client.tcp_dispatcher.register(TcpMessages.REQUEST_NOTIFICATION, Client.onRequestNotification)
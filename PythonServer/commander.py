@@ -36,6 +36,9 @@ class CommanderGovernor(object):
         self.forwardPacket = None
         self.governorHost = governorHost
         self.current_load = 0
+
+        # Governor is turning logons away, see LogonAdmission.
+        self.is_overloaded = False
         self.serverName = None
         self.disconnect_timeout = reactor.callLater(CommanderGovernor.TIMEOUT, self.forceDisconnect)
 
@@ -90,8 +93,16 @@ class CommanderGovernor(object):
             self.connection_status = CommanderGovernor.ConnectionStatus.CONNECTED
         elif self.connection_status == CommanderGovernor.ConnectionStatus.CONNECTED:
             load = packet.getUnsignedInteger()
-            logger.info("Received load of [%d] from governor [%s]" % (load, self))
+
+            # Governors from before overload was reported send only their load.
+            if packet.cursor_position < packet.used_size:
+                isOverloaded = packet.getUnsignedInteger8() > 0
+            else:
+                isOverloaded = False
+
+            logger.info("Received load of [%d] from governor [%s], overloaded: [%s]" % (load, self, isOverloaded))
             self.current_load = load
+            self.is_overloaded = isOverloaded
         elif self.connection_status == CommanderGovernor.ConnectionStatus.DISCONNECTED:
             logger.error("Received packet from governor while disconnected")
         else:
@@ -127,6 +138,13 @@ class CommanderGovernorController(ClientFactory):
                 if subServer.serverName is not None and subServer.serverName not in self.sub_servers_by_name:
                     self.sub_servers_by_name[subServer.serverName] = subServer
 
+                # Overloaded governors are only used if every governor is overloaded.
+                if lowestSubServer is not None and subServer.is_overloaded != lowestSubServer.is_overloaded:
+                    if subServer.is_overloaded:
+                        continue
+
+                    lowestSubServer = None
+
                 currentLoad = subServer.current_load
                 if currentLoad < lowest_load or lowestSubServer is None:
                     lowest_load = currentLoad
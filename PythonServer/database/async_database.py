@@ -0,0 +1,106 @@
+import logging
+import time
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from stat_tracker import PeriodMetrics
+
+logger = logging.getLogger(__name__)
+
+# Runs blocking database calls on a bounded pool of threads, so that the reactor thread (and so media relaying)
+# never waits for the database. Results are delivered via Deferreds which fire on the reactor thread.
+#
+# Functions run on the pool must only touch the database, and read state which does not change while they run.
+class AsyncDatabase(object):
+    MAX_THREADS = 8
+
+    def __init__(self, reactor, maxThreads=MAX_THREADS):
+        super(AsyncDatabase, self).__init__()
+        self.reactor = reactor
+        self.thread_pool = ThreadPool(minthreads=1, maxthreads=maxThreads, name="database")
+
+        # Key -> Deferred which fires once the last operation queued with that key has completed.
+        self.tails_by_key = dict()
+
+        # Operations which have been queued but not yet completed.
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+        self.period_metrics = PeriodMetrics('completed', 'failed', 'total_latency', 'max_latency')
+
+        reactor.callWhenRunning(self.thread_pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.thread_pool.stop)
+
+    def run(self, func, *args, **kwargs):
+        self.queue_depth += 1
+        if self.queue_depth > self.max_queue_depth:
+            self.max_queue_depth = self.queue_depth
+
+        d = threads.deferToThreadPool(self.reactor, self.thread_pool, func, *args, **kwargs)
+        d.addBoth(self._onComplete, time.time())
+        return d
+
+    # Operations with the same key run one after the other, in the order they were queued,
+    # e.g. so that a record is not removed before it has been written.
+    def runSerialized(self, key, func, *args, **kwargs):
+        result = defer.Deferred()
+        previousTail = self.tails_by_key.get(key)
+        tail = defer.Deferred()
+        self.tails_by_key[key] = tail
+
+        def onComplete(outcome):
+            if self.tails_by_key.get(key) is tail:
+                del self.tails_by_key[key]
+            tail.callback(None)
+
+            if isinstance(outcome, Failure):
+                result.errback(outcome)
+            else:
+                result.callback(outcome)
+
+        def execute(ignored):
+            self.run(func, *args, **kwargs).addBoth(onComplete)
+
+        if previousTail is None:
+            execute(None)
+        else:
+            previousTail.addCallback(execute)
+
+        return result
+
+    # Runs an operation which nobody waits for, failures are logged.
+    def runInBackground(self, key, func, *args, **kwargs):
+        def onFailure(failure):
+            logger.error("Background database operation [%s] failed: %s" % (func.__name__, failure.getErrorMessage()))
+
+        self.runSerialized(key, func, *args, **kwargs).addErrback(onFailure)
+
+    def _onComplete(self, outcome, submitTime):
+        latency = time.time() - submitTime
+        self.queue_depth -= 1
+        self.period_metrics.completed += 1
+        self.period_metrics.total_latency += latency
+        self.period_metrics.recordMax('max_latency', latency)
+
+        if isinstance(outcome, Failure):
+            self.period_metrics.failed += 1
+
+        return outcome
+
+    # Returns metrics since they were last reported, and starts a new reporting period.
+    def getMetrics(self):
+        period = self.period_metrics.take()
+        metrics = {'queue_depth': self.queue_depth,
+                   'max_queue_depth': self.max_queue_depth,
+                   'completed': period['completed'],
+                   'failed': period['failed'],
+                   'average_latency_ms': PeriodMetrics.getAverage(period['total_latency'], period['completed']) * 1000,
+                   'max_latency_ms': period['max_latency'] * 1000}
+
+        self.max_queue_depth = self.queue_depth
+        return metrics
+
+    def reportMetrics(self):
+        metrics = self.getMetrics()
+        logger.info("Database operations, queue depth: [%(queue_depth)d] (max %(max_queue_depth)d), completed: [%(completed)d], "
+                    "failed: [%(failed)d], latency: [%(average_latency_ms).2fms] average, [%(max_latency_ms).2fms] max" % metrics)
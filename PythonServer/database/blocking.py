@@ -1,16 +1,204 @@
 import logging
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from threading import RLock
 import pymongo
 import pymongo.errors
+from database.write_behind import DirectWrites, Operation
 
 logger = logging.getLogger(__name__)
 
 class Blocking(object):
-    def __init__(self, mongoCollection, expiryTimeSeconds=None):
+    def __init__(self, mongoCollection, expiryTimeSeconds=None, writeBehind=None):
         self.block_collection = mongoCollection
         self.expiry_time_seconds = expiryTimeSeconds
 
+        if writeBehind is None:
+            writeBehind = DirectWrites(mongoCollection.database)
+        self.write_behind = writeBehind
+
+        # Relations of connected clients, so that matching does not need to query the database.
+        #
+        # Persisted ID -> number of clients which have loaded its relations.
+        self.relation_references = dict()
+
+        # Persisted ID -> {persisted ID it blocked -> expiry date, None if never expires}
+        self.blocked_by_id = dict()
+
+        # Persisted ID -> {persisted ID which blocked it -> expiry date, None if never expires}
+        self.blockers_by_id = dict()
+
+        # The same, for blocks made while the persisted ID's relations were being queried, which the
+        # query may have missed. Merged in once the query completes.
+        self.pending_blocked_by_id = dict()
+        self.pending_blockers_by_id = dict()
+
+        self.relations_lock = RLock()
+
+    def _getExpiry(self, date):
+        if self.expiry_time_seconds is None or date is None:
+            return None
+
+        return date + timedelta(seconds=self.expiry_time_seconds)
+
+    # Loads all relations of the client's persisted ID in one query, until unloadRelations is called
+    # the same number of times.
+    #
+    # Raises ValueError if the query fails, the relations stay referenced but not loaded, see reloadRelations.
+    def loadRelations(self, client):
+        socialId = client.login_details.persisted_unique_id
+
+        self.relations_lock.acquire()
+        try:
+            self.relation_references[socialId] = self.relation_references.get(socialId, 0) + 1
+            if socialId in self.blocked_by_id:
+                return
+        finally:
+            self.relations_lock.release()
+
+        self._queryRelations(socialId)
+
+    # Queries relations which are referenced but failed to load.
+    def reloadRelations(self, client):
+        socialId = client.login_details.persisted_unique_id
+
+        self.relations_lock.acquire()
+        try:
+            if socialId not in self.relation_references or socialId in self.blocked_by_id:
+                return
+        finally:
+            self.relations_lock.release()
+
+        self._queryRelations(socialId)
+
+    def areRelationsLoaded(self, client):
+        return client.login_details.persisted_unique_id in self.blocked_by_id
+
+    def _queryRelations(self, socialId):
+        blocked = dict()
+        blockers = dict()
+        try:
+            self.write_behind.flushPending(self.block_collection.name)
+            query = {"$or": [{"blockerSocialId": socialId}, {"blockedSocialId": socialId}]}
+            for item in self.block_collection.find(query, {"_id": 0, "blockerSocialId": 1, "blockedSocialId": 1, "date": 1}):
+                expiry = self._getExpiry(item.get("date"))
+                if item["blockerSocialId"] == socialId:
+                    blocked[item["blockedSocialId"]] = expiry
+                if item["blockedSocialId"] == socialId:
+                    blockers[item["blockerSocialId"]] = expiry
+        except Exception as e:
+            raise ValueError(e)
+
+        self.relations_lock.acquire()
+        try:
+            # Could have been unloaded while we were querying.
+            if socialId in self.relation_references:
+                blocked.update(self.pending_blocked_by_id.pop(socialId, {}))
+                blockers.update(self.pending_blockers_by_id.pop(socialId, {}))
+                self.blocked_by_id[socialId] = blocked
+                self.blockers_by_id[socialId] = blockers
+        finally:
+            self.relations_lock.release()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Loaded [%d] blocked and [%d] blocker relations for social ID [%s]" % (len(blocked), len(blockers), socialId))
+
+    def unloadRelations(self, client):
+        socialId = client.login_details.persisted_unique_id
+
+        self.relations_lock.acquire()
+        try:
+            references = self.relation_references.get(socialId, 0) - 1
+            if references > 0:
+                self.relation_references[socialId] = references
+                return
+
+            self.relation_references.pop(socialId, None)
+            self.blocked_by_id.pop(socialId, None)
+            self.blockers_by_id.pop(socialId, None)
+            self.pending_blocked_by_id.pop(socialId, None)
+            self.pending_blockers_by_id.pop(socialId, None)
+        finally:
+            self.relations_lock.release()
+
+    @staticmethod
+    def _hasRelation(relations, socialId, now):
+        if socialId not in relations:
+            return False
+
+        expiry = relations[socialId]
+        if expiry is not None and expiry <= now:
+            del relations[socialId]
+            return False
+
+        return True
+
+    # Returns None if neither client's relations are loaded.
+    def _canMatchCached(self, clientSocialIdA, clientSocialIdB, checkBothSides):
+        now = datetime.utcnow()
+
+        self.relations_lock.acquire()
+        try:
+            blocked = self.blocked_by_id.get(clientSocialIdA)
+            if blocked is not None:
+                if Blocking._hasRelation(blocked, clientSocialIdB, now):
+                    return False
+
+                return not checkBothSides or not Blocking._hasRelation(self.blockers_by_id[clientSocialIdA], clientSocialIdB, now)
+
+            blockers = self.blockers_by_id.get(clientSocialIdB)
+            if blockers is not None:
+                if Blocking._hasRelation(blockers, clientSocialIdA, now):
+                    return False
+
+                return not checkBothSides or not Blocking._hasRelation(self.blocked_by_id[clientSocialIdB], clientSocialIdA, now)
+
+            return None
+        finally:
+            self.relations_lock.release()
+
+    # Returns the subset of social IDs which the client blocked or which blocked the client, using one query.
+    def findBlocked(self, client, candidateSocialIds):
+        socialId = client.login_details.persisted_unique_id
+        candidateSocialIds = list(candidateSocialIds)
+        if len(candidateSocialIds) == 0:
+            return set()
+
+        now = datetime.utcnow()
+        self.relations_lock.acquire()
+        try:
+            blocked = self.blocked_by_id.get(socialId)
+            if blocked is not None:
+                blockers = self.blockers_by_id[socialId]
+                return set(candidateSocialId for candidateSocialId in candidateSocialIds
+                           if Blocking._hasRelation(blocked, candidateSocialId, now) or Blocking._hasRelation(blockers, candidateSocialId, now))
+        finally:
+            self.relations_lock.release()
+
+        # Blocks are journaled by blocker.
+        self.write_behind.flushPending(self.block_collection.name, [socialId] + candidateSocialIds)
+
+        query = {"$or": [{"blockerSocialId": socialId, "blockedSocialId": {"$in": candidateSocialIds}},
+                         {"blockedSocialId": socialId, "blockerSocialId": {"$in": candidateSocialIds}}]}
+
+        result = set()
+        try:
+            for item in self.block_collection.find(query, {"_id": 0, "blockerSocialId": 1, "blockedSocialId": 1}):
+                if item["blockerSocialId"] == socialId:
+                    result.add(item["blockedSocialId"])
+                if item["blockedSocialId"] == socialId:
+                    result.add(item["blockerSocialId"])
+        except Exception as e:
+            raise ValueError(e)
+
+        return result
+
+    # As canMatch, using loaded relations only so that it never queries the database, see loadRelations.
+    # Clients can't match until the relations of either of them have been loaded.
+    def canMatchLoaded(self, clientA, clientB, checkBothSides=True):
+        result = self._canMatchCached(clientA.login_details.persisted_unique_id, clientB.login_details.persisted_unique_id, checkBothSides)
+        return result is True
+
     # find a match which is fit enough for the specified client.
     def canMatch(self, clientA, clientB, checkBothSides=True):
         #assert isinstance(clientA, Client)
@@ -19,6 +207,10 @@ class Blocking(object):
         clientSocialIdA = clientA.login_details.persisted_unique_id
         clientSocialIdB = clientB.login_details.persisted_unique_id
 
+        result = self._canMatchCached(clientSocialIdA, clientSocialIdB, checkBothSides)
+        if result is not None:
+            return result
+
         queryA = { "blockerSocialId" : clientSocialIdA,
                    "blockedSocialId" : clientSocialIdB }
 
@@ -26,6 +218,8 @@ class Blocking(object):
                   "blockedSocialId": clientSocialIdA}
 
         try:
+            self.write_behind.flushPending(self.block_collection.name, [clientSocialIdA, clientSocialIdB])
+
             item = self.block_collection.find_one(queryA)
             if item is not None:
                 return False
@@ -49,31 +243,43 @@ class Blocking(object):
         blockerSocialId = blockerClient.login_details.persisted_unique_id
         blockedSocialId = blockedClient.login_details.persisted_unique_id
 
-        self.block_collection.create_index([("blockerSocialId", pymongo.ASCENDING),
-                                            ("blockedSocialId", pymongo.ASCENDING)])
-
+        # Indexes are declared in database.schema.
         recordToInsert = {"blockerSocialId" : blockerSocialId,
                           "blockedSocialId" : blockedSocialId}
 
-
         if self.expiry_time_seconds is not None:
-            attempts = 0
-            while attempts < 2:
-                try:
-                    attempts += 1
-                    self.block_collection.create_index([("date", pymongo.ASCENDING)],
-                                                       expireAfterSeconds=self.expiry_time_seconds)
-                    break
-                except pymongo.errors.OperationFailure as e:
-                    logger.warn("Pymongo error: %s, dropping date index on blocking collection" % e)
-                    self.block_collection.drop_index([("date", pymongo.ASCENDING)])
-
             utcNow = datetime.utcnow()
             recordToInsert.update({"date": utcNow})
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Writing block record with expiration time of [%s] to DB for social ID: [%s] and [%s]" % (self.expiry_time_seconds, blockerSocialId, blockedSocialId))
-        self.block_collection.insert_one(recordToInsert)
+        self.write_behind.push(self.block_collection.name, blockerSocialId, Operation.INSERT_ONE, recordToInsert)
+        self._cacheBlock(blockerSocialId, blockedSocialId, recordToInsert.get("date"))
+
+    # Updates loaded relations only, so that they are current before the block has been written to the database.
+    def cacheBlock(self, blockerClient, blockedClient):
+        if blockerClient is None or blockedClient is None:
+            return
+
+        self._cacheBlock(blockerClient.login_details.persisted_unique_id, blockedClient.login_details.persisted_unique_id, datetime.utcnow())
+
+    def _cacheBlock(self, blockerSocialId, blockedSocialId, date):
+        expiry = self._getExpiry(date)
+        self.relations_lock.acquire()
+        try:
+            blocked = self.blocked_by_id.get(blockerSocialId)
+            if blocked is not None:
+                blocked[blockedSocialId] = expiry
+            elif blockerSocialId in self.relation_references:
+                self.pending_blocked_by_id.setdefault(blockerSocialId, dict())[blockedSocialId] = expiry
+
+            blockers = self.blockers_by_id.get(blockedSocialId)
+            if blockers is not None:
+                blockers[blockerSocialId] = expiry
+            elif blockedSocialId in self.relation_references:
+                self.pending_blockers_by_id.setdefault(blockedSocialId, dict())[blockerSocialId] = expiry
+        finally:
+            self.relations_lock.release()
 
     def listItems(self):
         for item in self.block_collection.find():
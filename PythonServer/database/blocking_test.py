@@ -52,4 +52,25 @@ if __name__ == '__main__':
             print "ERROR: Not blocked client returning canMatch = false (8)"
 
         if not db.canMatch(clientB, clientA):
-            print "ERROR: Not blocked client returning canMatch = false (9)"
\ No newline at end of file
+            print "ERROR: Not blocked client returning canMatch = false (9)"
+
+    # Same checks answered from loaded relations, without querying the database.
+    for client in clientsListA:
+        db.loadRelations(client)
+
+    for clientA, clientB in zip(clientsListA, clientsListB):
+        if db.canMatch(clientA, clientB) or db.canMatch(clientB, clientA):
+            print "ERROR: Blocked client returning canMatch = true (10)"
+
+        if not db.canMatch(clientA, Client.buildDummy()):
+            print "ERROR: Not blocked client returning canMatch = false (11)"
+
+    for clientA, clientB in zip(clientsListA, reversed(clientsListB)):
+        if not db.canMatch(clientA, clientB) or not db.canMatch(clientB, clientA):
+            print "ERROR: Not blocked client returning canMatch = false (12)"
+
+    for client in clientsListA:
+        db.unloadRelations(client)
+
+    if len(db.blocked_by_id) != 0 or len(db.relation_references) != 0:
+        print "ERROR: Relations not unloaded (13)"
@@ -2,19 +2,26 @@ import logging
 import pymongo
 import pymongo.errors
 from datetime import datetime
+from database.write_behind import DirectWrites, Operation
 logger = logging.getLogger(__name__)
 
 class Karma(object):
-    def __init__(self, mongoCollection, expiryTimeSeconds, shouldLinkTimes = False):
+    def __init__(self, mongoCollection, expiryTimeSeconds, shouldLinkTimes = False, writeBehind = None):
         self.karma_collection = mongoCollection
         self.expiry_time_seconds = expiryTimeSeconds
         self.should_link_times = shouldLinkTimes
 
+        if writeBehind is None:
+            writeBehind = DirectWrites(mongoCollection.database)
+        self.write_behind = writeBehind
+
     # find a match which is fit enough for the specified client.
     def getKarmaDeduction(self, client):
         #assert isinstance(client, Client)
 
         clientSocialId = client.login_details.persisted_unique_id
+        self.write_behind.flushPending(self.karma_collection.name, [clientSocialId])
+
         query = { "socialId" : clientSocialId }
         try:
             item = self.karma_collection.find(query)
@@ -29,6 +36,8 @@ class Karma(object):
         # assert isinstance(client, Client)
 
         clientSocialId = client.login_details.persisted_unique_id
+        self.write_behind.flushPending(self.karma_collection.name, [clientSocialId])
+
         query = {"socialId": clientSocialId}
         try:
             cursor = self.karma_collection.find(query, sort=[("date", pymongo.ASCENDING)])
@@ -63,18 +72,7 @@ class Karma(object):
 
         clientSocialId = client.login_details.persisted_unique_id
 
-        self.karma_collection.create_index([("socialId", pymongo.ASCENDING),("date", pymongo.ASCENDING)])
-
-        attempts= 0
-        while attempts < 2:
-            try:
-                attempts += 1
-                self.karma_collection.create_index([("date", pymongo.ASCENDING)], expireAfterSeconds=self.expiry_time_seconds)
-                break
-            except pymongo.errors.OperationFailure as e:
-                logger.warn("Pymongo error: %s, dropping date index on karma collection" % e)
-                self.karma_collection.drop_index([("date", pymongo.ASCENDING)])
-
+        # Indexes are declared in database.schema.
         utcNow = datetime.utcnow()
 
         recordToInsert = {"socialId" : clientSocialId,
@@ -82,11 +80,11 @@ class Karma(object):
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Writing karma deduction to database for Social ID: [%s]" % (clientSocialId))
-        self.karma_collection.insert_one(recordToInsert)
+        self.write_behind.push(self.karma_collection.name, clientSocialId, Operation.INSERT_ONE, recordToInsert)
 
         # If we want all records to have the latest timestamp.
         if self.should_link_times:
-            self.karma_collection.update({"socialId" : clientSocialId}, {'$set' : {"date": utcNow}}, multi=True)
+            self.write_behind.push(self.karma_collection.name, clientSocialId, Operation.UPDATE_MANY, {"socialId" : clientSocialId}, {'$set' : {"date": utcNow}})
 
     def clearKarma(self, client):
         if client is None:
@@ -95,7 +93,7 @@ class Karma(object):
         #assert isinstance(client, Client)
         clientSocialId = client.login_details.persisted_unique_id
 
-        self.karma_collection.remove({"socialId" : clientSocialId})
+        self.write_behind.push(self.karma_collection.name, clientSocialId, Operation.DELETE_MANY, {"socialId" : clientSocialId})
 
     def incrementKarma(self, client):
         if client is None:
@@ -106,6 +104,9 @@ class Karma(object):
 
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Incrementing karma for Social ID: %s" % clientSocialId)
+
+        # Removes the oldest deduction, so has to be made after any deductions which are pending.
+        self.write_behind.flushPending(self.karma_collection.name, [clientSocialId])
         record = self.karma_collection.find_one_and_delete({"socialId": clientSocialId}, sort=[("date", pymongo.ASCENDING)])
         if record is None:
             if logger.isEnabledFor(logging.DEBUG):
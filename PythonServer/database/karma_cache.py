@@ -0,0 +1,139 @@
+import logging
+import unittest
+from datetime import datetime, timedelta
+from threading import Lock
+from special_collections import LruCache
+from stat_tracker import PeriodMetrics
+
+logger = logging.getLogger(__name__)
+
+# Karma ledger records of recently seen persisted IDs, so that logons, ratings, ban audits and offline candidates
+# don't need to read the ledger each time. Writes made by this governor are applied to cached records as well as
+# to the database, see KarmaLedger.
+#
+# Other governors may change records too, so records are read again after at most MAX_AGE_SECONDS, and
+# sooner if a ban ends before then.
+class KarmaCache(object):
+    MAX_SIZE = 10000
+    MAX_AGE_SECONDS = 5 * 60
+
+    def __init__(self, maxSize=MAX_SIZE, maxAgeSeconds=MAX_AGE_SECONDS):
+        super(KarmaCache, self).__init__()
+
+        # Persisted ID -> (record, date after which the record must be read again, date of the last write through).
+        #
+        # Records written while not cached are held as None, so that a read which started before the write
+        # doesn't cache the record as it was.
+        self.records = LruCache(maxSize)
+        self.max_age = timedelta(seconds=maxAgeSeconds)
+        self.lock = Lock()
+
+        self.period_metrics = PeriodMetrics('hits', 'misses')
+
+    # Returns None if the record is not cached, or has expired.
+    def get(self, socialId, utcNow):
+        self.lock.acquire()
+        try:
+            entry = self.records.get(socialId)
+            if entry is not None and entry[1] <= utcNow:
+                self.records.discard(socialId)
+                entry = None
+
+            if entry is None or entry[0] is None:
+                self.period_metrics.misses += 1
+                return None
+
+            self.period_metrics.hits += 1
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    # Records must not be modified once cached, update replaces them instead.
+    #
+    # utcNow is when the record was read from the database.
+    def put(self, socialId, record, utcNow, validUntil=None):
+        expiry = utcNow + self.max_age
+        if validUntil is not None and validUntil < expiry:
+            expiry = validUntil
+
+        self.lock.acquire()
+        try:
+            # Written since we read it.
+            entry = self.records.get(socialId)
+            if entry is not None and entry[2] is not None and entry[2] >= utcNow:
+                return
+
+            self.records.put(socialId, (record, expiry, None))
+        finally:
+            self.lock.release()
+
+    # If the record is cached, replaces it with updateFunc(record), which returns (new record, valid until).
+    # Otherwise it is left to be read from the database.
+    def update(self, socialId, updateFunc, utcNow):
+        self.lock.acquire()
+        try:
+            entry = self.records.get(socialId)
+            if entry is None or entry[0] is None or entry[1] <= utcNow:
+                self.records.put(socialId, (None, utcNow + self.max_age, utcNow))
+                return
+
+            record, validUntil = updateFunc(entry[0])
+            expiry = entry[1]
+            if validUntil is not None and validUntil < expiry:
+                expiry = validUntil
+
+            self.records.put(socialId, (record, expiry, utcNow))
+        finally:
+            self.lock.release()
+
+    def discard(self, socialId):
+        self.lock.acquire()
+        try:
+            self.records.discard(socialId)
+        finally:
+            self.lock.release()
+
+    def reportMetrics(self):
+        period = self.period_metrics.take()
+        hitCount = period['hits']
+        missCount = period['misses']
+        hitRate = PeriodMetrics.getAverage(hitCount, hitCount + missCount) * 100.0
+
+        logger.info("Karma cache, records: [%d], hits: [%d], misses: [%d], hit rate: [%.1f%%]" % (len(self.records), hitCount, missCount, hitRate))
+
+
+class KarmaCacheTest(unittest.TestCase):
+    def testExpiry(self):
+        cache = KarmaCache(maxAgeSeconds=60)
+        utcNow = datetime(2016, 1, 1)
+
+        cache.put('a', {'deductions': []}, utcNow)
+        cache.put('b', {'deductions': []}, utcNow, validUntil=utcNow + timedelta(seconds=10))
+
+        self.assertEquals(cache.get('a', utcNow + timedelta(seconds=59)), {'deductions': []})
+        self.assertEquals(cache.get('b', utcNow + timedelta(seconds=9)), {'deductions': []})
+        self.assertIsNone(cache.get('b', utcNow + timedelta(seconds=10)))
+        self.assertIsNone(cache.get('a', utcNow + timedelta(seconds=60)))
+        self.assertIsNone(cache.get('c', utcNow))
+        self.assertEquals(len(cache.records), 0)
+
+    def testUpdate(self):
+        cache = KarmaCache(maxAgeSeconds=60)
+        utcNow = datetime(2016, 1, 1)
+
+        # Records which are not cached are left to be read from the database.
+        cache.update('a', lambda record: ({'deductions': [utcNow]}, None), utcNow)
+        self.assertIsNone(cache.get('a', utcNow))
+
+        # Read before the write, so could be missing it.
+        cache.put('a', {'deductions': []}, utcNow - timedelta(seconds=1))
+        self.assertIsNone(cache.get('a', utcNow))
+
+        cache.put('a', {'deductions': []}, utcNow + timedelta(seconds=1))
+        self.assertEquals(cache.get('a', utcNow), {'deductions': []})
+        cache.update('a', lambda record: ({'deductions': record['deductions'] + [utcNow]}, None), utcNow)
+        self.assertEquals(cache.get('a', utcNow), {'deductions': [utcNow]})
+
+        # Can only bring expiry forwards.
+        cache.update('a', lambda record: (record, utcNow + timedelta(seconds=5)), utcNow)
+        self.assertIsNone(cache.get('a', utcNow + timedelta(seconds=5)))
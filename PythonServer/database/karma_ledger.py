@@ -0,0 +1,301 @@
+import logging
+from datetime import datetime, timedelta
+from database.karma_leveled import KarmaLeveled
+from database.write_behind import DirectWrites, Operation
+from database.karma_cache import KarmaCache
+
+logger = logging.getLogger(__name__)
+
+# Karma and bans of each persisted ID held in a single record, so that reading them takes one query and
+# each change one atomic update. Replaces the per deduction records of KarmaLeveled, see
+# database/scripts/migrate_karma_ledger.py, with the same rules:
+#
+# - Each karma deduction expires after a day, karma is the maximum less the deductions.
+# - When karma runs out, the client is banned at every level and deductions are cleared.
+# - Bans at level n expire n days after the most recent ban, the client is banned for level n
+#   if at least n bans were made at that level.
+#
+# {'_id': persisted ID,
+#  'deductions': [date of each karma deduction, oldest first],
+#  'ban_<level>': {'count': bans at this level, 'date': date of the most recent ban},
+#  'date': date of the most recent deduction or ban, for TTL removal}
+class KarmaLedger(object):
+    KARMA_BASE_EXPIRY_TIME_SECONDS = KarmaLeveled.KARMA_BASE_EXPIRY_TIME_SECONDS
+    MAX_EXPONENTIAL_INCREASES = KarmaLeveled.MAX_EXPONENTIAL_INCREASES
+    KARMA_MAXIMUM = KarmaLeveled.KARMA_MAXIMUM
+
+    # Everything in a record has expired by the time the longest ban would have.
+    EXPIRATION_TIME_SECONDS = KARMA_BASE_EXPIRY_TIME_SECONDS * MAX_EXPONENTIAL_INCREASES
+
+    def __init__(self, mongoClient, writeBehind=None, karmaCache=None):
+        self.ledger_collection = mongoClient.db.karma_ledger
+
+        if writeBehind is None:
+            writeBehind = DirectWrites(mongoClient.db)
+        self.write_behind = writeBehind
+
+        if karmaCache is not None:
+            assert isinstance(karmaCache, KarmaCache)
+        self.karma_cache = karmaCache
+
+    @staticmethod
+    def getBanField(level):
+        return "ban_%d" % level
+
+    @staticmethod
+    def getBanExpiryTimeSeconds(level):
+        return KarmaLedger.KARMA_BASE_EXPIRY_TIME_SECONDS * level
+
+    @staticmethod
+    def getKarmaOfRecord(record, utcNow):
+        oldestValidDeduction = utcNow - timedelta(seconds=KarmaLedger.KARMA_BASE_EXPIRY_TIME_SECONDS)
+        deductions = len([date for date in record.get('deductions', []) if date > oldestValidDeduction])
+
+        karma = KarmaLedger.KARMA_MAXIMUM - deductions
+        if karma < 0:
+            karma = 0
+        return karma
+
+    # Returns (ban magnitude, seconds until the ban expires), or (None, None) if not banned.
+    @staticmethod
+    def getBanOfRecord(record, utcNow):
+        for level in range(KarmaLedger.MAX_EXPONENTIAL_INCREASES, 0, -1):
+            ban = record.get(KarmaLedger.getBanField(level))
+            if ban is None or ban['count'] < level:
+                continue
+
+            expirationTime = KarmaLedger.getBanExpiryTimeSeconds(level) - (utcNow - ban['date']).total_seconds()
+            if expirationTime > 0:
+                return level, int(expirationTime)
+
+        return None, None
+
+    # Cached records are read again once the ban they hold ends.
+    @staticmethod
+    def getValidUntil(record, utcNow):
+        banMagnitude, banTime = KarmaLedger.getBanOfRecord(record, utcNow)
+        if banTime is None:
+            return None
+
+        return utcNow + timedelta(seconds=banTime)
+
+    # The following return records as they will be once the corresponding update has been applied,
+    # so that cached records stay up to date.
+    @staticmethod
+    def applyDeduction(record, utcNow):
+        result = dict(record)
+        result['deductions'] = (record.get('deductions', []) + [utcNow])[-KarmaLedger.KARMA_MAXIMUM:]
+        result['date'] = utcNow
+        return result
+
+    @staticmethod
+    def applyBan(record, utcNow):
+        result = dict(record)
+        for level in range(KarmaLedger.MAX_EXPONENTIAL_INCREASES, 0, -1):
+            banField = KarmaLedger.getBanField(level)
+            ban = record.get(banField)
+
+            count = 0
+            if ban is not None and (utcNow - ban['date']).total_seconds() < KarmaLedger.getBanExpiryTimeSeconds(level):
+                count = ban['count']
+
+            result[banField] = {'count': count + 1, 'date': utcNow}
+
+        result['deductions'] = []
+        result['date'] = utcNow
+        return result
+
+    @staticmethod
+    def applyClear(record):
+        result = dict(record)
+        for level in range(KarmaLedger.MAX_EXPONENTIAL_INCREASES, 0, -1):
+            banField = KarmaLedger.getBanField(level)
+            ban = record.get(banField)
+            if ban is not None:
+                result[banField] = {'count': min(ban['count'], level - 1), 'date': ban['date']}
+
+        result['deductions'] = []
+        return result
+
+    @staticmethod
+    def applyIncrement(record):
+        result = dict(record)
+        result['deductions'] = record.get('deductions', [])[1:]
+        return result
+
+    def _updateCache(self, clientSocialId, applyFunc):
+        if self.karma_cache is None:
+            return
+
+        utcNow = datetime.utcnow()
+        def updateFunc(record):
+            result = applyFunc(record)
+            return result, KarmaLedger.getValidUntil(result, utcNow)
+
+        self.karma_cache.update(clientSocialId, updateFunc, utcNow)
+
+    def _cacheRecord(self, clientSocialId, record, utcNow):
+        if self.karma_cache is not None:
+            self.karma_cache.put(clientSocialId, record, utcNow, KarmaLedger.getValidUntil(record, utcNow))
+
+    def _getCachedRecord(self, clientSocialId, utcNow):
+        if self.karma_cache is None:
+            return None
+
+        return self.karma_cache.get(clientSocialId, utcNow)
+
+    def _getRecord(self, client):
+        return self._getRecordOfId(client.login_details.persisted_unique_id)
+
+    def _getRecordOfId(self, clientSocialId):
+        utcNow = datetime.utcnow()
+
+        record = self._getCachedRecord(clientSocialId, utcNow)
+        if record is not None:
+            return record
+
+        self.write_behind.flushPending(self.ledger_collection.name, [clientSocialId])
+
+        try:
+            record = self.ledger_collection.find_one({'_id': clientSocialId})
+        except Exception as e:
+            raise ValueError(e)
+
+        if record is None:
+            record = dict()
+
+        self._cacheRecord(clientSocialId, record, utcNow)
+        return record
+
+    # Returns (karma, ban magnitude, seconds until the ban expires), using one query.
+    def getKarmaAndBan(self, client):
+        return self.getKarmaAndBanOfId(client.login_details.persisted_unique_id)
+
+    # As getKarmaAndBan, for use before the client has logged in.
+    def getKarmaAndBanOfId(self, clientSocialId):
+        record = self._getRecordOfId(clientSocialId)
+        utcNow = datetime.utcnow()
+        banMagnitude, banTime = KarmaLedger.getBanOfRecord(record, utcNow)
+        return KarmaLedger.getKarmaOfRecord(record, utcNow), banMagnitude, banTime
+
+    # Returns persisted ID -> (karma, ban magnitude, seconds until the ban expires) of all the clients, using one query.
+    def getKarmaAndBanOfClients(self, clients):
+        clientSocialIds = [client.login_details.persisted_unique_id for client in clients]
+        utcNow = datetime.utcnow()
+
+        recordsById = dict()
+        for clientSocialId in clientSocialIds:
+            record = self._getCachedRecord(clientSocialId, utcNow)
+            if record is not None:
+                recordsById[clientSocialId] = record
+
+        uncachedSocialIds = [clientSocialId for clientSocialId in clientSocialIds if clientSocialId not in recordsById]
+        if len(uncachedSocialIds) > 0:
+            self.write_behind.flushPending(self.ledger_collection.name, uncachedSocialIds)
+
+            try:
+                for record in self.ledger_collection.find({'_id': {'$in': uncachedSocialIds}}):
+                    recordsById[record['_id']] = record
+            except Exception as e:
+                raise ValueError(e)
+
+            for clientSocialId in uncachedSocialIds:
+                self._cacheRecord(clientSocialId, recordsById.setdefault(clientSocialId, dict()), utcNow)
+
+        result = dict()
+        for clientSocialId in clientSocialIds:
+            record = recordsById[clientSocialId]
+            banMagnitude, banTime = KarmaLedger.getBanOfRecord(record, utcNow)
+            result[clientSocialId] = (KarmaLedger.getKarmaOfRecord(record, utcNow), banMagnitude, banTime)
+
+        return result
+
+    def getKarma(self, client):
+        return KarmaLedger.getKarmaOfRecord(self._getRecord(client), datetime.utcnow())
+
+    def getBanMagnitudeAndExpirationTime(self, client):
+        return KarmaLedger.getBanOfRecord(self._getRecord(client), datetime.utcnow())
+
+    # Return true if client has been banned.
+    def deductKarma(self, client, karmaOverride=None):
+        if client is None:
+            return False
+
+        if karmaOverride is None:
+            currentKarma = self.getKarma(client)
+        else:
+            currentKarma = karmaOverride
+
+        if currentKarma < 0:
+            return False
+
+        clientSocialId = client.login_details.persisted_unique_id
+        utcNow = datetime.utcnow()
+        if currentKarma > 0:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Writing karma deduction to database for Social ID: [%s]" % clientSocialId)
+
+            # Deductions beyond the maximum make no difference, so the list is capped.
+            self.write_behind.push(self.ledger_collection.name, clientSocialId, Operation.UPDATE_ONE,
+                                   {'_id': clientSocialId},
+                                   {'$push': {'deductions': {'$each': [utcNow], '$slice': -KarmaLedger.KARMA_MAXIMUM}},
+                                    '$set': {'date': utcNow}},
+                                   True)
+            self._updateCache(clientSocialId, lambda record: KarmaLedger.applyDeduction(record, utcNow))
+            return False
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Writing ban to database for Social ID: [%s]" % clientSocialId)
+
+        # Bans which have expired start counting again.
+        banUpdate = {'deductions': [], 'date': utcNow}
+        banIncrement = dict()
+        for level in range(KarmaLedger.MAX_EXPONENTIAL_INCREASES, 0, -1):
+            banField = KarmaLedger.getBanField(level)
+            expiredDate = utcNow - timedelta(seconds=KarmaLedger.getBanExpiryTimeSeconds(level))
+            self.write_behind.push(self.ledger_collection.name, clientSocialId, Operation.UPDATE_ONE,
+                                   {'_id': clientSocialId, banField + '.date': {'$lte': expiredDate}},
+                                   {'$unset': {banField: ''}})
+
+            banUpdate[banField + '.date'] = utcNow
+            banIncrement[banField + '.count'] = 1
+
+        # Karma is cleared, the ban may otherwise expire a bit before the deductions.
+        self.write_behind.push(self.ledger_collection.name, clientSocialId, Operation.UPDATE_ONE,
+                               {'_id': clientSocialId}, {'$set': banUpdate, '$inc': banIncrement}, True)
+        self._updateCache(clientSocialId, lambda record: KarmaLedger.applyBan(record, utcNow))
+        return True
+
+    # Does not wipe the entire ban list, but clears the current ban, such
+    # that on next ban time to wait and price increases.
+    def clearKarma(self, client):
+        if client is None:
+            return
+
+        clientSocialId = client.login_details.persisted_unique_id
+
+        # Every level is left one ban short of banning.
+        banLimits = dict((KarmaLedger.getBanField(level) + '.count', level - 1) for level in range(1, KarmaLedger.MAX_EXPONENTIAL_INCREASES + 1))
+        self.write_behind.push(self.ledger_collection.name, clientSocialId, Operation.UPDATE_ONE,
+                               {'_id': clientSocialId}, {'$set': {'deductions': []}, '$min': banLimits})
+        self._updateCache(clientSocialId, KarmaLedger.applyClear)
+
+    def incrementKarma(self, client):
+        if client is None:
+            return
+
+        clientSocialId = client.login_details.persisted_unique_id
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Incrementing karma for Social ID: %s" % clientSocialId)
+
+        # Removes the oldest deduction.
+        self.write_behind.push(self.ledger_collection.name, clientSocialId, Operation.UPDATE_ONE,
+                               {'_id': clientSocialId}, {'$pop': {'deductions': -1}})
+        self._updateCache(clientSocialId, KarmaLedger.applyIncrement)
+
+    def listItems(self):
+        for item in self.ledger_collection.find():
+            print item
+
+    def dropCollections(self):
+        self.ledger_collection.drop()
@@ -2,6 +2,8 @@ import logging
 logger = logging.getLogger(__name__)
 from database.karma import Karma
 
+# Karma deductions and bans as one record per deduction, across a karma collection and a collection per ban level.
+# Superseded by KarmaLedger, kept to migrate existing records, see database/scripts/migrate_karma_ledger.py.
 class KarmaLeveled(object):
     # 1 day.
     #
@@ -22,16 +24,26 @@ class KarmaLeveled(object):
     # Adjust this as user base increases.
     KARMA_MAXIMUM = 4
 
-    def __init__(self, mongoClient):
-        self.karma = Karma(mongoClient.db.karma, KarmaLeveled.KARMA_BASE_EXPIRY_TIME_SECONDS, shouldLinkTimes=False)
+    # Returns (collection name, expiration time) of the karma collection, then of the ban
+    # collections, most severe ban first.
+    @staticmethod
+    def getCollectionExpiryTimes():
+        result = [("karma", KarmaLeveled.KARMA_BASE_EXPIRY_TIME_SECONDS)]
+        for n in range(KarmaLeveled.MAX_EXPONENTIAL_INCREASES, 0, -1):
+            result.append(("ban_%d" % n, KarmaLeveled.KARMA_BASE_EXPIRY_TIME_SECONDS * n))
+        return result
+
+    def __init__(self, mongoClient, writeBehind=None):
+        collectionExpiryTimes = KarmaLeveled.getCollectionExpiryTimes()
+
+        collectionName, expirationTime = collectionExpiryTimes[0]
+        self.karma = Karma(getattr(mongoClient.db, collectionName), expirationTime, shouldLinkTimes=False, writeBehind=writeBehind)
 
         # Most severe ban is first in the list (element 0).
         self.bans = []
-        for n in range(KarmaLeveled.MAX_EXPONENTIAL_INCREASES, 0, -1):
-            expirationTime = KarmaLeveled.KARMA_BASE_EXPIRY_TIME_SECONDS * n
-            collectionName = "ban_%d" % n
+        for collectionName, expirationTime in collectionExpiryTimes[1:]:
             logger.info("MongoDB collection [%s] has expiration of %d seconds" % (collectionName, expirationTime))
-            self.bans.append(Karma(getattr(mongoClient.db,collectionName), expiryTimeSeconds=expirationTime, shouldLinkTimes=True))
+            self.bans.append(Karma(getattr(mongoClient.db,collectionName), expiryTimeSeconds=expirationTime, shouldLinkTimes=True, writeBehind=writeBehind))
 
     def listItems(self):
         print "Karma: "
@@ -1,3 +1,4 @@
+import itertools
 import logging
 import pymongo
 import time
@@ -12,24 +13,37 @@ import pickle
 from bson.binary import Binary
 import struct
 from blocking import Blocking
+from profile_pictures import ProfilePictures
 from datetime import datetime
+from write_behind import DirectWrites, Operation
 
 logger = logging.getLogger(__name__)
 
 class Matching(object):
-    # We will search through 1000 people that match search criteria such as gender, both online and offline
-    # until we give up on finding an online match (since e.g. we've been blocked or skipped by everybody).
-    #
-    # Then we will we will use the first offline person we found earlier, or will continue searching, but take
-    # the first online or offline person we find.
-    PRIORITISE_ONLINE_UP_TO = 1000
+    # We will search through up to 1000 offline people that match search criteria such as gender,
+    # until we give up (since e.g. we've been blocked or skipped by everybody).
+    MAX_CANDIDATES_EXAMINED = 1000
+
+    # Candidates are read, and filtered by block and skip relations, this many at a time.
+    PAGE_SIZE = 100
+
+    # Fields needed to decide whether a candidate is suitable, the rest of the profile (mostly
+    # the profile picture) is only loaded for the candidate which is picked.
+    CANDIDATE_PROJECTION = {'_id': 1, 'unique_id': 1, 'persisted_unique_id': 1, 'should_notify': 1,
+                            'location': 1, 'gender': 1, 'gender_wanted': 1, 'age': 1}
+
+    PROFILE_PROJECTION = {'name': 1, 'short_name': 1, 'card_text': 1, 'profile_picture_hash': 1, 'profile_picture': 1,
+                          'profile_picture_orientation': 1, 'remote_notification_payload': 1}
 
     # Expire matches after 1 week.
     # Technically this impacts online clients too, but unlikely a client will be online for an entire week.
     # This is aimed at getting rid of offline clients which are unfavourable i.e. noone accepts.
     EXPIRATION_TIME_SECONDS = 7 * 24 * 60 * 60
 
-    def __init__(self, serverName, mongoClient, blockingDatabase, matchHistoryDatabase):
+    # Clients which have been matched before are not rematched for an hour.
+    MATCH_HISTORY_EXPIRATION_TIME_SECONDS = 60 * 60
+
+    def __init__(self, serverName, mongoClient, blockingDatabase, matchHistoryDatabase, writeBehind=None):
         assert isinstance(blockingDatabase, Blocking)
         assert isinstance(matchHistoryDatabase, Blocking)
 
@@ -40,6 +54,12 @@ class Matching(object):
         self.blocking_database = blockingDatabase
         self.match_history_database = matchHistoryDatabase
 
+        self.profile_pictures = ProfilePictures(mongoClient)
+
+        if writeBehind is None:
+            writeBehind = DirectWrites(mongoClient.db)
+        self.write_behind = writeBehind
+
         logger.info("Expiring waiting matches after %d seconds" % Matching.EXPIRATION_TIME_SECONDS)
 
     def pushBlock(self, blockerClient, blockedClient):
@@ -48,26 +68,56 @@ class Matching(object):
     def pushSkip(self, skipperClient, skippedClient):
         self.match_history_database.pushBlock(skipperClient, skippedClient)
 
+    def cacheBlock(self, blockerClient, blockedClient):
+        self.blocking_database.cacheBlock(blockerClient, blockedClient)
+
+    def cacheSkip(self, skipperClient, skippedClient):
+        self.match_history_database.cacheBlock(skipperClient, skippedClient)
+
+    # Loaded relations only, so that matching never queries the database, clients whose relations
+    # are not loaded are treated as skipped and blocked.
     def didRecentlySkip(self, skipperClient, skippedClient):
-        return not self.match_history_database.canMatch(skipperClient, skippedClient)
+        return not self.match_history_database.canMatchLoaded(skipperClient, skippedClient)
 
     def didBlock(self, blockerClient, blockedClient, checkBothSides=True):
-        return not self.blocking_database.canMatch(blockerClient, blockedClient, checkBothSides=checkBothSides)
+        return not self.blocking_database.canMatchLoaded(blockerClient, blockedClient, checkBothSides=checkBothSides)
+
+    # Returns the subset of persisted IDs which the client blocked or recently skipped, or which did so to the client.
+    def findBlockedOrSkipped(self, client, persistedIds):
+        return self.blocking_database.findBlocked(client, persistedIds) | self.match_history_database.findBlocked(client, persistedIds)
+
+    # Block and skip relations of connected clients are held in memory, so that matching does not query the database.
+    #
+    # Both are referenced even if the first fails to load, so that unloadRelations is always balanced.
+    def loadRelations(self, client):
+        try:
+            self.blocking_database.loadRelations(client)
+        finally:
+            self.match_history_database.loadRelations(client)
+
+    def reloadRelations(self, client):
+        try:
+            self.blocking_database.reloadRelations(client)
+        finally:
+            self.match_history_database.reloadRelations(client)
+
+    def areRelationsLoaded(self, client):
+        return self.blocking_database.areRelationsLoaded(client) and self.match_history_database.areRelationsLoaded(client)
+
+    def unloadRelations(self, client):
+        self.blocking_database.unloadRelations(client)
+        self.match_history_database.unloadRelations(client)
 
     def removeMatch(self, client):
         assert isinstance(client, Client)
-        self.match_collection.remove({'_id': self.buildId(client.login_details)})
+        self.removeMatchById(self.buildId(client.login_details))
 
     def removeMatchById(self, theId):
-        self.match_collection.remove({'_id': theId})
-
-    # find a match which is fit enough for the specified client.
-    def findMatch(self, sourceClient, buildClientFromDatabaseResultFunc):
-        assert isinstance(sourceClient, Client)
-        loginDetails = sourceClient.login_details
-
-        # Note that age can be 0 here if user does not want to disclose via social. We should handle this case.
+        self.write_behind.push(self.match_collection.name, theId, Operation.DELETE_ONE, {'_id': theId})
 
+    # Returns (gender wanted, gender wanted values which are compatible with the client's gender).
+    @staticmethod
+    def getGenderCriteria(loginDetails):
         # Gender can be 0 here if user does not want to disclose via social. We handle this by saying that users
         # not specifying gender can match people looking for either male, female or who do not care. We do not
         # specify a specific gender.
@@ -82,6 +132,19 @@ class Matching(object):
             loginDetails.interested_in = 3
         genderWanted = loginDetails.interested_in
 
+        return genderWanted, matchWithGenderWanted
+
+    # Returns the records of up to maxCandidates offline clients, which want to be notified, and which are not
+    # blocked or recently skipped by the specified client, nearest first.
+    #
+    # Online clients are found in memory by the house. Only the candidate fields are loaded, see loadProfile.
+    def findOfflineCandidates(self, sourceClient, maxCandidates):
+        assert isinstance(sourceClient, Client)
+        loginDetails = sourceClient.login_details
+
+        # Note that age can be 0 here if user does not want to disclose via social. We should handle this case.
+        genderWanted, matchWithGenderWanted = Matching.getGenderCriteria(loginDetails)
+
         # If they don't care what gender they want, then don't include gender as part of the query.
         if genderWanted == 3:
             query = {}
@@ -89,6 +152,7 @@ class Matching(object):
             query = {'gender' : genderWanted}
 
         query.update({'server': self.server_name,
+                      'should_notify': True,
                       'gender_wanted' : {'$in' : matchWithGenderWanted},
                       # Age over complicates things for now, because we need age selection on GUI.
                       # If we get loads of users we can put this in.
@@ -106,93 +170,99 @@ class Matching(object):
                     })
 
         try:
-            cursor = self.match_collection.find(query)
+            self.write_behind.flushPending(self.match_collection.name)
+            cursor = self.match_collection.find(query, Matching.CANDIDATE_PROJECTION).batch_size(Matching.PAGE_SIZE)
         except Exception as e:
             raise ValueError(e)
 
-        bestOfflineClient = None
-        try:
-            while True:
-                for iteration in xrange(Matching.PRIORITISE_ONLINE_UP_TO):
-                    dbResult = cursor.next()
-                    client = buildClientFromDatabaseResultFunc(dbResult)
-                    if client is None:
-                        continue
-
-                    isOffline = client.isSynthesizedOfflineClient()
-                    if isOffline:
-                        if bestOfflineClient is None:
-                            bestOfflineClient = client
-                    else:
-                        return client
-
-                # When we reach this point, we are prepared to tolerate an offline client.
-                if bestOfflineClient is not None:
-                    return bestOfflineClient
-        except StopIteration:
-            # When we reach this point, we have iterated over all clients in the DB,
-            # and didn't find anyone online, and hadn't reached our toleration limit, such
-            # that we wouldn't accept an offline client yet. Since we've reached the end,
-            # return the best offline client that we found.
-            if bestOfflineClient is not None:
-                return bestOfflineClient
-
-        return None
+        candidates = []
+        iterations = 0
+        while len(candidates) < maxCandidates and iterations < Matching.MAX_CANDIDATES_EXAMINED:
+            page = list(itertools.islice(cursor, Matching.PAGE_SIZE))
+            if len(page) == 0:
+                break
+
+            # One query for the whole page, rather than a few per candidate.
+            excludedIds = self.findBlockedOrSkipped(sourceClient, [dbResult['_id'] for dbResult in page])
+
+            for dbResult in page:
+                iterations += 1
+                if dbResult['_id'] not in excludedIds:
+                    candidates.append(dbResult)
 
+        return candidates[:maxCandidates]
+
+    # Client can be synthesized from a candidate record, without the profile, or from a full record.
     def synthesizeClient(self, dataRecord, buildClientFunc):
         assert isinstance(dataRecord, dict)
 
         client = buildClientFunc()
 
-        profilePicture = ByteBuffer()
-        profilePictureString = dataRecord['profile_picture']
-        assert isinstance(profilePictureString, basestring)
-        profilePicture.buffer = bytearray(profilePictureString, encoding='latin1')
-        profilePicture.used_size = len(profilePicture.buffer)
-        profilePicture.memory_size = profilePicture.used_size
-
         client.login_details = Client.LoginDetails(str(dataRecord['unique_id']), str(dataRecord['persisted_unique_id']),
-                                                   str(dataRecord['name']), str(dataRecord['short_name']), dataRecord['age'],
+                                                   None, None, dataRecord['age'],
                                                    dataRecord['gender'], dataRecord['gender_wanted'], dataRecord['location'][0],
-                                                   dataRecord['location'][1], str(dataRecord['card_text']), profilePicture, dataRecord['profile_picture_orientation'])
-
-        client.remote_notification_payload = str(dataRecord['remote_notification_payload'])
+                                                   dataRecord['location'][1], None, None, None)
 
         client.should_notify_on_match_accept = True
         client.udp_hash = client.login_details.unique_id
 
+        if Matching._hasProfile(dataRecord):
+            self._applyProfile(client, dataRecord)
+
         return client
 
+    @staticmethod
+    def _hasProfile(dataRecord):
+        return 'profile_picture_hash' in dataRecord or 'profile_picture' in dataRecord
 
+    # Returns false if the client's record no longer exists.
+    def loadProfile(self, client):
+        if client.login_details.card_head is not None:
+            return True
 
-    # push a client into the waiting list, ready to be found by findMatch.
-    def pushWaiting(self, client):
-        assert isinstance(client, Client)
+        uniqueId = self.buildId(client.login_details)
+        self.write_behind.flushPending(self.match_collection.name, [uniqueId])
+
+        dataRecord = self.match_collection.find_one({'_id': uniqueId}, Matching.PROFILE_PROJECTION)
+        if dataRecord is None or not Matching._hasProfile(dataRecord):
+            return False
+
+        return self._applyProfile(client, dataRecord)
+
+    # Returns false if the profile picture no longer exists.
+    def _applyProfile(self, client, dataRecord):
+        pictureHash = dataRecord.get('profile_picture_hash')
+        if pictureHash is not None:
+            profilePicture = self.profile_pictures.getProfilePicture(pictureHash)
+            if profilePicture is None:
+                return False
+        else:
+            # Records written before pictures were stored separately.
+            profilePicture = ByteBuffer()
+            profilePictureString = dataRecord['profile_picture']
+            assert isinstance(profilePictureString, basestring)
+            profilePicture.buffer = bytearray(profilePictureString, encoding='latin1')
+            profilePicture.used_size = len(profilePicture.buffer)
+            profilePicture.memory_size = profilePicture.used_size
 
         loginDetails = client.login_details
+        loginDetails.name = str(dataRecord['name'])
+        loginDetails.short_name = str(dataRecord['short_name'])
+        loginDetails.card_text = str(dataRecord['card_text'])
+        loginDetails.profile_picture = profilePicture
+        loginDetails.profile_picture_orientation = dataRecord['profile_picture_orientation']
+        loginDetails.encodeCard()
 
-        attempts = 0
-        while attempts < 2:
-            try:
-                attempts += 1
-                self.match_collection.create_index([("date", pymongo.ASCENDING)],
-                                                   expireAfterSeconds=Matching.EXPIRATION_TIME_SECONDS)
-                break
-            except pymongo.errors.OperationFailure as e:
-                logger.warn("Pymongo error: %s, dropping date index on matching collection" % e)
-                self.match_collection.drop_index([("date", pymongo.ASCENDING)])
+        client.remote_notification_payload = str(dataRecord['remote_notification_payload'])
+        return True
 
-        self.match_collection.create_index([("server", pymongo.ASCENDING),
-                                            ("gender", pymongo.ASCENDING),
-                                            ("gender_wanted", pymongo.ASCENDING),
-                                            ("age", pymongo.ASCENDING),
-                                            ("location", pymongo.GEOSPHERE)])
+    # push a client into the waiting list, ready to be found by findMatch.
+    def pushWaiting(self, client):
+        assert isinstance(client, Client)
 
-        self.match_collection.create_index([("server", pymongo.ASCENDING),
-                                            ("gender_wanted", pymongo.ASCENDING),
-                                            ("age", pymongo.ASCENDING),
-                                            ("location", pymongo.GEOSPHERE)])
+        loginDetails = client.login_details
 
+        # Indexes are declared in database.schema.
         utcNow = datetime.utcnow()
         shouldNotify = client.should_notify_on_match_accept
         uniqueId = self.buildId(loginDetails)
@@ -207,20 +277,17 @@ class Matching(object):
                           "date": utcNow}
 
         if shouldNotify:
-            buf = loginDetails.profile_picture
-            assert isinstance(buf, ByteBuffer)
-            encodedProfilePicture = buf.buffer[:buf.used_size].decode('latin-1')
+            pictureHash = self.profile_pictures.pushProfilePicture(loginDetails.profile_picture)
 
             recordToInsert.update({'name' : loginDetails.name,
                                    'short_name' : loginDetails.short_name,
                                    'card_text' : loginDetails.card_text,
-                                   'profile_picture_used_size' : loginDetails.profile_picture.used_size,
-                                   'profile_picture' : encodedProfilePicture,
+                                   'profile_picture_hash' : pictureHash,
                                    'profile_picture_orientation' : loginDetails.profile_picture_orientation,
                                    'persisted_unique_id' : loginDetails.persisted_unique_id,
                                    'remote_notification_payload' : client.remote_notification_payload})
 
-        self.match_collection.replace_one({"_id" : uniqueId}, recordToInsert, upsert=True)
+        self.write_behind.push(self.match_collection.name, uniqueId, Operation.REPLACE_ONE, {"_id" : uniqueId}, recordToInsert, True)
 
     def buildId(self, loginDetails):
         assert isinstance(loginDetails, Client.LoginDetails)
@@ -0,0 +1,77 @@
+import hashlib
+import logging
+from datetime import datetime
+from threading import Lock
+from bson.binary import Binary
+from byte_buffer import ByteBuffer
+from special_collections import LruCache
+
+logger = logging.getLogger(__name__)
+
+# Profile pictures of waiting clients, stored once per distinct picture and keyed by a hash of their contents,
+# so that matching records only need to carry the hash.
+class ProfilePictures(object):
+    # Pictures are kept for longer than matching records, which refer to them, live for.
+    EXPIRATION_TIME_SECONDS = 14 * 24 * 60 * 60
+
+    # Number of decoded pictures kept in memory.
+    CACHE_SIZE = 256
+
+    def __init__(self, mongoClient, cacheSize=CACHE_SIZE):
+        self.mongo_client = mongoClient
+        self.collection = self.mongo_client.db.profile_pictures
+
+        # Hash -> ByteBuffer, used from the database thread pool.
+        self.cache = LruCache(cacheSize)
+        self.cache_lock = Lock()
+
+    @staticmethod
+    def getHash(profilePicture):
+        assert isinstance(profilePicture, ByteBuffer)
+        return hashlib.sha1(profilePicture.getUsedView()).hexdigest()
+
+    # Stores the picture if we don't already have it, and returns its hash.
+    def pushProfilePicture(self, profilePicture):
+        pictureHash = ProfilePictures.getHash(profilePicture)
+        utcNow = datetime.utcnow()
+
+        # Most pictures are already stored (e.g. the client was waiting before), in which case
+        # there is no need to send the picture again.
+        result = self.collection.update_one({"_id": pictureHash}, {"$set": {"date": utcNow}})
+        if result.matched_count == 0:
+            self.collection.update_one({"_id": pictureHash},
+                                       {"$setOnInsert": {"data": Binary(profilePicture.getUsedView().tobytes())},
+                                        "$set": {"date": utcNow}},
+                                       upsert=True)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Stored profile picture [%s] of size [%d]" % (pictureHash, profilePicture.used_size))
+
+        self._cachePicture(pictureHash, profilePicture)
+        return pictureHash
+
+    # Returns None if the picture no longer exists.
+    def getProfilePicture(self, pictureHash):
+        self.cache_lock.acquire()
+        try:
+            profilePicture = self.cache.get(pictureHash)
+        finally:
+            self.cache_lock.release()
+
+        if profilePicture is not None:
+            return profilePicture
+
+        record = self.collection.find_one({"_id": pictureHash})
+        if record is None:
+            return None
+
+        profilePicture = ByteBuffer.buildFromIterable(record["data"])
+        self._cachePicture(pictureHash, profilePicture)
+        return profilePicture
+
+    def _cachePicture(self, pictureHash, profilePicture):
+        self.cache_lock.acquire()
+        try:
+            self.cache.put(pictureHash, profilePicture)
+        finally:
+            self.cache_lock.release()
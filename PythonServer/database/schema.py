@@ -0,0 +1,138 @@
+import logging
+import pymongo
+import pymongo.errors
+from bson.son import SON
+from database.matching import Matching
+from database.karma_ledger import KarmaLedger
+from database.profile_pictures import ProfilePictures
+
+logger = logging.getLogger(__name__)
+
+class Index(object):
+    def __init__(self, keys, expireAfterSeconds=None):
+        super(Index, self).__init__()
+        self.keys = keys
+        self.expire_after_seconds = expireAfterSeconds
+
+    @staticmethod
+    def normaliseKeys(keys):
+        return tuple((field, int(direction) if isinstance(direction, (int, long, float)) else direction) for field, direction in keys)
+
+    def getKeyPattern(self):
+        return Index.normaliseKeys(self.keys)
+
+    def __str__(self):
+        if self.expire_after_seconds is None:
+            return "%s" % (self.keys,)
+        return "%s (expires after %d seconds)" % (self.keys, self.expire_after_seconds)
+
+# Indexes and TTLs of every collection we use, reconciled once at startup so that writes don't need to ensure them.
+class Schema(object):
+    @staticmethod
+    def buildDeclared():
+        collections = dict()
+
+        collections['matcher_v2'] = [Index([("date", pymongo.ASCENDING)], expireAfterSeconds=Matching.EXPIRATION_TIME_SECONDS),
+                                     Index([("server", pymongo.ASCENDING),
+                                            ("gender", pymongo.ASCENDING),
+                                            ("gender_wanted", pymongo.ASCENDING),
+                                            ("age", pymongo.ASCENDING),
+                                            ("location", pymongo.GEOSPHERE)]),
+                                     Index([("server", pymongo.ASCENDING),
+                                            ("gender_wanted", pymongo.ASCENDING),
+                                            ("age", pymongo.ASCENDING),
+                                            ("location", pymongo.GEOSPHERE)])]
+
+        # Relations are looked up by both sides.
+        blockingIndexes = [Index([("blockerSocialId", pymongo.ASCENDING), ("blockedSocialId", pymongo.ASCENDING)]),
+                           Index([("blockedSocialId", pymongo.ASCENDING)])]
+        collections['blocked'] = blockingIndexes
+        collections['match_decision'] = blockingIndexes + [Index([("date", pymongo.ASCENDING)], expireAfterSeconds=Matching.MATCH_HISTORY_EXPIRATION_TIME_SECONDS)]
+
+        # Indexed by ID, the karma and ban collections which it replaced are no longer declared.
+        collections['karma_ledger'] = [Index([("date", pymongo.ASCENDING)], expireAfterSeconds=KarmaLedger.EXPIRATION_TIME_SECONDS)]
+
+        # Only indexed by ID.
+        collections['persisted_ids'] = []
+
+        collections['profile_pictures'] = [Index([("date", pymongo.ASCENDING)], expireAfterSeconds=ProfilePictures.EXPIRATION_TIME_SECONDS)]
+
+        return collections
+
+    def __init__(self, database, collections=None):
+        super(Schema, self).__init__()
+        self.database = database
+
+        if collections is None:
+            collections = Schema.buildDeclared()
+        self.collections = collections
+
+    # Returns a list of differences between the declared and actual indexes, if dryRun is false
+    # missing indexes are created and TTLs are corrected. Indexes which are not declared are reported but kept.
+    def reconcile(self, dryRun=False):
+        drift = []
+        for collectionName in sorted(self.collections):
+            drift += self._reconcileCollection(collectionName, self.collections[collectionName], dryRun)
+
+        for description in drift:
+            logger.warn("Database schema drift: %s" % description)
+
+        if len(drift) == 0:
+            logger.info("Database schema is up to date")
+
+        return drift
+
+    def _reconcileCollection(self, collectionName, indexes, dryRun):
+        collection = self.database[collectionName]
+        drift = []
+
+        # Key pattern -> (index name, index information).
+        existing = dict()
+        for name, information in collection.index_information().iteritems():
+            existing[Index.normaliseKeys(information['key'])] = (name, information)
+
+        declaredKeyPatterns = set()
+        for index in indexes:
+            keyPattern = index.getKeyPattern()
+            declaredKeyPatterns.add(keyPattern)
+
+            if keyPattern not in existing:
+                drift.append("[%s] is missing index %s" % (collectionName, index))
+                if not dryRun:
+                    self._createIndex(collection, index)
+                continue
+
+            name, information = existing[keyPattern]
+            expireAfterSeconds = information.get('expireAfterSeconds')
+            if expireAfterSeconds is not None:
+                expireAfterSeconds = int(expireAfterSeconds)
+
+            if expireAfterSeconds != index.expire_after_seconds:
+                drift.append("[%s] index [%s] expires after [%s] seconds, declared %s" % (collectionName, name, expireAfterSeconds, index))
+                if not dryRun:
+                    self._updateExpiry(collection, name, index)
+
+        for keyPattern, (name, information) in existing.iteritems():
+            if name != '_id_' and keyPattern not in declaredKeyPatterns:
+                drift.append("[%s] has undeclared index [%s]" % (collectionName, name))
+
+        return drift
+
+    def _createIndex(self, collection, index):
+        if index.expire_after_seconds is None:
+            collection.create_index(index.keys)
+        else:
+            collection.create_index(index.keys, expireAfterSeconds=index.expire_after_seconds)
+
+    def _updateExpiry(self, collection, name, index):
+        # TTLs can only be added or changed in place with collMod, otherwise we have to rebuild the index.
+        if index.expire_after_seconds is not None:
+            try:
+                self.database.command('collMod', collection.name,
+                                      index={'keyPattern': SON(index.keys), 'expireAfterSeconds': index.expire_after_seconds})
+                return
+            except pymongo.errors.OperationFailure as e:
+                logger.warn("Failed to modify expiry of index [%s] on collection [%s], rebuilding it: %s" % (name, collection.name, e))
+
+        collection.drop_index(name)
+        self._createIndex(collection, index)
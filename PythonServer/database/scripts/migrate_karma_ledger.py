@@ -0,0 +1,79 @@
+import argparse
+import logging
+import pymongo
+from pymongo import UpdateOne
+from database.karma_leveled import KarmaLeveled
+from database.karma_ledger import KarmaLedger
+
+logger = logging.getLogger(__name__)
+
+# Records written per bulk write.
+BATCH_SIZE = 500
+
+# Returns persisted ID -> karma ledger record, built from the karma and ban collections of KarmaLeveled.
+def buildLedgerRecords(database):
+    collectionExpiryTimes = KarmaLeveled.getCollectionExpiryTimes()
+    karmaCollectionName = collectionExpiryTimes[0][0]
+
+    records = dict()
+    def getRecord(socialId):
+        return records.setdefault(socialId, {'_id': socialId, 'deductions': [], 'date': None})
+
+    def updateDate(record, date):
+        if record['date'] is None or date > record['date']:
+            record['date'] = date
+
+    # Only the most recent deductions count, see KarmaLedger.deductKarma.
+    for item in database[karmaCollectionName].aggregate([{'$sort': {'date': pymongo.ASCENDING}},
+                                                         {'$group': {'_id': '$socialId', 'dates': {'$push': '$date'}}}]):
+        record = getRecord(item['_id'])
+        record['deductions'] = item['dates'][-KarmaLedger.KARMA_MAXIMUM:]
+        updateDate(record, item['dates'][-1])
+
+    # Records of a ban level all share the date of the most recent ban.
+    for collectionName, expiryTimeSeconds in collectionExpiryTimes[1:]:
+        level = int(collectionName.split('_')[1])
+        for item in database[collectionName].aggregate([{'$group': {'_id': '$socialId', 'count': {'$sum': 1}, 'date': {'$max': '$date'}}}]):
+            record = getRecord(item['_id'])
+            record[KarmaLedger.getBanField(level)] = {'count': item['count'], 'date': item['date']}
+            updateDate(record, item['date'])
+
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate karma and bans from the per deduction collections to the karma ledger')
+    parser.add_argument('--dry_run', help='Only report what would be migrated, do not change anything', action='store_true', default=False)
+    parser.add_argument('--drop_old', help='Drop the karma and ban collections once migrated', action='store_true', default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)-30s %(name)-20s %(levelname)-8s %(message)s')
+
+    mongoClient = pymongo.MongoClient("localhost", 27017)
+    records = buildLedgerRecords(mongoClient.db)
+    logger.info("Built karma ledger records of [%d] persisted IDs" % len(records))
+
+    if args.dry_run:
+        for record in records.itervalues():
+            print record
+    else:
+        # Records written since the governor switched to the ledger take priority, so existing fields are kept.
+        ledgerCollection = KarmaLedger(mongoClient).ledger_collection
+        requests = []
+        for socialId, record in records.iteritems():
+            fields = dict(record)
+            del fields['_id']
+            requests.append(UpdateOne({'_id': socialId}, {'$setOnInsert': fields}, upsert=True))
+
+            if len(requests) >= BATCH_SIZE:
+                ledgerCollection.bulk_write(requests, ordered=False)
+                requests = []
+
+        if len(requests) > 0:
+            ledgerCollection.bulk_write(requests, ordered=False)
+
+        logger.info("Migrated karma ledger records of [%d] persisted IDs" % len(records))
+
+        if args.drop_old:
+            for collectionName, expiryTimeSeconds in KarmaLeveled.getCollectionExpiryTimes():
+                mongoClient.db[collectionName].drop()
+                logger.info("Dropped collection [%s]" % collectionName)
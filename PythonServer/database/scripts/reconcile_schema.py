@@ -0,0 +1,16 @@
+import argparse
+import logging
+import pymongo
+from database.schema import Schema
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconcile database indexes with those declared in database.schema')
+    parser.add_argument('--dry_run', help='Only report differences, do not change anything', action='store_true', default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)-30s %(name)-20s %(levelname)-8s %(message)s')
+
+    mongoClient = pymongo.MongoClient("localhost", 27017)
+    drift = Schema(mongoClient.db).reconcile(dryRun=args.dry_run)
+    for description in drift:
+        print description
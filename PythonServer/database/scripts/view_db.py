@@ -1,7 +1,7 @@
 import pymongo
-from database.karma_leveled import KarmaLeveled
+from database.karma_ledger import KarmaLedger
 
 if __name__ == '__main__':
     mongoClient = pymongo.MongoClient("localhost", 27017)
-    db = KarmaLeveled(mongoClient)
+    db = KarmaLedger(mongoClient)
     db.listItems()
\ No newline at end of file
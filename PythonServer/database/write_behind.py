@@ -0,0 +1,490 @@
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from threading import Lock
+from bson.errors import InvalidDocument
+from pymongo import InsertOne, ReplaceOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError, ConnectionFailure, AutoReconnect, WriteConcernError
+from twisted.internet import task
+from stat_tracker import PeriodMetrics
+
+logger = logging.getLogger(__name__)
+
+class Operation(object):
+    INSERT_ONE = 'insert_one'
+    REPLACE_ONE = 'replace_one'
+    UPDATE_ONE = 'update_one'
+    UPDATE_MANY = 'update_many'
+    DELETE_ONE = 'delete_one'
+    DELETE_MANY = 'delete_many'
+
+# Operations are journaled by name and arguments, so that they can be spooled to disk.
+REQUEST_TYPES = {Operation.INSERT_ONE: InsertOne,
+                 Operation.REPLACE_ONE: ReplaceOne,
+                 Operation.UPDATE_ONE: UpdateOne,
+                 Operation.UPDATE_MANY: UpdateMany,
+                 Operation.DELETE_ONE: DeleteOne,
+                 Operation.DELETE_MANY: DeleteMany}
+
+def buildRequest(operation, arguments):
+    return REQUEST_TYPES[operation](*arguments)
+
+# Applies writes straight away, used when there is no journal e.g. by scripts.
+class DirectWrites(object):
+    def __init__(self, database):
+        super(DirectWrites, self).__init__()
+        self.database = database
+
+    def push(self, collectionName, key, operation, *arguments):
+        self.database[collectionName].bulk_write([buildRequest(operation, arguments)])
+
+    def flushPending(self, collectionName, keys=None):
+        pass
+
+# Journal of writes which are applied to the database in the background, as one bulk_write per collection
+# every few milliseconds, or sooner when many writes are pending.
+#
+# Writes to a collection are applied in the order they were pushed, so writes about the same persisted ID
+# are never reordered. Every write is appended to a local spool file before push returns, writes which
+# were not acknowledged by the database are replayed by recover on the next start. Replayed writes may have
+# been applied already, which is harmless for the writes we journal (at worst an extra karma deduction).
+#
+# Reads which must see their own writes call flushPending first, see Blocking and Karma.
+class WriteBehind(object):
+    FLUSH_INTERVAL_SECONDS = 0.01
+
+    # Writes pending before a flush is made without waiting for the flush interval, and the most written per flush.
+    MAX_BATCH_SIZE = 500
+
+    def __init__(self, database, spoolPath, flushIntervalSeconds=FLUSH_INTERVAL_SECONDS, maxBatchSize=MAX_BATCH_SIZE):
+        super(WriteBehind, self).__init__()
+        self.database = database
+        self.spool_path = spoolPath
+        self.flush_interval = flushIntervalSeconds
+        self.max_batch_size = maxBatchSize
+
+        # (sequence number, collection name, key, operation, arguments), oldest first.
+        self.pending = []
+        self.next_sequence = 0
+
+        # (collection name, key) -> number of writes which are pending or being written, and the same by collection name.
+        self.unwritten_by_key = dict()
+        self.unwritten_by_collection = dict()
+
+        # Protects the above and the spool file.
+        self.lock = Lock()
+
+        # Only one flush at a time, so that writes to a collection stay in order.
+        self.flush_lock = Lock()
+
+        self.spool = None
+
+        self.reactor = None
+        self.async_database = None
+        self.flusher = None
+        self.is_flush_scheduled = False
+
+        self.period_metrics = PeriodMetrics('written', 'dropped', 'flushes', 'failed_flushes')
+
+    # Replays writes which were spooled but not acknowledged before we last stopped, must be called before push.
+    # Returns the number of writes replayed.
+    def recover(self):
+        unacknowledged = self._readSpool()
+
+        # Rewrite the spool with only the unacknowledged writes, then swap it in, so that they are not lost
+        # if we stop again during recovery.
+        temporaryPath = self.spool_path + ".tmp"
+        self.spool = open(temporaryPath, 'wb')
+        for collectionName, key, operation, arguments in unacknowledged:
+            self.push(collectionName, key, operation, *arguments)
+        self._syncSpool()
+        os.rename(temporaryPath, self.spool_path)
+
+        if len(unacknowledged) > 0:
+            logger.warn("Replaying [%d] database writes which were not acknowledged before shutdown" % len(unacknowledged))
+            self.flush()
+
+        return len(unacknowledged)
+
+    def _readSpool(self):
+        if not os.path.exists(self.spool_path):
+            return []
+
+        # Sequence number -> (collection name, key, operation, arguments).
+        writes = OrderedDict()
+        with open(self.spool_path, 'rb') as spool:
+            while True:
+                try:
+                    record = pickle.load(spool)
+                except EOFError:
+                    break
+                except Exception as e:
+                    # The last record may have been partially written.
+                    logger.warn("Stopped reading write behind spool [%s] at a damaged record: %s" % (self.spool_path, e))
+                    break
+
+                if record[0] == 'write':
+                    writes[record[1]] = record[2:]
+                else:
+                    for sequence in record[1]:
+                        writes.pop(sequence, None)
+
+        return writes.values()
+
+    def _appendToSpool(self, record):
+        pickle.dump(record, self.spool, pickle.HIGHEST_PROTOCOL)
+        self.spool.flush()
+
+    # The lock is not held while syncing, so that push doesn't wait on the disk.
+    def _syncSpool(self):
+        self.lock.acquire()
+        try:
+            self.spool.flush()
+        finally:
+            self.lock.release()
+
+        os.fsync(self.spool.fileno())
+
+    # Flushes periodically on the database thread pool, until the reactor stops.
+    def start(self, reactor, asyncDatabase):
+        self.reactor = reactor
+        self.async_database = asyncDatabase
+        self.flusher = task.LoopingCall(self.scheduleFlush)
+        self.flusher.start(self.flush_interval, now=False)
+
+        # Runs before the database thread pool is stopped.
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.flusher is not None and self.flusher.running:
+            self.flusher.stop()
+
+        self.flush()
+
+    def push(self, collectionName, key, operation, *arguments):
+        assert operation in REQUEST_TYPES
+
+        self.lock.acquire()
+        try:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+
+            self._appendToSpool(('write', sequence, collectionName, key, operation, arguments))
+            self.pending.append((sequence, collectionName, key, operation, arguments))
+
+            unwrittenKey = (collectionName, key)
+            self.unwritten_by_key[unwrittenKey] = self.unwritten_by_key.get(unwrittenKey, 0) + 1
+            self.unwritten_by_collection[collectionName] = self.unwritten_by_collection.get(collectionName, 0) + 1
+
+            isBatchFull = len(self.pending) >= self.max_batch_size
+        finally:
+            self.lock.release()
+
+        if isBatchFull and self.reactor is not None:
+            self.reactor.callFromThread(self.scheduleFlush)
+
+    # If any writes to the collection (and about one of the keys, if specified) have not been written
+    # yet, writes them now.
+    def flushPending(self, collectionName, keys=None):
+        self.lock.acquire()
+        try:
+            if keys is None:
+                isUnwritten = self.unwritten_by_collection.get(collectionName, 0) > 0
+            else:
+                isUnwritten = any((collectionName, key) in self.unwritten_by_key for key in keys)
+        finally:
+            self.lock.release()
+
+        if isUnwritten:
+            self.flush()
+
+    # Must be called from the reactor thread.
+    def scheduleFlush(self):
+        if self.is_flush_scheduled or len(self.pending) == 0:
+            return
+
+        self.is_flush_scheduled = True
+        result = self.async_database.run(self.flush)
+        result.addErrback(self._onFlushFailure)
+        result.addBoth(self._onFlushComplete)
+
+    def _onFlushFailure(self, failure):
+        logger.error("Failed to flush database writes: %s" % failure.getErrorMessage())
+
+    def _onFlushComplete(self, result):
+        self.is_flush_scheduled = False
+
+    # Writes everything pending, stops early if the database fails, in which case the writes
+    # that failed are retried by the next flush.
+    def flush(self):
+        self.flush_lock.acquire()
+        try:
+            while True:
+                self.lock.acquire()
+                try:
+                    batch = self.pending[:self.max_batch_size]
+                    del self.pending[:self.max_batch_size]
+                finally:
+                    self.lock.release()
+
+                if len(batch) == 0:
+                    break
+
+                if not self._writeBatch(batch):
+                    self.period_metrics.failed_flushes += 1
+                    break
+
+            self.lock.acquire()
+            try:
+                # Everything in the spool has been acknowledged.
+                if len(self.unwritten_by_key) == 0:
+                    self.spool.seek(0)
+                    self.spool.truncate()
+            finally:
+                self.lock.release()
+        finally:
+            self.flush_lock.release()
+
+    # Returns false if some of the batch needs to be retried.
+    def _writeBatch(self, batch):
+        acknowledged = []
+        retry = []
+        droppedCount = 0
+        try:
+            # Make sure the batch would survive a crash before it is written.
+            self._syncSpool()
+
+            # Collection name -> writes, in the order they were pushed.
+            writesByCollection = OrderedDict()
+            for write in batch:
+                writesByCollection.setdefault(write[1], list()).append(write)
+
+            for collectionName, writes in writesByCollection.iteritems():
+                try:
+                    requests = [buildRequest(operation, arguments) for sequence, collectionName, key, operation, arguments in writes]
+                    self.database[collectionName].bulk_write(requests, ordered=True)
+                    acknowledged += writes
+                except BulkWriteError as e:
+                    writeErrors = (e.details or {}).get('writeErrors')
+                    if not writeErrors:
+                        # Only the write concern failed, so we don't know which of the writes were applied.
+                        logger.warn("Failed to write [%d] operations to collection [%s], will retry: %s" % (len(writes), collectionName, e))
+                        retry += writes
+                        continue
+
+                    # Writes are applied in order up until the one which failed, it would fail again so it is dropped.
+                    failedIndex = writeErrors[0]['index']
+                    logger.error("Dropping database write [%s] to collection [%s], which failed: %s" % (writes[failedIndex][3], collectionName, writeErrors[0].get('errmsg')))
+                    acknowledged += writes[:failedIndex + 1]
+                    retry += writes[failedIndex + 1:]
+                    droppedCount += 1
+                except (ConnectionFailure, WriteConcernError) as e:
+                    logger.warn("Failed to write [%d] operations to collection [%s], will retry: %s" % (len(writes), collectionName, e))
+                    retry += writes
+                except Exception as e:
+                    # Some write can never succeed, e.g. it can't be encoded, so would hold up the collection's writes for good.
+                    logger.warn("Failed to write [%d] operations to collection [%s], writing them one at a time: %s" % (len(writes), collectionName, e))
+                    written, writeDroppedCount, unwritten = self._writeEach(collectionName, writes)
+                    acknowledged += written
+                    retry += unwritten
+                    droppedCount += writeDroppedCount
+        finally:
+            # Nothing taken from pending may be lost, whatever went wrong, everything not yet acknowledged is retried.
+            settled = set(write[0] for write in acknowledged) | set(write[0] for write in retry)
+            retry += [write for write in batch if write[0] not in settled]
+            self._settleBatch(acknowledged, retry)
+
+        self.period_metrics.written += len(acknowledged) - droppedCount
+        self.period_metrics.dropped += droppedCount
+        self.period_metrics.flushes += 1
+        return len(retry) == 0
+
+    # Writes in order until the database fails, dropping writes which fail by themselves.
+    # Returns the writes acknowledged (including those dropped), the number dropped, and the writes to retry.
+    def _writeEach(self, collectionName, writes):
+        acknowledged = []
+        droppedCount = 0
+        for index, write in enumerate(writes):
+            operation, arguments = write[3], write[4]
+            try:
+                self.database[collectionName].bulk_write([buildRequest(operation, arguments)], ordered=True)
+            except BulkWriteError as e:
+                if not (e.details or {}).get('writeErrors'):
+                    return acknowledged, droppedCount, writes[index:]
+
+                logger.error("Dropping database write [%s] to collection [%s], which failed: %s" % (operation, collectionName, e.details['writeErrors'][0].get('errmsg')))
+                droppedCount += 1
+            except (ConnectionFailure, WriteConcernError):
+                return acknowledged, droppedCount, writes[index:]
+            except Exception as e:
+                logger.error("Dropping database write [%s] to collection [%s], which failed: %s" % (operation, collectionName, e))
+                droppedCount += 1
+
+            acknowledged.append(write)
+
+        return acknowledged, droppedCount, []
+
+    def _settleBatch(self, acknowledged, retry):
+        self.lock.acquire()
+        try:
+            # Anything being retried is older than everything still pending.
+            self.pending[0:0] = sorted(retry)
+
+            for sequence, collectionName, key, operation, arguments in acknowledged:
+                unwrittenKey = (collectionName, key)
+                self.unwritten_by_key[unwrittenKey] -= 1
+                if self.unwritten_by_key[unwrittenKey] == 0:
+                    del self.unwritten_by_key[unwrittenKey]
+
+                self.unwritten_by_collection[collectionName] -= 1
+                if self.unwritten_by_collection[collectionName] == 0:
+                    del self.unwritten_by_collection[collectionName]
+
+            if len(acknowledged) > 0:
+                self._appendToSpool(('acknowledged', [write[0] for write in acknowledged]))
+        finally:
+            self.lock.release()
+
+    # Returns metrics since they were last reported, and starts a new reporting period.
+    def getMetrics(self):
+        metrics = self.period_metrics.take()
+        metrics['pending'] = len(self.pending)
+        return metrics
+
+    def reportMetrics(self):
+        metrics = self.getMetrics()
+        logger.info("Database write behind, pending: [%(pending)d], written: [%(written)d] in [%(flushes)d] flushes, "
+                    "failed flushes: [%(failed_flushes)d], dropped: [%(dropped)d]" % metrics)
+
+
+class WriteBehindTest(unittest.TestCase):
+    # Records the writes made to it, raises the errors queued for its next calls.
+    class FakeCollection(object):
+        def __init__(self):
+            self.requests = []
+            self.errors = []
+
+        def bulk_write(self, requests, ordered=True):
+            assert ordered
+            for request in requests:
+                if request == InsertOne({'name': 'bad'}):
+                    raise InvalidDocument("cannot encode object")
+
+            if len(self.errors) > 0:
+                error = self.errors.pop(0)
+                if isinstance(error, BulkWriteError):
+                    self.requests += requests[:error.details['writeErrors'][0]['index']]
+                raise error
+
+            self.requests += requests
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.directory, "write_behind.spool")
+        self.database = dict()
+        self.write_behind = self.buildWriteBehind()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def buildWriteBehind(self):
+        self.database = dict((name, WriteBehindTest.FakeCollection()) for name in ['a', 'b'])
+        writeBehind = WriteBehind(self.database, self.spool_path)
+        writeBehind.recover()
+        return writeBehind
+
+    def push(self, collectionName, key, value):
+        self.write_behind.push(collectionName, key, Operation.INSERT_ONE, {'name': value})
+
+    def assertWritten(self, collectionName, values):
+        self.assertEqual([InsertOne({'name': value}) for value in values], self.database[collectionName].requests)
+
+    def testOrderedFlush(self):
+        for index in range(3):
+            self.push('a', 'x', index)
+            self.push('b', 'x', index)
+        self.push('a', 'y', 3)
+
+        self.write_behind.flush()
+
+        self.assertWritten('a', [0, 1, 2, 3])
+        self.assertWritten('b', [0, 1, 2])
+        self.assertEqual(0, len(self.write_behind.pending))
+        self.assertEqual(0, len(self.write_behind.unwritten_by_key))
+        self.assertEqual(0, len(self.write_behind.unwritten_by_collection))
+
+    def testBulkWriteErrorRetriesRest(self):
+        for index in range(4):
+            self.push('a', 'x', index)
+        self.database['a'].errors.append(BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': "duplicate key"}]}))
+
+        # The write which failed is dropped, the ones after it are retried.
+        self.write_behind.flush()
+        self.assertWritten('a', [0])
+        self.assertEqual([2, 3], [write[4][0]['name'] for write in self.write_behind.pending])
+        self.assertTrue(('a', 'x') in self.write_behind.unwritten_by_key)
+
+        self.write_behind.flush()
+        self.assertWritten('a', [0, 2, 3])
+        self.assertEqual(0, len(self.write_behind.unwritten_by_key))
+
+    def testConnectionFailureRetriesAll(self):
+        self.push('a', 'x', 0)
+        self.push('a', 'x', 1)
+        self.database['a'].errors.append(AutoReconnect("connection closed"))
+
+        self.write_behind.flush()
+        self.assertWritten('a', [])
+        self.assertEqual(2, len(self.write_behind.pending))
+
+        self.write_behind.flush()
+        self.assertWritten('a', [0, 1])
+
+    def testUnwritableWriteDropped(self):
+        self.push('a', 'x', 0)
+        self.push('a', 'x', 'bad')
+        self.push('a', 'y', 2)
+
+        # Never retried, the writes after it are made in order.
+        self.write_behind.flush()
+        self.assertWritten('a', [0, 2])
+        self.assertEqual(0, len(self.write_behind.pending))
+        self.assertEqual(0, len(self.write_behind.unwritten_by_key))
+
+        self.push('a', 'x', 3)
+        self.write_behind.flush()
+        self.assertWritten('a', [0, 2, 3])
+
+    def testRecoverReplaysUnacknowledged(self):
+        self.push('a', 'x', 0)
+        self.push('b', 'x', 1)
+        self.push('b', 'x', 2)
+        self.database['b'].errors.append(AutoReconnect("connection closed"))
+        self.write_behind.flush()
+        self.assertWritten('a', [0])
+
+        # Stopped without acknowledging the writes to b.
+        self.write_behind.spool.close()
+        self.write_behind = self.buildWriteBehind()
+        self.assertWritten('a', [])
+        self.assertWritten('b', [1, 2])
+
+        # Nothing is replayed twice.
+        self.write_behind.spool.close()
+        self.write_behind = self.buildWriteBehind()
+        self.assertWritten('b', [])
+
+    def testSpoolTruncatedOnceAcknowledged(self):
+        self.push('a', 'x', 0)
+        self.assertTrue(os.path.getsize(self.spool_path) > 0)
+
+        self.database['a'].errors.append(AutoReconnect("connection closed"))
+        self.write_behind.flush()
+        self.assertTrue(os.path.getsize(self.spool_path) > 0)
+
+        self.write_behind.flush()
+        self.assertEqual(0, os.path.getsize(self.spool_path))
@@ -0,0 +1,399 @@
+import hashlib
+import hmac
+import logging
+import random
+import struct
+import unittest
+from threading import RLock
+from utility import DataConstants
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+# Precomputed UDP routes between the two participants of matched rooms.
+#
+# The relay path reads routes without taking any lock (a single dict lookup is atomic),
+# all modifications are made under our own lock by the house as rooms change state.
+#
+# Clients can also prefix media datagrams with the connection ID we assign them, in which case
+# they are routed by ID and their address is updated in place when their network changes.
+#
+# The ID is followed by a tag which only the client can compute, see getConnectionIdTag, as
+# otherwise anyone guessing an ID could move the client's routes to their own address.
+class ForwardingTable(object):
+    # Datagram format: [OP_CONNECTION_ID (1 byte)][connection ID (4 bytes)][tag (8 bytes)][original datagram]
+    OP_CONNECTION_ID = 5
+    CONNECTION_ID_PREFIX = chr(OP_CONNECTION_ID)
+    CONNECTION_ID_TAG_SIZE = 8
+    CONNECTION_ID_TAG_OFFSET = DataConstants.UBYTE_SIZE + DataConstants.ULONG_SIZE
+    CONNECTION_ID_HEADER_SIZE = CONNECTION_ID_TAG_OFFSET + CONNECTION_ID_TAG_SIZE
+
+    _random = random.SystemRandom()
+
+    MAX_CONNECTION_ID = 0xFFFFFFFF
+
+    def __init__(self):
+        super(ForwardingTable, self).__init__()
+
+        # Source UDP address -> UDP address of the client at the other end of the room.
+        self.routes = dict()
+
+        # Client -> UDP address the client was registered with, so that routes can be removed
+        # even after the client's UDP address has changed.
+        self.addresses_by_client = dict()
+
+        # Functions called with (source address, peer address) whenever a route changes,
+        # peer address is None when the route has been removed.
+        self.listeners = list()
+
+        # Connection ID -> client.
+        self.clients_by_connection_id = dict()
+
+        # Functions called with (connection ID, UDP address) whenever a connection ID is registered or
+        # the client's address changes, address is None when the connection ID has been removed.
+        self.connection_id_listeners = list()
+
+        # Connection IDs are assigned such that ID % partition count == partition, see setConnectionIdPartition.
+        self.connection_id_partition = 0
+        self.connection_id_partition_count = 1
+
+        self._lock = RLock()
+
+    # Return the connection ID of a datagram, or None if it is not prefixed with one.
+    @staticmethod
+    def parseConnectionId(data):
+        if data[:1] != ForwardingTable.CONNECTION_ID_PREFIX or len(data) < ForwardingTable.CONNECTION_ID_HEADER_SIZE:
+            return None
+
+        return struct.unpack_from(DataConstants.ULONG_FORMAT, data, DataConstants.UBYTE_SIZE)[0]
+
+    # Truncated HMAC of the connection ID, keyed with the client's session hash which only
+    # the client and us know.
+    @staticmethod
+    def getConnectionIdTag(connectionId, sessionHash):
+        message = struct.pack(DataConstants.ULONG_FORMAT, connectionId)
+        return hmac.new(str(sessionHash), message, hashlib.sha256).digest()[:ForwardingTable.CONNECTION_ID_TAG_SIZE]
+
+    # Whether a datagram prefixed with a connection ID carries the tag we expect, compared in constant time.
+    @staticmethod
+    def isValidConnectionIdTag(data, expectedTag):
+        if expectedTag is None:
+            return False
+
+        tag = data[ForwardingTable.CONNECTION_ID_TAG_OFFSET:ForwardingTable.CONNECTION_ID_HEADER_SIZE]
+        return hmac.compare_digest(tag, expectedTag)
+
+    def addListener(self, listenerFunc):
+        self._lock.acquire()
+        try:
+            self.listeners.append(listenerFunc)
+        finally:
+            self._lock.release()
+
+    def _notifyListeners(self, sourceAddress, peerAddress):
+        for listenerFunc in self.listeners:
+            listenerFunc(sourceAddress, peerAddress)
+
+    def addConnectionIdListener(self, listenerFunc):
+        self._lock.acquire()
+        try:
+            self.connection_id_listeners.append(listenerFunc)
+        finally:
+            self._lock.release()
+
+    def _notifyConnectionIdListeners(self, connectionId, address):
+        for listenerFunc in self.connection_id_listeners:
+            listenerFunc(connectionId, address)
+
+    # Shards of a sharded governor each assign IDs from their own partition, so that the front process
+    # can tell which shard a datagram prefixed with a connection ID belongs to.
+    def setConnectionIdPartition(self, partition, partitionCount):
+        assert 0 <= partition < partitionCount
+        self.connection_id_partition = partition
+        self.connection_id_partition_count = partitionCount
+
+    @staticmethod
+    def getConnectionIdPartition(connectionId, partitionCount):
+        return connectionId % partitionCount
+
+    # Assign a new connection ID to a client which has connected via UDP.
+    def registerConnectionId(self, client):
+        self._lock.acquire()
+        try:
+            self._unregisterConnectionId(client)
+
+            while True:
+                connectionId = ForwardingTable._random.getrandbits(32)
+                connectionId += self.connection_id_partition - connectionId % self.connection_id_partition_count
+                if 0 < connectionId <= ForwardingTable.MAX_CONNECTION_ID and connectionId not in self.clients_by_connection_id:
+                    break
+
+            client.connection_id = connectionId
+            client.connection_id_tag = ForwardingTable.getConnectionIdTag(connectionId, client.udp_hash)
+            self.clients_by_connection_id[connectionId] = client
+            self._notifyConnectionIdListeners(connectionId, client.udp.remote_address)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Connection ID [%d] registered for client [%s]" % (connectionId, client))
+            return connectionId
+        finally:
+            self._lock.release()
+
+    # Keep the connection ID which a client moved from another shard already uses, see Governor.adoptMigratedClient.
+    # Returns false if the ID is in use here.
+    def adoptConnectionId(self, client, connectionId):
+        self._lock.acquire()
+        try:
+            if connectionId in self.clients_by_connection_id:
+                return False
+
+            self._unregisterConnectionId(client)
+
+            client.connection_id = connectionId
+            client.connection_id_tag = ForwardingTable.getConnectionIdTag(connectionId, client.udp_hash)
+            self.clients_by_connection_id[connectionId] = client
+            self._notifyConnectionIdListeners(connectionId, client.udp.remote_address)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Connection ID [%d] adopted for client [%s]" % (connectionId, client))
+            return True
+        finally:
+            self._lock.release()
+
+    def unregisterConnectionId(self, client):
+        self._lock.acquire()
+        try:
+            self._unregisterConnectionId(client)
+        finally:
+            self._lock.release()
+
+    def _unregisterConnectionId(self, client):
+        connectionId = client.connection_id
+        if connectionId is None:
+            return
+
+        # Connection ID may have been reassigned to a reconnected client object.
+        if self.clients_by_connection_id.get(connectionId) is client:
+            del self.clients_by_connection_id[connectionId]
+            self._notifyConnectionIdListeners(connectionId, None)
+
+        client.connection_id = None
+        client.connection_id_tag = None
+
+    # Copy of all connection IDs and their addresses, safe to iterate while clients change.
+    def getConnectionIds(self):
+        self._lock.acquire()
+        try:
+            return dict((connectionId, client.udp.remote_address) for connectionId, client in self.clients_by_connection_id.iteritems() if client.udp is not None)
+        finally:
+            self._lock.release()
+
+    # Client's UDP address has changed, rewrite its routes in place, the other side of the room is unaffected.
+    def updateClientAddress(self, client):
+        self._lock.acquire()
+        try:
+            if client.udp is None:
+                return
+
+            newAddress = client.udp.remote_address
+            if client.connection_id is not None and self.clients_by_connection_id.get(client.connection_id) is client:
+                self._notifyConnectionIdListeners(client.connection_id, newAddress)
+
+            oldAddress = self.addresses_by_client.get(client)
+            if oldAddress is None or oldAddress == newAddress:
+                return
+
+            peerAddress = self.routes.pop(oldAddress, None)
+            self._notifyListeners(oldAddress, None)
+            self.addresses_by_client[client] = newAddress
+            if peerAddress is None:
+                return
+
+            self.routes[newAddress] = peerAddress
+            self.routes[peerAddress] = newAddress
+            self._notifyListeners(newAddress, peerAddress)
+            self._notifyListeners(peerAddress, newAddress)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Forwarding route moved from [%s] to [%s], peer [%s]" % (oldAddress, newAddress, peerAddress))
+        finally:
+            self._lock.release()
+
+    def addRoom(self, clientA, clientB):
+        self._lock.acquire()
+        try:
+            self._removeClient(clientA)
+            self._removeClient(clientB)
+
+            # Offline clients have no UDP address, there is nothing to relay to.
+            if clientA.udp is None or clientB.udp is None:
+                return
+
+            addressA = clientA.udp.remote_address
+            addressB = clientB.udp.remote_address
+
+            self.addresses_by_client[clientA] = addressA
+            self.addresses_by_client[clientB] = addressB
+
+            self.routes[addressA] = addressB
+            self.routes[addressB] = addressA
+
+            self._notifyListeners(addressA, addressB)
+            self._notifyListeners(addressB, addressA)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Forwarding route added between [%s] and [%s]" % (addressA, addressB))
+        finally:
+            self._lock.release()
+
+    # Copy of all routes, safe to iterate while rooms change.
+    def getRoutes(self):
+        self._lock.acquire()
+        try:
+            return dict(self.routes)
+        finally:
+            self._lock.release()
+
+    def removeClient(self, client):
+        self._lock.acquire()
+        try:
+            self._removeClient(client)
+        finally:
+            self._lock.release()
+
+    # Removes the routes in both directions.
+    def _removeClient(self, client):
+        address = self.addresses_by_client.pop(client, None)
+        if address is None:
+            return
+
+        peerAddress = self.routes.pop(address, None)
+        self._notifyListeners(address, None)
+        if peerAddress is not None and self.routes.get(peerAddress) == address:
+            del self.routes[peerAddress]
+            self._notifyListeners(peerAddress, None)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Forwarding route removed between [%s] and [%s]" % (address, peerAddress))
+
+    def __len__(self):
+        return len(self.routes)
+
+
+class ForwardingTableTest(unittest.TestCase):
+    class DummyUdp(object):
+        def __init__(self, remoteAddress):
+            self.remote_address = remoteAddress
+
+    class DummyClient(object):
+        def __init__(self, remoteAddress):
+            self.udp = ForwardingTableTest.DummyUdp(remoteAddress)
+            self.udp_hash = "hash%s" % (remoteAddress,)
+            self.connection_id = None
+            self.connection_id_tag = None
+
+    def testRoutes(self):
+        table = ForwardingTable()
+        clientA = ForwardingTableTest.DummyClient(("1.1.1.1", 1))
+        clientB = ForwardingTableTest.DummyClient(("2.2.2.2", 2))
+        table.addRoom(clientA, clientB)
+
+        self.assertEquals(table.routes.get(("1.1.1.1", 1)), ("2.2.2.2", 2))
+        self.assertEquals(table.routes.get(("2.2.2.2", 2)), ("1.1.1.1", 1))
+
+        # Client A changes network, old route must not survive.
+        clientA.udp = ForwardingTableTest.DummyUdp(("3.3.3.3", 3))
+        table.addRoom(clientA, clientB)
+        self.assertEquals(len(table), 2)
+        self.assertEquals(table.routes.get(("2.2.2.2", 2)), ("3.3.3.3", 3))
+        self.assertIsNone(table.routes.get(("1.1.1.1", 1)))
+
+        table.removeClient(clientB)
+        self.assertEquals(len(table), 0)
+
+    def testListeners(self):
+        table = ForwardingTable()
+        mirror = dict()
+
+        def onRouteChange(sourceAddress, peerAddress):
+            if peerAddress is None:
+                mirror.pop(sourceAddress, None)
+            else:
+                mirror[sourceAddress] = peerAddress
+
+        table.addListener(onRouteChange)
+        clientA = ForwardingTableTest.DummyClient(("1.1.1.1", 1))
+        clientB = ForwardingTableTest.DummyClient(("2.2.2.2", 2))
+        table.addRoom(clientA, clientB)
+        self.assertEquals(mirror, table.routes)
+
+        clientB.udp = ForwardingTableTest.DummyUdp(("3.3.3.3", 3))
+        table.addRoom(clientA, clientB)
+        self.assertEquals(mirror, table.routes)
+
+        table.removeClient(clientA)
+        self.assertEquals(mirror, table.routes)
+
+    def testConnectionIdRebinding(self):
+        table = ForwardingTable()
+        clientA = ForwardingTableTest.DummyClient(("1.1.1.1", 1))
+        clientB = ForwardingTableTest.DummyClient(("2.2.2.2", 2))
+        connectionId = table.registerConnectionId(clientA)
+        table.addRoom(clientA, clientB)
+
+        tag = ForwardingTable.getConnectionIdTag(connectionId, clientA.udp_hash)
+        data = ForwardingTable.CONNECTION_ID_PREFIX + struct.pack(DataConstants.ULONG_FORMAT, connectionId) + tag + "media"
+        self.assertEquals(ForwardingTable.parseConnectionId(data), connectionId)
+        self.assertEquals(data[ForwardingTable.CONNECTION_ID_HEADER_SIZE:], "media")
+        self.assertIsNone(ForwardingTable.parseConnectionId("\x02media"))
+
+        # Only the client holding the session hash can produce the tag.
+        self.assertTrue(ForwardingTable.isValidConnectionIdTag(data, clientA.connection_id_tag))
+        self.assertFalse(ForwardingTable.isValidConnectionIdTag(data, clientB.connection_id_tag))
+        forged = data[:ForwardingTable.CONNECTION_ID_TAG_OFFSET] + "\x00" * ForwardingTable.CONNECTION_ID_TAG_SIZE + "media"
+        self.assertFalse(ForwardingTable.isValidConnectionIdTag(forged, clientA.connection_id_tag))
+        self.assertIs(table.clients_by_connection_id[connectionId], clientA)
+
+        clientA.udp = ForwardingTableTest.DummyUdp(("3.3.3.3", 3))
+        table.updateClientAddress(clientA)
+        self.assertEquals(table.routes, {("3.3.3.3", 3): ("2.2.2.2", 2), ("2.2.2.2", 2): ("3.3.3.3", 3)})
+        self.assertEquals(table.getConnectionIds(), {connectionId: ("3.3.3.3", 3)})
+
+        table.unregisterConnectionId(clientA)
+        self.assertEquals(len(table.clients_by_connection_id), 0)
+        self.assertIsNone(clientA.connection_id)
+        self.assertIsNone(clientA.connection_id_tag)
+
+    def testConnectionIdPartition(self):
+        table = ForwardingTable()
+        table.setConnectionIdPartition(2, 3)
+        for address in range(100):
+            connectionId = table.registerConnectionId(ForwardingTableTest.DummyClient(("1.1.1.1", address)))
+            self.assertEquals(ForwardingTable.getConnectionIdPartition(connectionId, 3), 2)
+
+    def testAdoptConnectionId(self):
+        table = ForwardingTable()
+        table.setConnectionIdPartition(0, 2)
+        notified = []
+        table.addConnectionIdListener(lambda connectionId, address: notified.append((connectionId, address)))
+
+        # Moved from the shard of the other partition, keeping its ID and tag.
+        clientA = ForwardingTableTest.DummyClient(("1.1.1.1", 1))
+        self.assertTrue(table.adoptConnectionId(clientA, 7))
+        self.assertIs(table.clients_by_connection_id[7], clientA)
+        self.assertEquals(clientA.connection_id_tag, ForwardingTable.getConnectionIdTag(7, clientA.udp_hash))
+        self.assertEquals(notified, [(7, ("1.1.1.1", 1))])
+
+        clientB = ForwardingTableTest.DummyClient(("2.2.2.2", 2))
+        self.assertFalse(table.adoptConnectionId(clientB, 7))
+        self.assertIsNone(clientB.connection_id)
+        self.assertIs(table.clients_by_connection_id[7], clientA)
+
+    def testOfflineClient(self):
+        table = ForwardingTable()
+        clientA = ForwardingTableTest.DummyClient(("1.1.1.1", 1))
+        clientB = ForwardingTableTest.DummyClient(None)
+        clientB.udp = None
+        table.addRoom(clientA, clientB)
+        self.assertEquals(len(table), 0)
@@ -2,6 +2,8 @@ __author__ = 'pryormic'
 
 import math
 
+EARTH_RADIUS_KM = 6373
+
 def distanceBetweenPoints(longitudeA, latitudeA, longitudeB, latitudeB):
     # Convert latitude and longitude to
     # spherical coordinates in radians.
@@ -25,12 +27,13 @@ def distanceBetweenPoints(longitudeA, latitudeA, longitudeB, latitudeB):
 
     cos = (math.sin(phi1)*math.sin(phi2)*math.cos(theta1 - theta2) +
            math.cos(phi1)*math.cos(phi2))
-    arc = math.acos( cos )
+    # Rounding can push identical points just outside the domain of acos.
+    arc = math.acos( max(-1.0, min(1.0, cos)) )
 
     return arc
 
 def distanceBetweenPointsKm(longitudeA, latitudeA, longitudeB, latitudeB):
-    return distanceBetweenPoints(longitudeA, latitudeA, longitudeB, latitudeB) * 6373
+    return distanceBetweenPoints(longitudeA, latitudeA, longitudeB, latitudeB) * EARTH_RADIUS_KM
 
 if __name__ == '__main__':
     print distanceBetweenPointsKm(-0.110755, 51.507761, -0.389731, 51.651498)
@@ -2,25 +2,37 @@ from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet import reactor, protocol, ssl
 from twisted.internet.protocol import ClientFactory, ReconnectingClientFactory
 from byte_buffer import ByteBuffer
-from client import Client
+from client import Client, TcpMessages
 from handshaking import UdpConnectionLinker
 from protocol_client import ClientTcp, ClientUdp
 from threading import RLock;
 from twisted.internet.error import AlreadyCalled, AlreadyCancelled
-from utility import getRemainingTimeOnAction, Throttle, parseLogLevel
+from utility import getRemainingTimeOnAction, Throttle, parseLogLevel, bindUdpSocket
 from house import House
 import logging
 import argparse
+from collections import OrderedDict
 import os
-from stat_tracker import StatTracker
+from stat_tracker import StatTracker, LatencyHistogram
 from analytics import Analytics
 import pymongo
 from database.matching import Matching
 from database.blocking import Blocking
-from database.karma_leveled import KarmaLeveled
+from database.karma_ledger import KarmaLedger
+from database.karma_cache import KarmaCache
 from database.persisted_ids import PersistedIds
+from database.schema import Schema
+from database.async_database import AsyncDatabase
+from database.write_behind import WriteBehind
 from payments import PaymentsEx
 from remote_notification import RemoteNotification
+from relay_worker import RelayWorkerPool, listenReusableUdp
+from batched_udp import isBatchedUdpSupported, listenBatchedUdp
+from forwarding_table import ForwardingTable
+from session_hash import SessionHashSigner
+from logon_admission import LogonAdmission
+from shard_worker import ShardFront
+from timing_wheel import TimingWheel
 
 __author__ = 'pryormic'
 
@@ -36,7 +48,7 @@ sys.setdefaultencoding('utf8')
 #
 # ClientFactory encapsulates the TCP listening socket.
 class Governor(ClientFactory, protocol.DatagramProtocol):
-    def __init__(self, reactor, matchingDatabase, karmaDatabase, persistedIdsDatabase, governorName, remoteNotification):
+    def __init__(self, reactor, matchingDatabase, karmaDatabase, persistedIdsDatabase, governorName, remoteNotification, sessionHashSigner, asyncDatabase, writeBehind, timingWheel):
         # All connected clients.
         self.client_mappings_lock = RLock()
 
@@ -45,27 +57,85 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
         self.clients_by_udp_hash = dict()
         self.clients_by_udp_address = dict()
 
-        self.udp_connection_linker = UdpConnectionLinker(self.clients_by_udp_hash)
+        self.udp_connection_linker = UdpConnectionLinker(self.clients_by_udp_hash, sessionHashSigner)
 
         self.clean_actions_by_udp_hash = dict()
 
         self.reactor = reactor
-        self.house = House(matchingDatabase, self.udp_connection_linker, self.buildClient)
+
+        # Client timeouts and session expiries, kept out of the reactor's timer heap.
+        self.timing_wheel = timingWheel
+        self.house = House(matchingDatabase, self.udp_connection_linker, self.buildClient, asyncDatabase, timingWheel)
+        self.house.startMatchmaking()
+
+        # Source UDP address -> peer UDP address, for relaying without locks or method hops.
+        self.forwarding_routes = self.house.forwarding_table.routes
+        self.clients_by_connection_id = self.house.forwarding_table.clients_by_connection_id
+
+        # Logon stage -> time taken, since last reported.
+        self.logon_latency = OrderedDict((stage, LatencyHistogram()) for stage in Client.LOGON_STAGES)
+
+        # Bounds the logons processed at once, e.g. when clients reconnect en masse after a restart.
+        self.logon_admission = LogonAdmission()
 
         # Track kilobytes per second averaged over last 30 seconds.
         self.kilobyte_per_second_tracker = StatTracker(1,30)
 
+        # Bytes received since the load was last calculated, kept out of the tracker
+        # so that the relay path does not need to take its lock.
+        self.bytes_received = 0
+
         self.governor_name = governorName
         self.karma_database = karmaDatabase
         self.payments_verifier = PaymentsEx(100)
         self.persisted_ids_verifier = persistedIdsDatabase
         self.remote_notification = remoteNotification
+        self.write_behind = writeBehind
 
     # Higher = under more stress, handling more traffic, lower = handling less.
     def getLoad(self):
-        self.kilobyte_per_second_tracker.soft_tick()
+        bytesReceived = self.bytes_received
+        self.bytes_received = 0
+        self.kilobyte_per_second_tracker.tick(float(bytesReceived) / 1024.0)
         return self.kilobyte_per_second_tracker.average_tick_rate
 
+    # Only available when using batched UDP I/O.
+    def reportTransportStatistics(self):
+        try:
+            getTransportStatistics = self.transport.getTransportStatistics
+        except AttributeError:
+            return
+
+        receiveRate, sendRate, droppedCount = getTransportStatistics()
+        logger.info("UDP packets per system call, receiving: [%.2f], sending: [%.2f], dropped: [%d]" % (receiveRate, sendRate, droppedCount))
+
+    # Logons are being turned away or queued for a while, the commander should send new clients elsewhere.
+    def isOverloaded(self):
+        return self.logon_admission.isOverloaded()
+
+    def reportLogonStatistics(self):
+        self.logon_admission.reportMetrics()
+        for stage, histogram in self.logon_latency.iteritems():
+            if histogram.count > 0:
+                logger.info("Logon stage [%s] latency, %s" % (stage, histogram))
+            histogram.reset()
+
+    # Reported on each ping to the commander.
+    def reportStatistics(self):
+        self.reportTransportStatistics()
+        self.reportDatabaseStatistics()
+        self.reportLogonStatistics()
+        self.reportTimerStatistics()
+
+    def reportTimerStatistics(self):
+        self.timing_wheel.reportMetrics()
+
+    def reportDatabaseStatistics(self):
+        self.house.async_database.reportMetrics()
+        self.write_behind.reportMetrics()
+        if self.karma_database.karma_cache is not None:
+            self.karma_database.karma_cache.reportMetrics()
+
     def startedConnecting(self, connector):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug('Started to connect.')
@@ -88,6 +158,7 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Attempt to cleanup UDP address [%s] failed, not yet connected via UDP" % udpClient)
 
+        self.house.forwarding_table.unregisterConnectionId(client)
         self.cleanupClientUdpHash(client, immediate)
 
     def cleanupClientUdpHash(self, client, immediate=False):
@@ -104,7 +175,7 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
                     logger.debug("Scheduled new session expiry for client [%s] in [%s] seconds" % (client, delay))
 
                 if not immediate:
-                    cleanAction = self.reactor.callLater(delay, self._doClientHashCleanup, client)
+                    cleanAction = self.timing_wheel.callLater(delay, self._doClientHashCleanup, client)
                     self.clean_actions_by_udp_hash[client.udp_hash] = cleanAction
                 else:
                     if logger.isEnabledFor(logging.DEBUG):
@@ -115,7 +186,7 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("Reset expiry of [%s] seconds remaining for client [%s] to [%.2f] seconds" % (getRemainingTimeOnAction(cleanAction), client, delay))
                 try:
-                    cleanAction.reset(self, delay)
+                    cleanAction.reset(delay)
                 except AlreadyCalled:
                     if logger.isEnabledFor(logging.DEBUG):
                         logger.debug("Failed to reset, timer already fired for client [%s]" % client)
@@ -174,6 +245,7 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
                             logger.debug("Cleaning up UDP hash [%s] of client [%s]" % (udpHash, client))
 
                         del self.clients_by_udp_hash[udpHash]
+                        self.udp_connection_linker.releaseSession(udpHash)
 
                         # We need to make sure that client data is not left dangling without a UDP hash.
                         self.clientDisconnected(client)
@@ -226,9 +298,96 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
         finally:
             self._unlockClm()
 
+    # Forgets a connected client whose TCP connection is moving to another shard, which holds its session
+    # and room from now on, see Shard.migrateClient. Unlike a disconnect, the connection is left open and
+    # the session is released straight away.
+    def detachClient(self, client):
+        assert isinstance(client, Client)
+
+        if client.timeout_check is not None and client.timeout_check.active():
+            client.timeout_check.cancel()
+
+        if client.has_loaded_relations:
+            self.house.unloadRelations(client)
+            client.has_loaded_relations = False
+
+        client.cancelAcceptingMatchExpiry()
+        client.connection_status = Client.ConnectionStatus.NOT_CONNECTED
+
+        # The connection outlives the client here, its loss must not reach it.
+        client.tcp.parent = None
+
+        self._lockClm()
+        try:
+            if self.clients_by_tcp_address.get(client.tcp.remote_address) is client:
+                del self.clients_by_tcp_address[client.tcp.remote_address]
+
+            if client.udp is not None and self.clients_by_udp_address.get(client.udp.remote_address) is client:
+                del self.clients_by_udp_address[client.udp.remote_address]
+
+            self.house.forwarding_table.unregisterConnectionId(client)
+            self.cancelCleanupClientUdpHash(client)
+
+            if self.clients_by_udp_hash.get(client.udp_hash) is client:
+                del self.clients_by_udp_hash[client.udp_hash]
+                self.udp_connection_linker.releaseSession(client.udp_hash)
+        finally:
+            self._unlockClm()
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Client [%s] detached, its connection is moving to another shard" % client)
+
+    # Takes over the session of a client whose TCP connection another shard has handed to us, see Shard.migrateClient.
+    # The client is still connected from its point of view, so it doesn't log on again, nor link its UDP hash.
+    # It must be held here already, e.g. in a room as an offline client. Returns false if it can't be taken over.
+    def adoptMigratedClient(self, client, udpHash, udpAddress, connectionId, usesConnectionId):
+        assert isinstance(client, Client)
+
+        self._lockClm()
+        try:
+            existingClient = self.clients_by_udp_hash.get(udpHash)
+            if existingClient is None or existingClient.connection_status != Client.ConnectionStatus.NOT_CONNECTED:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Session [%s] of migrated client isn't held by an offline client, can't take it over" % udpHash)
+                return False
+
+            # Clients keep the connection ID they were given, as they aren't told of a new one.
+            if connectionId > 0 and connectionId in self.clients_by_connection_id:
+                return False
+
+            client.udp_hash = udpHash
+            client.login_details = existingClient.login_details
+            client.udp = ClientUdp(udpAddress, self.transport.write)
+
+            if connectionId > 0:
+                self.house.forwarding_table.adoptConnectionId(client, connectionId)
+            client.uses_connection_id = usesConnectionId
+
+            client.consumeMetaState(existingClient)
+            self.clientDisconnected(existingClient)
+            self.house.forwarding_table.unregisterConnectionId(existingClient)
+
+            self.cancelCleanupClientUdpHash(client)
+            self.clients_by_udp_hash[udpHash] = client
+            self.clients_by_udp_address[udpAddress] = client
+        finally:
+            self._unlockClm()
+
+        client.connection_status = Client.ConnectionStatus.CONNECTED
+        client.udp_connection_linker = None
+
+        self.house.loadRelations(client)
+        client.has_loaded_relations = True
+
+        # Rejoins the room which held it.
+        self.house.addToMatchmaking(client)
+
+        logger.info("Client %s migrated from another shard with udp hash: [%s]" % (client.login_details, udpHash))
+        return True
+
     def buildClient(self, tcpCon = None):
         return Client(reactor, tcpCon, self.clientDisconnected, self.udp_connection_linker, self.house,
-                      self.karma_database, self.payments_verifier, self.persisted_ids_verifier, self.remote_notification)
+                      self.karma_database, self.payments_verifier, self.persisted_ids_verifier, self.remote_notification, self.logon_latency, self.logon_admission)
 
     def buildProtocol(self, addr):
         if logger.isEnabledFor(logging.DEBUG):
@@ -254,7 +413,17 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
             logger.debug('Connection failed. Reason:')
 
     def datagramReceived(self, data, remoteAddress):
-        self.kilobyte_per_second_tracker.tick(float(len(data)) / 1024.0)
+        self.bytes_received += len(data)
+
+        if data[:1] == ForwardingTable.CONNECTION_ID_PREFIX:
+            self.datagramReceivedWithConnectionId(data, remoteAddress)
+            return
+
+        # Fast path, client is in a conversation and we have a precomputed route to the other side.
+        peerAddress = self.forwarding_routes.get(remoteAddress)
+        if peerAddress is not None:
+            self.transport.write(data, peerAddress)
+            return
 
         self._lockClm()
         try:
@@ -268,6 +437,54 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
         else:
             knownClient.handleUdpPacket(data)
 
+    # Datagram prefixed with the connection ID we assigned to the client, route by ID so
+    # that a change in the client's address (e.g. 3G to wifi) is picked up immediately.
+    def datagramReceivedWithConnectionId(self, data, remoteAddress):
+        connectionId = ForwardingTable.parseConnectionId(data)
+        client = self.clients_by_connection_id.get(connectionId)
+        if client is None or client.udp is None:
+            self._onMalformed(remoteAddress)
+            return
+
+        if client.udp.remote_address != remoteAddress:
+            # The client's routes only move if the datagram carries its tag, not just its ID.
+            if not ForwardingTable.isValidConnectionIdTag(data, client.connection_id_tag):
+                self._onMalformed(remoteAddress)
+                return
+
+            self.onClientAddressChanged(client, remoteAddress)
+
+        client.uses_connection_id = True
+
+        payload = data[ForwardingTable.CONNECTION_ID_HEADER_SIZE:]
+        peerAddress = self.forwarding_routes.get(remoteAddress)
+        if peerAddress is not None:
+            self.transport.write(payload, peerAddress)
+            return
+
+        client.handleUdpPacket(payload)
+
+    # Move the client to its new UDP address, updating the routes of its room in place.
+    def onClientAddressChanged(self, client, remoteAddress):
+        self._lockClm()
+        try:
+            newUdp = ClientUdp(remoteAddress, self.transport.write)
+            oldUdp = client.udp
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Client UDP routing has changed from [%s] to [%s]" % (oldUdp, newUdp))
+
+            try:
+                del self.clients_by_udp_address[oldUdp.remote_address]
+            except KeyError:
+                pass
+
+            self.clients_by_udp_address[remoteAddress] = client
+            client.udp = newUdp
+
+            self.house.forwarding_table.updateClientAddress(client)
+        finally:
+            self._unlockClm()
+
     @Throttle(1)
     def _onMalformed(self, fromAddress):
         if logger.isEnabledFor(logging.DEBUG):
@@ -287,6 +504,10 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
             self._onMalformed(remoteAddress)
             return
 
+        if not self.udp_connection_linker.isValidHash(theHash):
+            self._onMalformed(remoteAddress)
+            return
+
         registeredClient = self.udp_connection_linker.registerCompletion(theHash, ClientUdp(remoteAddress, self.transport.write))
 
         if registeredClient:
@@ -298,15 +519,16 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
                         logger.debug("Cleaning up existing client before processing reconnect: %s" % existingClient)
                     registeredClient.consumeMetaState(existingClient)
                     self.clientDisconnected(existingClient)
+                    self.house.forwarding_table.unregisterConnectionId(existingClient)
 
                 self.cancelCleanupClientUdpHash(registeredClient)
                 self.clients_by_udp_hash[theHash] = registeredClient
                 self.clients_by_udp_address[remoteAddress] = registeredClient
+                connectionId = self.house.forwarding_table.registerConnectionId(registeredClient)
             finally:
                 self._unlockClm()
 
-            successPing = ByteBuffer()
-            successPing.addUnsignedInteger8(Client.TcpOperationCodes.OP_ACCEPT_UDP)
+            successPing = TcpMessages.ACCEPT_UDP.encode(connectionId)
 
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Sending fully connected ACK")
@@ -322,24 +544,11 @@ class Governor(ClientFactory, protocol.DatagramProtocol):
             # TCP route stays unchanged, so we need to update on the fly.
             client = self.clients_by_udp_hash.get(theHash)
             if client is not None and client.connection_status == Client.ConnectionStatus.CONNECTED and client.udp is not None:
-                self._lockClm()
-                try:
-                    newUdp = ClientUdp(remoteAddress, self.transport.write)
-                    oldUdp = client.udp
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Client UDP routing has changed from [%s] to [%s]" % (oldUdp, newUdp))
-
-                    try:
-                        del self.clients_by_udp_address[oldUdp.remote_address]
-                    except KeyError:
-                        pass
-
-                    self.clients_by_udp_address[remoteAddress] = client
-                    client.udp = newUdp
+                self.onClientAddressChanged(client, remoteAddress)
 
+                # Clients routed by connection ID keep relaying through us, no need to renegotiate the peer to peer route.
+                if not client.uses_connection_id:
                     self.house.readviseNatPunchthrough(client)
-                finally:
-                    self._unlockClm()
 
 
 class CommanderConnection(ReconnectingClientFactory):
@@ -354,9 +563,8 @@ class CommanderConnection(ReconnectingClientFactory):
         SUCCESS = 1
         FAILURE = 2
 
+    # governor is a Governor, or the front process of a sharded governor (ShardFront).
     def __init__(self, commanderHost, commanderPort, ourGovernorTcpPort, ourGovernorUdpPort, governor, analytics):
-        assert isinstance(governor, Governor)
-
         self.governorPacket = ByteBuffer()
         passwordEnvVariable = os.environ['HOLOGRAM_PASSWORD']
         if len(passwordEnvVariable) == 0:
@@ -392,16 +600,22 @@ class CommanderConnection(ReconnectingClientFactory):
             return
 
         load = self.governor.getLoad()
+        isOverloaded = self.governor.isOverloaded()
+        if isOverloaded:
+            logger.warn("Governor is overloaded with logons, advising commander")
 
         # Tell commander how much load we are handling so that it can load balance.
         pingPacket = ByteBuffer()
         pingPacket.addUnsignedInteger(load)
+        pingPacket.addUnsignedInteger8(1 if isOverloaded else 0)
         self.tcp.sendByteBuffer(pingPacket)
         self.schedulePing()
 
+        self.governor.reportStatistics()
+
         # Tell Google analytics how much load we are handling
-        if analytics is not None:
-            analytics.pushEvent(load, "governor_load", "bandwidth", self.governor.governor_name)
+        if self.analytics is not None:
+            self.analytics.pushEvent(load, "governor_load", "bandwidth", self.governor.governor_name)
 
     # Always have one, and only one, ping scheduled.
     def schedulePing(self):
@@ -429,6 +643,35 @@ class CommanderConnection(ReconnectingClientFactory):
         logger.warn("Connection with commander lost, reason [%s]" % reason.getErrorMessage())
         self.retry(connector)
 
+# Connects to the databases and builds a governor which uses them. Also used by each shard of a sharded
+# governor, all of which share its waiting list.
+def buildGovernor(governorName, writeBehindSpool):
+    mongoClient = pymongo.MongoClient("localhost", 27017)
+
+    # Indexes are only ensured here, not on every write.
+    Schema(mongoClient.db).reconcile()
+
+    # Database calls are made from this pool, so that the reactor thread never blocks on them.
+    asyncDatabase = AsyncDatabase(reactor)
+
+    timingWheel = TimingWheel()
+    timingWheel.start(reactor)
+
+    # Skips, blocks, karma and waiting list writes are batched.
+    writeBehind = WriteBehind(mongoClient.db, writeBehindSpool)
+    writeBehind.recover()
+    writeBehind.start(reactor, asyncDatabase)
+
+    blockingDatabase = Blocking(mongoClient.db.blocked, writeBehind=writeBehind)
+    matchHistoryDatabase = Blocking(mongoClient.db.match_decision, expiryTimeSeconds=Matching.MATCH_HISTORY_EXPIRATION_TIME_SECONDS, writeBehind=writeBehind)
+    matchingDatabase = Matching(governorName, mongoClient, blockingDatabase, matchHistoryDatabase, writeBehind=writeBehind)
+    karmaDatabase = KarmaLedger(mongoClient, writeBehind=writeBehind, karmaCache=KarmaCache())
+    persistedIdsDatabase = PersistedIds(mongoClient)
+
+    remoteNotification = RemoteNotification(1000, governorName, production=True)
+    sessionHashSigner = SessionHashSigner(SessionHashSigner.loadSecret(), governorName)
+    return Governor(reactor, matchingDatabase, karmaDatabase, persistedIdsDatabase, governorName, remoteNotification, sessionHashSigner, asyncDatabase, writeBehind, timingWheel)
+
 if __name__ == "__main__":
     # This is what we actually need to code:
     # sub server connects to a central server to register its existence, it waits to be told what port it should bind to.
@@ -452,6 +695,11 @@ if __name__ == "__main__":
     parser.add_argument('--commander_port', help='Commander port to connect to, defaults to 12240', default="12240")
     parser.add_argument('--governor_name', help='Name of this instance, to uniquely identify it in the database')
     parser.add_argument('--log_level', help="ERROR, WARN, INFO or DEBUG", default="INFO")
+    parser.add_argument('--relay_workers', help='Number of additional processes relaying UDP traffic on the same port, defaults to 0', default="0")
+    parser.add_argument('--write_behind_spool', help='File in which database writes are journaled until they are acknowledged, defaults to write_behind.spool', default="write_behind.spool")
+    parser.add_argument('--batched_udp', help='Receive and send datagrams in batches (recvmmsg/sendmmsg)', action='store_true', default=False)
+    parser.add_argument('--shards', help='Number of shard processes to hand clients to, each with its own house, defaults to 0 (clients are handled by this process)', default="0")
+    parser.add_argument('--shard_socket', help='Path of the UNIX socket shards connect to, defaults to hologram_<governor name>.sock', default=None)
     args = parser.parse_args()
 
     logLevel = parseLogLevel(args.log_level)
@@ -461,20 +709,24 @@ if __name__ == "__main__":
     tcpPort = int(args.tcp_port)
     udpPort = int(args.udp_port)
     governorName = args.governor_name
+    relayWorkers = int(args.relay_workers)
+    shards = int(args.shards)
+
+    batchedUdp = args.batched_udp
+    if batchedUdp and not isBatchedUdpSupported():
+        logger.warn("Batched UDP I/O is not supported on this platform, falling back to one system call per datagram")
+        batchedUdp = False
 
     logger.info("GOVERNOR [%s] STARTED" % governorName)
 
     commanderHost = args.commander_host
     commanderPort = int(args.commander_port)
 
-    mongoClient = pymongo.MongoClient("localhost", 27017)
-    blockingDatabase = Blocking(mongoClient.db.blocked)
-    matchHistoryDatabase = Blocking(mongoClient.db.match_decision, expiryTimeSeconds=60 * 60)
-    matchingDatabase = Matching(governorName, mongoClient, blockingDatabase, matchHistoryDatabase)
-    karmaDatabase = KarmaLeveled(mongoClient)
-    persistedIdsDatabase = PersistedIds(mongoClient)
-    remoteNotification = RemoteNotification(1000, governorName, production=True)
-    server = Governor(reactor, matchingDatabase, karmaDatabase, persistedIdsDatabase, governorName, remoteNotification)
+    if shards > 0:
+        # Front process, clients are handed to shard processes which each run a governor.
+        server = ShardFront(reactor, governorName, shards, args.shard_socket, args.log_level, args.write_behind_spool)
+    else:
+        server = buildGovernor(governorName, args.write_behind_spool)
 
     analytics = Analytics(100, governorName)
 
@@ -487,5 +739,27 @@ if __name__ == "__main__":
     endpoint.listen(server)
 
     # UDP server.
-    reactor.listenUDP(udpPort, server)
+    if shards > 0:
+        if relayWorkers > 0:
+            # Workers relay the rooms of every shard, see ShardRelay.
+            logger.info("Relaying UDP traffic of shards with %d additional worker processes" % relayWorkers)
+            listenReusableUdp(udpPort, server.relay, batched=batchedUdp)
+            relayWorkerPool = RelayWorkerPool(reactor, server, server.relay, server.session_hash_signer, udpPort, relayWorkers, args.log_level, batchedUdp)
+            reactor.callWhenRunning(relayWorkerPool.start)
+        elif batchedUdp:
+            listenBatchedUdp(bindUdpSocket(udpPort), server.relay)
+        else:
+            reactor.listenUDP(udpPort, server.relay)
+        reactor.callWhenRunning(server.start)
+    elif relayWorkers > 0:
+        # Share the port with relay worker processes, the kernel spreads traffic between us.
+        logger.info("Relaying UDP traffic with %d additional worker processes" % relayWorkers)
+        listenReusableUdp(udpPort, server, batched=batchedUdp)
+        relayWorkerPool = RelayWorkerPool(reactor, server, server.house.forwarding_table, server.udp_connection_linker.session_hash_signer,
+                                          udpPort, relayWorkers, args.log_level, batchedUdp)
+        reactor.callWhenRunning(relayWorkerPool.start)
+    elif batchedUdp:
+        listenBatchedUdp(bindUdpSocket(udpPort), server)
+    else:
+        reactor.listenUDP(udpPort, server)
     reactor.run()
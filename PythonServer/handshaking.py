@@ -1,6 +1,6 @@
-import uuid
 import logging
 from client import Client
+from session_hash import SessionHashSigner
 
 __author__ = 'pryormic'
 
@@ -30,11 +30,41 @@ class UdpConnectionLink(object):
 class UdpConnectionLinker(object):
     DELAY = 20
 
-    def __init__(self, clientsByUdpHash):
+    def __init__(self, clientsByUdpHash, sessionHashSigner):
         super(UdpConnectionLinker, self).__init__()
+        assert isinstance(sessionHashSigner, SessionHashSigner)
+
         self.waiting_hashes = dict()
         self.clients_by_udp_hash = clientsByUdpHash
+        self.session_hash_signer = sessionHashSigner
+
+        self.session_listeners = list()
+
+    # Listeners are called with (UDP hash, is held) when we start holding a session, i.e. have a client waiting
+    # for or connected with its hash, and when we stop. A sharded governor's front process routes a session's
+    # connections and datagrams to the shard holding it, see ShardFront.
+    def addSessionListener(self, listenerFunc):
+        self.session_listeners.append(listenerFunc)
+
+    def _notifySessionListeners(self, udpHash, isHeld):
+        for listenerFunc in self.session_listeners:
+            listenerFunc(udpHash, isHeld)
 
+    def isSessionHeld(self, udpHash):
+        return udpHash in self.clients_by_udp_hash or UdpConnectionLink(udpHash, None) in self.waiting_hashes
+
+    def getHeldSessions(self):
+        return set(self.clients_by_udp_hash.iterkeys()) | set(link.udp_hash for link in self.waiting_hashes.iterkeys())
+
+    # Offline clients are held by their UDP hash while matched, so that they can reconnect to the room.
+    def holdSession(self, udpHash, client):
+        self.clients_by_udp_hash[udpHash] = client
+        self._notifySessionListeners(udpHash, True)
+
+    # Must be called once the session's client has been removed from clients_by_udp_hash.
+    def releaseSession(self, udpHash):
+        if not self.isSessionHeld(udpHash):
+            self._notifySessionListeners(udpHash, False)
 
     def registerInterest(self, udpHash, waitingClient):
         obj = UdpConnectionLink(udpHash, waitingClient)
@@ -44,14 +74,15 @@ class UdpConnectionLinker(object):
             return False
 
         self.waiting_hashes[obj] = obj
+        self._notifySessionListeners(udpHash, True)
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Interest registered in UDP hash [%s]" % udpHash)
         return True
 
-    def generateHash(self):
+    def generateHash(self, persistedId):
         # Generate a truly unique hash.
         while True:
-            newHash = str(uuid.uuid4())
+            newHash = self.session_hash_signer.generateHash(persistedId)
             if newHash not in self.waiting_hashes:
                 return newHash
 
@@ -60,14 +91,14 @@ class UdpConnectionLinker(object):
                 logger.debug("Hash clash found with hash [%s], generating new hash" % newHash)
 
 
-    def registerInterestGenerated(self, waitingClient, newHash = None):
+    def registerInterestGenerated(self, waitingClient, persistedId, newHash = None):
         provided = newHash is not None
 
         while True:
             # it is possible for a race condition to occur where same hash generated at
             # similar time and attempted to be added. Allowing for failure here solves that problem.
             if newHash is None:
-                newHash = self.generateHash()
+                newHash = self.generateHash(persistedId)
             success = self.registerInterest(newHash, waitingClient)
             if success or provided:
                 return newHash
@@ -77,6 +108,7 @@ class UdpConnectionLinker(object):
     def registerPrematureCompletion(self, udpHash, waitingClient):
         try:
             del self.waiting_hashes[UdpConnectionLink(udpHash, waitingClient)]
+            self.releaseSession(udpHash)
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("UDP connection with hash [%s] was prematurely aborted" % udpHash)
         except KeyError:
@@ -84,6 +116,10 @@ class UdpConnectionLinker(object):
                 logger.debug("UDP hash not found in waiting hashes, no need to remove [%s]" % udpHash)
 
 
+    # Checked before any lookup, so that forged hashes can be discarded cheaply, by any process.
+    def isValidHash(self, udpHash):
+        return self.session_hash_signer.verifyHash(udpHash, checkExpiry=False)
+
     def registerCompletion(self, udpHash, clientUdp):
         try:
             hashObj = self.waiting_hashes[UdpConnectionLink(udpHash, None)]
@@ -1,23 +1,43 @@
 __author__ = 'pryormic'
-from client import Client
+from client import Client, TcpMessages
 from byte_buffer import ByteBuffer
 from threading import RLock
 import logging
 from database.matching import Matching
-from utility import getRemainingTimeOnAction, getEpoch
+from database.async_database import AsyncDatabase
+from utility import getRemainingTimeOnAction
 from geography import distanceBetweenPointsKm
 import math
-from database.karma_leveled import KarmaLeveled
 from handshaking import UdpConnectionLinker
+from forwarding_table import ForwardingTable
+from twisted.internet import task
+from collections import OrderedDict
+from spatial_index import SpatialIndex
+from timing_wheel import TimingWheel
 import pickle
 
 logger = logging.getLogger(__name__)
 
 # A house has lots of rooms in it, each room has two participants in it (the video call).
 class House:
-    def __init__(self, matchingDatabase, udpConnectionLinker, buildOfflineClientFunc):
+    # Seconds between matchmaking passes over all clients looking for a match.
+    MATCHMAKING_INTERVAL = 0.5
+
+    # Offline clients considered per database search.
+    MAX_OFFLINE_CANDIDATES = 10
+
+    # Seconds before loading a client's relations again after failing to, see loadRelations.
+    RELATIONS_RETRY_SECONDS = 5
+
+    # Nearest waiting clients taken from the waiting index for each client in a matchmaking pass, they
+    # are checked for blocks and skips outside of the lock.
+    MAX_ONLINE_CANDIDATES = 20
+
+    def __init__(self, matchingDatabase, udpConnectionLinker, buildOfflineClientFunc, asyncDatabase, timingWheel):
         assert isinstance(matchingDatabase, Matching)
         assert isinstance(udpConnectionLinker, UdpConnectionLinker)
+        assert isinstance(asyncDatabase, AsyncDatabase)
+        assert isinstance(timingWheel, TimingWheel)
 
         # When clients are offline, and matched with somebody, we need to add
         # them to the clients by UDP hash map, which is contained within this object.
@@ -38,28 +58,129 @@ class House:
         # Client -> Unique key (stored in DB)
         self.waiting_keys_by_client = dict()
 
-        self.abort_nat_punchthrough_packet = ByteBuffer()
-        self.abort_nat_punchthrough_packet.addUnsignedInteger(Client.TcpOperationCodes.OP_NAT_PUNCHTHROUGH_CLIENT_DISCONNECT)
+        # Waiting clients by location, bucketed by (gender, gender wanted), so that
+        # online matches are found without querying the database.
+        self.waiting_index = SpatialIndex()
 
-        self.house_lock = RLock()
+        self.abort_nat_punchthrough_packet = TcpMessages.NAT_PUNCHTHROUGH_CLIENT_DISCONNECT.encode()
 
-        self.disconnected_temporary = ByteBuffer()
-        self.disconnected_temporary.addUnsignedInteger(Client.TcpOperationCodes.OP_TEMP_DISCONNECT)
+        self.house_lock = RLock()
 
-        self.disconnected_permanent = ByteBuffer()
-        self.disconnected_permanent.addUnsignedInteger(Client.TcpOperationCodes.OP_PERM_DISCONNECT)
+        # UDP routes of matched rooms, read by the governor's relay fast path.
+        self.forwarding_table = ForwardingTable()
 
-        self.disconnected_skip = ByteBuffer()
-        self.disconnected_skip.addUnsignedInteger(Client.TcpOperationCodes.OP_SKIPPED_DISCONNECT)
+        self.disconnected_temporary = TcpMessages.TEMP_DISCONNECT.encode()
+        self.disconnected_permanent = TcpMessages.PERM_DISCONNECT_ADVICE.encode()
+        self.disconnected_skip = TcpMessages.SKIPPED_DISCONNECT.encode()
 
         self.matchingDatabase = matchingDatabase
 
+        # All database calls are made from here, off the reactor thread.
+        self.async_database = asyncDatabase
+
+        # Timers of all clients, and the time cached at its last tick.
+        self.timing_wheel = timingWheel
+
+        # Clients with a search for offline matches in progress.
+        self.offline_searches = set()
+
+        # Clients connected via UDP, which are matched (or reuse their old room) by a single matchmaking pass.
+        # Client -> Client, in order of joining, so that clients waiting longest win ties between equally near pairs.
+        self.matchmaking_clients = OrderedDict()
+        self.matchmaker = task.LoopingCall(self.matchmake)
+
+        # Matches our waiting clients with those of the other shards of a sharded governor, see ShardMatchmaker.
+        self.remote_matchmaker = None
+
+    def startMatchmaking(self):
+        self.matchmaker.start(House.MATCHMAKING_INTERVAL, now=False)
+
+    def addToMatchmaking(self, client):
+        self.house_lock.acquire()
+        try:
+            # Reconnected clients are equal to their old client, replace the key as well as the value.
+            self.matchmaking_clients.pop(client, None)
+            self.matchmaking_clients[client] = client
+        finally:
+            self.house_lock.release()
+
+    # Pairs up all clients looking for a match in one pass.
+    #
+    # Clients can be matched once their block and skip relations have been loaded, see loadRelations.
+    # Every client looking for a match is put in the waiting index, and the candidate pairs are built once from
+    # the nearest waiting clients of each. Pairs which blocks or skips rule out are dropped, and the rest are
+    # assigned greedily, nearest pair first, without any database queries. Clients left without a match are
+    # offered to the waiting clients of other shards if sharded, otherwise they search the database for offline clients.
+    def matchmake(self):
+        self.house_lock.acquire()
+        try:
+            clients = self.matchmaking_clients.values()
+        finally:
+            self.house_lock.release()
+
+        searchingClients = []
+        for client in clients:
+            try:
+                if self.aquireMatch(client):
+                    searchingClients.append(client)
+            except Exception as e:
+                logger.error("Failed to matchmake client [%s]: %s" % (client, e), exc_info=True)
+
+        if len(searchingClients) == 0:
+            return
+
+        self.house_lock.acquire()
+        try:
+            searchingClients = [client for client in searchingClients if self._isLookingForMatch(client) and self.matchingDatabase.areRelationsLoaded(client)]
+            for client in searchingClients:
+                self._addToWaitingList(client)
+
+            pairs = self.findOnlinePairs(searchingClients)
+        finally:
+            self.house_lock.release()
+
+        # Avoid recently skipped clients, and blocked clients.
+        pairs = [(distance, clientA, clientB) for distance, clientA, clientB in pairs if clientA.shouldMatch(clientB)]
+
+        matchedClients = set()
+        self.house_lock.acquire()
+        try:
+            for distance, clientA, clientB in pairs:
+                if clientA in matchedClients or clientB in matchedClients:
+                    continue
+
+                # Either client may have moved on while blocks and skips were checked.
+                if not self._isWaiting(clientA) or not self._isWaiting(clientB):
+                    continue
+
+                self.takeRoom(clientA, clientB)
+                matchedClients.add(clientA)
+                matchedClients.add(clientB)
+        finally:
+            self.house_lock.release()
+
+        for client in searchingClients:
+            if client in matchedClients:
+                continue
+
+            try:
+                if self.remote_matchmaker is not None and self.remote_matchmaker.offerMatch(client):
+                    continue
+
+                self.searchOffline(client)
+            except Exception as e:
+                logger.error("Failed to search for offline match for client [%s]: %s" % (client, e), exc_info=True)
+
     def takeRoom(self, clientA, clientB):
         self.house_lock.acquire()
         try:
             self._removeFromWaitingList(clientA)
             self._removeFromWaitingList(clientB)
 
+            # Media is only relayed once both sides accept, drop anything left over from a previous room.
+            self.forwarding_table.removeClient(clientA)
+            self.forwarding_table.removeClient(clientB)
+
             self.room_participant[clientA] = clientB
             self.room_participant[clientB] = clientA
 
@@ -134,6 +255,11 @@ class House:
     def adviseNatPunchthrough(self, clientA, clientB):
         self.mutualAdvise(clientA, clientB, Client.adviseNatPunchthrough)
 
+        # Both clients are now in a conversation, or have changed UDP address while in one,
+        # so media can be relayed directly between their current addresses.
+        if clientA.state == Client.State.MATCHED and clientB.state == Client.State.MATCHED:
+            self.forwarding_table.addRoom(clientA, clientB)
+
     # reconnectingClient is true if one of the clients reconnected, and that's why it was resent match details.
     def adviseMatchDetails(self, clientA, clientB, reconnectingClient = False):
         distance = self.getDistance(clientA, clientB)
@@ -174,6 +300,9 @@ class House:
             if clientB is not None:
                 # Possible that client reconnected before this socket disconnected, so do not clean up the new connection.
                 realClient = self.room_participant.get(clientB)
+
+            if realClient is not None and client is realClient:
+                self.forwarding_table.removeClient(client)
         finally:
             self.house_lock.release()
 
@@ -191,12 +320,16 @@ class House:
             if client in self.waiting_keys_by_client:
                 del self.waiting_keys_by_client[client]
                 del self.waiting_clients_by_key[client.login_details.unique_id]
+                self.waiting_index.remove(client)
+
+                if self.remote_matchmaker is not None:
+                    self.remote_matchmaker.onWaitingChange(client, False)
 
                 if not client.should_notify_on_match_accept or removeOfflineFromDatabase:
-                    self.matchingDatabase.removeMatch(client)
+                    self.removeMatch(client)
             else:
                 if removeOfflineFromDatabase:
-                    self.matchingDatabase.removeMatch(client)
+                    self.removeMatch(client)
         finally:
             self.house_lock.release()
 
@@ -217,6 +350,9 @@ class House:
             del self.room_participant[client]
             del self.room_participant[clientB]
 
+            self.forwarding_table.removeClient(client)
+            self.forwarding_table.removeClient(clientB)
+
             self.mutualAdvise(client, clientB, Client.onRoomClosure)
 
             self.adviseAbortNatPunchthrough(clientB)
@@ -234,7 +370,7 @@ class House:
             # we need to put it back into the waiting list.
             if clientB.connection_status != Client.ConnectionStatus.CONNECTED and clientB.should_notify_on_match_accept:
                 clientB.transitionState(None, Client.State.MATCHING)
-                self.matchingDatabase.pushWaiting(clientB)
+                self.pushWaiting(clientB)
 
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Permanent closure of session between client [%s] and [%s] due to client [%s] leaving the room" % (client, clientB, client))
@@ -252,54 +388,45 @@ class House:
                 return
 
             client.should_notify_on_match_accept = True
-            self.matchingDatabase.pushWaiting(client)
+            self.pushWaiting(client)
         finally:
             self.house_lock.release()
 
-    def attemptTakeRoom(self, client):
-        def onFailure():
-            if client not in self.waiting_keys_by_client:
-                key = client.login_details.unique_id
-                self.waiting_clients_by_key[key] = client
-                self.waiting_keys_by_client[client] = key
+    # Must be called with the house lock held.
+    def _addToWaitingList(self, client):
+        if client in self.waiting_keys_by_client:
+            return
 
-                self.matchingDatabase.pushWaiting(client)
+        key = client.login_details.unique_id
+        self.waiting_clients_by_key[key] = client
+        self.waiting_keys_by_client[client] = key
+        self.waiting_index.add(client, self._getWaitingIndexBucket(client), client.login_details.longitude, client.login_details.latitude)
 
-        # A client which is not connected should never be able to take a room.
-        # This covers the edge case of a temporarily disconnected session where the connected party
-        # skips, this triggers an attemptTakeRoom call on the disconnected party.
-        if client.connection_status != Client.ConnectionStatus.CONNECTED:
-            return
+        if self.remote_matchmaker is not None:
+            self.remote_matchmaker.onWaitingChange(client, True)
 
-        client.state = Client.State.MATCHING
+        # Only offline clients are matched via the database, online clients are found in the waiting index.
+        if client.should_notify_on_match_accept:
+            self.pushWaiting(client)
 
+    # Each client runs one query for offline clients initially and then repeats
+    # every two seconds, the result arrives in a later reactor iteration.
+    def searchOffline(self, client):
         self.house_lock.acquire()
         try:
-            # Can't take more than one room at a time.
-            if client in self.room_participant or client.waiting_for_rating_task is not None:
+            if not self._isLookingForMatch(client):
                 return
 
-            # Each client runs one query initially and then repeats
-            # every two seconds.
-            doQuery = client.house_match_timer is None or getEpoch() - client.house_match_timer > 2
-
-            if doQuery:
-                client.house_match_timer = getEpoch()
-
-                try:
-                    clientMatch = self.matchingDatabase.findMatch(client, lambda clientDatabaseResultMatch : self.buildAndVerifyClientFromDatabaseResult(client, clientDatabaseResultMatch))
-                except ValueError as e:
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Bad database query attempt [%s], forcefully disconnecting client: [%s]" % (e, client))
-                    client.closeConnection()
-                    return
+            if client in self.offline_searches or (client.house_match_timer is not None and self.timing_wheel.now - client.house_match_timer <= 2):
+                return
 
-                # If we can't immediately find a match then add it to the waiting list.
-                if clientMatch is None:
-                    onFailure()
-                    return
+            client.house_match_timer = self.timing_wheel.now
+            self.offline_searches.add(client)
 
-                self.takeRoom(client, clientMatch)
+            search = self.async_database.run(self._loadOfflineCandidates, client)
+            search.addCallback(self._onOfflineCandidates, client)
+            search.addErrback(self._onOfflineSearchFailure, client)
+            search.addBoth(self._onOfflineSearchComplete, client)
         finally:
             self.house_lock.release()
 
@@ -313,20 +440,23 @@ class House:
         finally:
             self.house_lock.release()
 
+    # Reuses the old room of a reconnected client, returns true if the client is looking for a match.
     def aquireMatch(self, client):
         if client.connection_status != Client.ConnectionStatus.CONNECTED:
-            if client.connection_status == Client.ConnectionStatus.NOT_CONNECTED:
-                client.client_matcher.stop()
+            if client.connection_status == Client.ConnectionStatus.NOT_CONNECTED and self.matchmaking_clients.get(client) is client:
+                del self.matchmaking_clients[client]
 
-            return
+            return False
 
+        isSearching = False
         self.house_lock.acquire()
         try:
             if client not in self.room_participant:
                 if client.state != Client.State.MATCHING and client.state != Client.State.MATCHED:
-                    return
+                    return False
 
-                clientMatch = self.attemptTakeRoom(client)
+                client.state = Client.State.MATCHING
+                isSearching = True
             else:
                 clientMatch = self.room_participant[client]
                 clientOld = self.room_participant[clientMatch]
@@ -368,6 +498,8 @@ class House:
         finally:
             self.house_lock.release()
 
+        return isSearching
+
     def handleUdpPacket(self, client, packet = None):
         if client.connection_status == Client.ConnectionStatus.CONNECTED and client.state != Client.State.MATCHED:
             return
@@ -384,67 +516,209 @@ class House:
             # Send to client that we are matched with.
             clientMatch.udp.sendRawBuffer(packet)
 
-    def buildAndVerifyClientFromDatabaseResult(self, client, clientDatabaseResultMatch):
-        clientMatch = self.buildClientFromDatabaseResult(clientDatabaseResultMatch)
+    # Waiting clients are indexed after their gender wanted has been normalised, see Matching.getGenderCriteria.
+    @staticmethod
+    def _getWaitingIndexBucket(client):
+        genderWanted, matchWithGenderWanted = Matching.getGenderCriteria(client.login_details)
+        return client.login_details.gender, genderWanted
+
+    # Buckets of a waiting index holding clients which the client could match with.
+    @staticmethod
+    def _getCandidateBuckets(client, buckets):
+        genderWanted, matchWithGenderWanted = Matching.getGenderCriteria(client.login_details)
+        return [(gender, otherGenderWanted) for gender, otherGenderWanted in buckets
+                if otherGenderWanted in matchWithGenderWanted and (genderWanted == 3 or gender == genderWanted)]
+
+    # Candidate pairs of the clients, which are in the waiting index, with up to MAX_ONLINE_CANDIDATES of the nearest
+    # waiting clients of each that both would match with, as (distance, client, candidate) nearest first.
+    # Blocks and skips are not checked here.
+    def findOnlinePairs(self, clients):
+        bucketsByClient = dict((client, set(House._getCandidateBuckets(client, self.waiting_index.cells_by_bucket.keys()))) for client in clients)
+
+        # (client, candidate) -> distance, each pair once whichever client found it, in order of finding.
+        distancesByPair = OrderedDict()
+        for client in clients:
+            loginDetails = client.login_details
+            bucket = House._getWaitingIndexBucket(client)
+
+            candidateCount = 0
+            for clientMatch, distance in self.waiting_index.iterateNearest(loginDetails.longitude, loginDetails.latitude, bucketsByClient[client]):
+                # Same person on a different connection.
+                if clientMatch is client or clientMatch.login_details.persisted_unique_id == loginDetails.persisted_unique_id:
+                    continue
+
+                # Clients in the index are all looking for a match, and so in this pass.
+                matchBuckets = bucketsByClient.get(clientMatch)
+                if matchBuckets is None or bucket not in matchBuckets:
+                    continue
+
+                if (clientMatch, client) not in distancesByPair:
+                    distancesByPair[(client, clientMatch)] = distance
+
+                candidateCount += 1
+                if candidateCount >= House.MAX_ONLINE_CANDIDATES:
+                    break
+
+        pairs = [(distance, client, clientMatch) for (client, clientMatch), distance in distancesByPair.iteritems()]
+        pairs.sort(key=lambda pair: pair[0])
+        return pairs
+
+    # True if the client is still in the waiting list, and so can be matched.
+    def _isWaiting(self, client):
+        return self.waiting_clients_by_key.get(client.login_details.unique_id) is client and client.state == Client.State.MATCHING and \
+               client not in self.room_participant
+
+    # Runs on a database thread, returns offline clients which the client could be matched with, nearest first.
+    def _loadOfflineCandidates(self, client):
+        synthClients = []
+        for databaseResultMatch in self.matchingDatabase.findOfflineCandidates(client, House.MAX_OFFLINE_CANDIDATES):
+            # Online clients have already been considered via the waiting index, including those of other shards.
+            if databaseResultMatch['unique_id'] in self.waiting_clients_by_key:
+                continue
+            if self.remote_matchmaker is not None and self.remote_matchmaker.isWaitingRemotely(databaseResultMatch['unique_id']):
+                continue
+
+            # We can tolerate an offline client, if we intend on notifying them.
+            synthClient = self.matchingDatabase.synthesizeClient(databaseResultMatch, self.build_offline_client_func)
+            assert isinstance(synthClient, Client)
+            synthClients.append(synthClient)
+
+        if len(synthClients) == 0:
+            return synthClients
+
+        # Karma of all candidates in one query.
+        karmaById = client.karma_database.getKarmaAndBanOfClients(synthClients)
+
+        candidates = []
+        for synthClient in synthClients:
+            karma, banMagnitude, banTime = karmaById[synthClient.login_details.persisted_unique_id]
+            if banTime is not None:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Offline client [%s] is banned, removing" % synthClient)
+
+                logger.info("Offline client %s is banned" % synthClient.login_details)
+                self.matchingDatabase.removeMatch(synthClient)
+                continue
+
+            synthClient.karma_rating = karma
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Offline client [%s] loaded karma of %d" % (synthClient, synthClient.karma_rating))
 
-        # Avoid recently skipped clients, and blocked clients.
-        if clientMatch is not None and client is not clientMatch and client.shouldMatch(clientMatch):
-            return clientMatch
-        else:
-            return None
+            candidates.append(synthClient)
 
-    def buildClientFromDatabaseResult(self, databaseResultMatch):
-        key = databaseResultMatch['unique_id']
-        clientMatch = self.waiting_clients_by_key.get(key)
+        return candidates
 
-        if clientMatch is not None:
-            return clientMatch
+    def _onOfflineCandidates(self, candidates, client):
+        return self._tryOfflineCandidates(list(candidates), client)
 
-        # If the match is offline.
-        # ***** Here if notify enabled on the record, we synthesize a client out of that record.
+    # Loads the profile of the first suitable candidate, the rest are tried in turn if it can't be matched after all.
+    # Returns a Deferred which fires once done, so that the client doesn't search again in the meantime.
+    def _tryOfflineCandidates(self, candidates, client):
+        while len(candidates) > 0:
+            if not self._isLookingForMatch(client):
+                return
 
-        shouldNotify = databaseResultMatch.get('should_notify')
-        if not shouldNotify:
-            # We don't tolerate an offline client here, because we're not going notify them.
-            # So this must be because of a server restart, so clear that client out.
-            self.matchingDatabase.removeMatchById(databaseResultMatch['_id'])
-            logger.warn("Client in DB not found in waiting list, database inconsistency detected, removing key from database: " + key + ", and retrying")
-            return None
+            synthClient = candidates.pop(0)
 
-        # We can tolerate an offline client, if we intend on notifying them.
-        synthClient = self.matchingDatabase.synthesizeClient(databaseResultMatch, self.build_offline_client_func)
-        assert isinstance(synthClient, Client)
+            # Allow client to reconnect and takeover this session.
+            # If something there already, then maybe client recently connected and will soon
+            # update this record.
+            #
+            # Basically prevents a race condition.
+            clientMatch = self.udp_connection_linker.clients_by_udp_hash.get(synthClient.udp_hash, synthClient)
 
-        banMagnitude, banTime = synthClient.karma_database.getBanMagnitudeAndExpirationTime(synthClient)
-        if banTime is not None:
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Offline client [%s] is banned, removing" % synthClient)
+            # Avoid recently skipped clients, and blocked clients.
+            if clientMatch is client or not client.shouldMatch(clientMatch):
+                continue
 
-            logger.info("Offline client %s is banned" % synthClient.login_details)
-            self._removeFromWaitingList(synthClient,True)
-            return None
+            # Only the candidate we picked needs its full profile.
+            profileLoaded = self.async_database.run(self.matchingDatabase.loadProfile, clientMatch)
+            profileLoaded.addCallback(self._onOfflineProfileLoaded, client, clientMatch, candidates)
+            return profileLoaded
 
-        synthClient.karma_rating = synthClient.karma_database.getKarma(synthClient)
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("Offline client [%s] loaded karma of %d" % (synthClient, synthClient.karma_rating))
-
-        # Allow client to reconnect and takeover this session.
-        # If something there already, then maybe client recently connected and will soon
-        # update this record.
-        #
-        # Basically prevents a race condition.
-        synthClientDup = self.udp_connection_linker.clients_by_udp_hash.get(synthClient.udp_hash)
-        if synthClientDup is not None:
-            return synthClientDup
+    def _onOfflineProfileLoaded(self, isLoaded, client, clientMatch, candidates):
+        if not isLoaded:
+            logger.warn("Profile of offline client [%s] could not be loaded, record no longer exists" % clientMatch)
+            return self._tryOfflineCandidates(candidates, client)
+
+        # Either client may have moved on while the profile was loading.
+        if not client.shouldMatch(clientMatch):
+            return self._tryOfflineCandidates(candidates, client)
+
+        self.house_lock.acquire()
+        try:
+            if not self._isLookingForMatch(client):
+                return
+
+            isAvailable = clientMatch.state == Client.State.MATCHING and clientMatch not in self.room_participant
+            if isAvailable:
+                self.takeRoom(client, clientMatch)
+        finally:
+            self.house_lock.release()
+
+        if not isAvailable:
+            return self._tryOfflineCandidates(candidates, client)
+
+    def _onOfflineSearchFailure(self, failure, client):
+        if failure.check(ValueError):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Bad database query attempt [%s], forcefully disconnecting client: [%s]" % (failure.getErrorMessage(), client))
+            client.closeConnection()
         else:
-            return synthClient
+            logger.error("Failed to search for offline match for client [%s]: %s" % (client, failure.getErrorMessage()))
+
+    def _onOfflineSearchComplete(self, result, client):
+        self.offline_searches.discard(client)
+        return result
+
+    def _isLookingForMatch(self, client):
+        return client.connection_status == Client.ConnectionStatus.CONNECTED and client.state == Client.State.MATCHING and \
+               client not in self.room_participant and client.waiting_for_rating_task is None
+
+    # Database writes are made in the background, in order per client.
+    def _getDatabaseKey(self, client):
+        return client.login_details.persisted_unique_id
 
+    def pushWaiting(self, client):
+        self.async_database.runInBackground(self._getDatabaseKey(client), self.matchingDatabase.pushWaiting, client)
 
+    def removeMatch(self, client):
+        self.async_database.runInBackground(self._getDatabaseKey(client), self.matchingDatabase.removeMatch, client)
+
+    # Clients are not matched until their relations are loaded, so loading is retried while they stay connected.
+    def loadRelations(self, client):
+        loaded = self.async_database.runSerialized(self._getDatabaseKey(client), self.matchingDatabase.loadRelations, client)
+        loaded.addErrback(self._onLoadRelationsFailure, client)
+
+    def _reloadRelations(self, client):
+        # Client has disconnected since, see Client.onTcpSocketDisconnect.
+        if not client.has_loaded_relations:
+            return
+
+        loaded = self.async_database.runSerialized(self._getDatabaseKey(client), self.matchingDatabase.reloadRelations, client)
+        loaded.addErrback(self._onLoadRelationsFailure, client)
+
+    def _onLoadRelationsFailure(self, failure, client):
+        logger.warn("Failed to load relations of client [%s], retrying in %d seconds: %s" % (client, House.RELATIONS_RETRY_SECONDS, failure.getErrorMessage()))
+        self.timing_wheel.callLater(House.RELATIONS_RETRY_SECONDS, self._reloadRelations, client)
+
+    def unloadRelations(self, client):
+        self.async_database.runInBackground(self._getDatabaseKey(client), self.matchingDatabase.unloadRelations, client)
+
+    # Loaded relations are updated immediately, so that the clients are not matched again before the write completes.
     def pushBlock(self, blockerClient, blockedClient):
-        self.matchingDatabase.pushBlock(blockerClient, blockedClient)
+        if blockerClient is None or blockedClient is None:
+            return
+
+        self.matchingDatabase.cacheBlock(blockerClient, blockedClient)
+        self.async_database.runInBackground(self._getDatabaseKey(blockerClient), self.matchingDatabase.pushBlock, blockerClient, blockedClient)
 
     def pushSkip(self, skipperClient, skippedClient):
-        self.matchingDatabase.pushSkip(skipperClient, skippedClient)
+        if skipperClient is None or skippedClient is None:
+            return
+
+        self.matchingDatabase.cacheSkip(skipperClient, skippedClient)
+        self.async_database.runInBackground(self._getDatabaseKey(skipperClient), self.matchingDatabase.pushSkip, skipperClient, skippedClient)
 
     def didRecentlySkip(self, skipperClient, skippedClient):
         return self.matchingDatabase.didRecentlySkip(skipperClient, skippedClient)
@@ -0,0 +1,229 @@
+import logging
+import random
+import time
+import unittest
+from collections import deque
+from stat_tracker import PeriodMetrics
+
+logger = logging.getLogger(__name__)
+
+# Limits how many logons are processed at once, so that a reconnect storm (e.g. after a restart or network blip)
+# doesn't flood the database thread pool and starve the clients already connected.
+#
+# Logons beyond the limit wait in a bounded queue, reconnects (those presenting a session hash) ahead of fresh logons,
+# as they are cheap to serve and their conversations are waiting on them. Each source address is also rate limited
+# with a token bucket. Logons which can't be queued are rejected straight away, telling the client when to retry.
+#
+# Must be used from the reactor thread.
+class LogonAdmission(object):
+    # Logons having their database lookups made at once.
+    MAX_IN_PROGRESS = 64
+
+    MAX_QUEUED = 1000
+
+    # Per source address, sustained logons per second and the burst allowed above that. Generous
+    # because many clients can share an address behind carrier NAT.
+    SOURCE_RATE_PER_SECOND = 2.0
+    SOURCE_BURST = 20
+
+    # Retries are spread between this and twice it, so that rejected clients don't all come back at once.
+    RETRY_AFTER_MS = 2000
+
+    # Bucket state is forgotten for sources which are idle, once we hold this many.
+    MAX_SOURCES = 10000
+
+    def __init__(self, maxInProgress=MAX_IN_PROGRESS, maxQueued=MAX_QUEUED, sourceRatePerSecond=SOURCE_RATE_PER_SECOND,
+                 sourceBurst=SOURCE_BURST, retryAfterMs=RETRY_AFTER_MS, maxSources=MAX_SOURCES):
+        super(LogonAdmission, self).__init__()
+        self.max_in_progress = maxInProgress
+        self.max_queued = maxQueued
+        self.source_rate = sourceRatePerSecond
+        self.source_burst = sourceBurst
+        self.retry_after_ms = retryAfterMs
+        self.max_sources = maxSources
+
+        self.in_progress = 0
+
+        # Functions which start a logon, oldest first.
+        self.queued_reconnects = deque()
+        self.queued_logons = deque()
+
+        # Source address -> (tokens, time tokens were last added).
+        self.source_buckets = dict()
+
+        # Prevents release from recursing when a queued logon completes straight away.
+        self.is_starting = False
+
+        self.period_metrics = PeriodMetrics('admitted', 'rejected', 'rate_limited')
+        self.max_queue_length = 0
+
+    def getQueueLength(self):
+        return len(self.queued_reconnects) + len(self.queued_logons)
+
+    # Returns a randomised number of milliseconds that a rejected client should wait before retrying.
+    def getRetryAfterMs(self):
+        return self.retry_after_ms + random.randint(0, self.retry_after_ms)
+
+    def _takeSourceToken(self, source, now):
+        tokens, lastTime = self.source_buckets.get(source, (self.source_burst, now))
+        tokens = min(self.source_burst, tokens + (now - lastTime) * self.source_rate)
+        if tokens < 1:
+            self.source_buckets[source] = (tokens, now)
+            return False
+
+        if source not in self.source_buckets and len(self.source_buckets) >= self.max_sources:
+            self._forgetIdleSources(now)
+
+        self.source_buckets[source] = (tokens - 1, now)
+        return True
+
+    # Sources whose buckets have refilled are no different to those we have never seen.
+    def _forgetIdleSources(self, now):
+        for source, (tokens, lastTime) in self.source_buckets.items():
+            if tokens + (now - lastTime) * self.source_rate >= self.source_burst:
+                del self.source_buckets[source]
+
+    # Calls startFunc(None) once the logon may be processed, which may be straight away, release must then be
+    # called once the logon completes. If a queued logon is turned away to make room for a reconnect,
+    # startFunc is instead called with the number of milliseconds the client should wait before retrying.
+    #
+    # Returns None if the logon was started or queued, otherwise the number of milliseconds the client
+    # should wait before retrying.
+    def request(self, source, isReconnect, startFunc, now=None):
+        if now is None:
+            now = time.time()
+
+        if not self._takeSourceToken(source, now):
+            self.period_metrics.rate_limited += 1
+            return self.getRetryAfterMs()
+
+        if self.in_progress < self.max_in_progress and self.getQueueLength() == 0:
+            self._start(startFunc)
+            return None
+
+        if self.getQueueLength() >= self.max_queued:
+            if not isReconnect or len(self.queued_logons) == 0:
+                self.period_metrics.rejected += 1
+                return self.getRetryAfterMs()
+
+            # Make room for the reconnect, the newest fresh logon has waited the least.
+            self.queued_logons.pop()(self.getRetryAfterMs())
+            self.period_metrics.rejected += 1
+
+        if isReconnect:
+            self.queued_reconnects.append(startFunc)
+        else:
+            self.queued_logons.append(startFunc)
+
+        queueLength = self.getQueueLength()
+        if queueLength > self.max_queue_length:
+            self.max_queue_length = queueLength
+        return None
+
+    def _start(self, startFunc):
+        self.in_progress += 1
+        self.period_metrics.admitted += 1
+        startFunc(None)
+
+    def release(self):
+        self.in_progress -= 1
+        if self.is_starting:
+            return
+
+        self.is_starting = True
+        try:
+            while self.in_progress < self.max_in_progress and self.getQueueLength() > 0:
+                if len(self.queued_reconnects) > 0:
+                    startFunc = self.queued_reconnects.popleft()
+                else:
+                    startFunc = self.queued_logons.popleft()
+
+                self._start(startFunc)
+        finally:
+            self.is_starting = False
+
+    # Overloaded if we turned logons away, or are holding so many that new ones will wait a while.
+    def isOverloaded(self):
+        return self.period_metrics.rejected > 0 or self.getQueueLength() >= self.max_queued / 2
+
+    # Returns metrics since they were last reported, and starts a new reporting period.
+    def getMetrics(self):
+        overloaded = self.isOverloaded()
+        metrics = self.period_metrics.take()
+        metrics.update({'in_progress': self.in_progress,
+                        'queued': self.getQueueLength(),
+                        'max_queued': self.max_queue_length,
+                        'overloaded': overloaded})
+
+        self.max_queue_length = self.getQueueLength()
+        return metrics
+
+    def reportMetrics(self):
+        metrics = self.getMetrics()
+        logger.info("Logon admission, in progress: [%(in_progress)d], queued: [%(queued)d] (max %(max_queued)d), admitted: [%(admitted)d], "
+                    "rejected: [%(rejected)d], rate limited: [%(rate_limited)d], overloaded: [%(overloaded)s]" % metrics)
+        return metrics
+
+
+class LogonAdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+        self.rejected = []
+
+    def buildStartFunc(self, name):
+        def startFunc(retryAfterMs):
+            if retryAfterMs is None:
+                self.started.append(name)
+            else:
+                self.rejected.append(name)
+        return startFunc
+
+    def testQueueAndPriority(self):
+        admission = LogonAdmission(maxInProgress=1, maxQueued=2)
+        self.assertIsNone(admission.request('a', False, self.buildStartFunc('fresh1'), now=0))
+        self.assertIsNone(admission.request('b', False, self.buildStartFunc('fresh2'), now=0))
+        self.assertIsNone(admission.request('c', False, self.buildStartFunc('fresh3'), now=0))
+        self.assertEquals(self.started, ['fresh1'])
+
+        # Queue is full, a fresh logon is turned away but a reconnect takes the place of the newest fresh logon.
+        self.assertIsNotNone(admission.request('d', False, self.buildStartFunc('fresh4'), now=0))
+        self.assertIsNone(admission.request('e', True, self.buildStartFunc('reconnect'), now=0))
+        self.assertEquals(self.rejected, ['fresh3'])
+        self.assertTrue(admission.isOverloaded())
+
+        admission.release()
+        admission.release()
+        self.assertEquals(self.started, ['fresh1', 'reconnect', 'fresh2'])
+        self.assertEquals(admission.in_progress, 1)
+
+        admission.getMetrics()
+        self.assertFalse(admission.isOverloaded())
+
+    def testReleaseWhileStarting(self):
+        admission = LogonAdmission(maxInProgress=1)
+
+        # Logons which complete as soon as they start, e.g. the client disconnected while queued.
+        def startFunc(retryAfterMs):
+            self.started.append(retryAfterMs)
+            admission.release()
+
+        for source in range(100):
+            admission.request(source, False, self.buildStartFunc('first') if source == 0 else startFunc, now=0)
+
+        admission.release()
+        self.assertEquals(len(self.started), 100)
+        self.assertEquals(admission.in_progress, 0)
+
+    def testSourceRateLimit(self):
+        admission = LogonAdmission(sourceRatePerSecond=1.0, sourceBurst=2)
+        self.assertIsNone(admission.request('a', False, self.buildStartFunc('1'), now=0))
+        self.assertIsNone(admission.request('a', False, self.buildStartFunc('2'), now=0))
+        self.assertIsNotNone(admission.request('a', True, self.buildStartFunc('3'), now=0))
+        self.assertIsNone(admission.request('b', False, self.buildStartFunc('4'), now=0))
+        self.assertIsNone(admission.request('a', False, self.buildStartFunc('5'), now=1))
+        self.assertEquals(self.started, ['1', '2', '4', '5'])
+
+        # Refilled buckets are forgotten when room is needed.
+        admission.max_sources = 2
+        admission.request('c', False, self.buildStartFunc('6'), now=10)
+        self.assertEquals(sorted(admission.source_buckets.keys()), ['c'])
@@ -0,0 +1,336 @@
+import struct
+import unittest
+from collections import namedtuple
+from operator import itemgetter
+from byte_buffer import ByteBuffer
+from utility import DataConstants
+
+__author__ = 'pryormic'
+
+class FieldType:
+    UINT8 = 0
+    UINT32 = 1
+    FLOAT = 2
+
+    # Variable length, prefixed with their size as a UINT32.
+    STRING = 3
+    BYTES = 4 # ByteBuffer.
+    HEX = 5 # Hex string on our side, raw bytes on the wire.
+
+    FIXED_FORMATS = {UINT8: DataConstants.UBYTE_FORMAT,
+                     UINT32: DataConstants.ULONG_FORMAT,
+                     FLOAT: DataConstants.FLOAT_FORMAT}
+
+    FIXED_STRUCTS = {UINT8: DataConstants.UBYTE_STRUCT,
+                     UINT32: DataConstants.ULONG_STRUCT,
+                     FLOAT: DataConstants.FLOAT_STRUCT}
+
+    @staticmethod
+    def isFixedSize(fieldType):
+        return fieldType in FieldType.FIXED_FORMATS
+
+class Field(object):
+    def __init__(self, name, fieldType, optional=False):
+        super(Field, self).__init__()
+        self.name = name
+        self.field_type = fieldType
+
+        # Optional fields are omitted when None, they must come after all other fields.
+        self.optional = optional
+
+# Consecutive fixed size fields which are packed and unpacked with a single struct.
+# Fields can only share a struct if they have the same byte order (single bytes fit in any).
+class _FixedRun(object):
+    def __init__(self):
+        super(_FixedRun, self).__init__()
+        self.byte_order = None
+        self.codes = ''
+        self.getters = list()
+        self.field_types = list()
+
+    def canAdd(self, fieldType):
+        byteOrder, code = _FixedRun.splitFormat(FieldType.FIXED_FORMATS[fieldType])
+        return byteOrder is None or self.byte_order is None or byteOrder == self.byte_order
+
+    def add(self, fieldType, getter):
+        byteOrder, code = _FixedRun.splitFormat(FieldType.FIXED_FORMATS[fieldType])
+        if byteOrder is not None:
+            self.byte_order = byteOrder
+        self.codes += code
+        self.getters.append(getter)
+        self.field_types.append(fieldType)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def buildStruct(self):
+        # Always explicit, otherwise native alignment would insert padding.
+        byteOrder = self.byte_order if self.byte_order is not None else '<'
+        return struct.Struct(byteOrder + self.codes)
+
+    @staticmethod
+    def splitFormat(theFormat):
+        if theFormat[0] in '<>!=@':
+            return theFormat[0], theFormat[1:]
+        return None, theFormat
+
+def _lengthGetter(index, fieldType):
+    if fieldType == FieldType.STRING:
+        return lambda values: len(values[index])
+    elif fieldType == FieldType.BYTES:
+        return lambda values: values[index].used_size
+    else:
+        return lambda values: len(values[index]) // 2
+
+def _constantGetter(value):
+    return lambda values: value
+
+def _writeVariableLengthData(packet, value, fieldType):
+    if fieldType == FieldType.STRING:
+        packet.addVariableLengthData(value, len(value), includePrefix=False)
+    elif fieldType == FieldType.BYTES:
+        packet.addByteBuffer(value, includePrefix=False)
+    else:
+        data = value.decode('hex')
+        packet.addVariableLengthData(data, len(data), includePrefix=False)
+
+def _readVariableLengthData(packet, fieldType):
+    if fieldType == FieldType.STRING:
+        return packet.getString()
+    elif fieldType == FieldType.BYTES:
+        return packet.getByteBuffer()
+    else:
+        return packet.getHexString()
+
+# Wire format of a single message, compiled when constructed into a short list of
+# encode and decode steps, so that runs of fixed size fields cost a single struct call.
+#
+# Encoding writes the op code, decoding expects it to have already been read (see MessageDispatcher).
+class MessageSchema(object):
+    def __init__(self, name, opCode, fields, opCodeType=FieldType.UINT8):
+        super(MessageSchema, self).__init__()
+        self.name = name
+        self.op_code = opCode
+        self.op_code_type = opCodeType
+        self.fields = fields
+        self.field_count = len(fields)
+        self.message_type = namedtuple(name, [field.name for field in fields])
+
+        seenOptional = False
+        for field in fields:
+            if seenOptional and not field.optional:
+                raise ValueError("Message [%s] has mandatory field [%s] after an optional field" % (name, field.name))
+            seenOptional = seenOptional or field.optional
+
+        self.encoders = self._compileEncoders()
+        self.decoders = self._compileDecoders()
+
+    def _compileEncoders(self):
+        encoders = list()
+        run = _FixedRun()
+
+        def flushRun(run):
+            if len(run) == 0:
+                return
+            theStruct = run.buildStruct()
+            getters = tuple(run.getters)
+            encoders.append(lambda packet, values: packet.packValues(theStruct, [getter(values) for getter in getters]))
+
+        if self.op_code is not None:
+            run.add(self.op_code_type, _constantGetter(self.op_code))
+
+        for index, field in enumerate(self.fields):
+            fieldType = field.field_type
+            if field.optional:
+                flushRun(run)
+                run = _FixedRun()
+                encoders.append(self._buildOptionalEncoder(index, fieldType))
+            elif FieldType.isFixedSize(fieldType):
+                if not run.canAdd(fieldType):
+                    flushRun(run)
+                    run = _FixedRun()
+                run.add(fieldType, itemgetter(index))
+            else:
+                # The size prefix goes in the run, the data follows it.
+                if not run.canAdd(FieldType.UINT32):
+                    flushRun(run)
+                    run = _FixedRun()
+                run.add(FieldType.UINT32, _lengthGetter(index, fieldType))
+                flushRun(run)
+                run = _FixedRun()
+                encoders.append(lambda packet, values, index=index, fieldType=fieldType: _writeVariableLengthData(packet, values[index], fieldType))
+
+        flushRun(run)
+        return encoders
+
+    def _buildOptionalEncoder(self, index, fieldType):
+        if FieldType.isFixedSize(fieldType):
+            theStruct = FieldType.FIXED_STRUCTS[fieldType]
+            def encodeOptional(packet, values):
+                if values[index] is not None:
+                    packet.pack(theStruct, values[index])
+        else:
+            def encodeOptional(packet, values):
+                value = values[index]
+                if value is not None:
+                    packet.pack(DataConstants.ULONG_STRUCT, _lengthGetter(index, fieldType)(values))
+                    _writeVariableLengthData(packet, value, fieldType)
+        return encodeOptional
+
+    def _compileDecoders(self):
+        decoders = list()
+        run = _FixedRun()
+
+        def flushRun(run):
+            if len(run) == 0:
+                return
+            theStruct = run.buildStruct()
+            fieldStructs = [FieldType.FIXED_STRUCTS[fieldType] for fieldType in run.field_types]
+
+            def decodeRun(packet, values):
+                result = packet.unpackValues(theStruct)
+                if result is None:
+                    # Not enough data, fall back to reading field by field, which behaves as ByteBuffer always has.
+                    result = [packet.unpack(fieldStruct) for fieldStruct in fieldStructs]
+                values.extend(result)
+            decoders.append(decodeRun)
+
+        for field in self.fields:
+            fieldType = field.field_type
+            if field.optional:
+                flushRun(run)
+                run = _FixedRun()
+                decoders.append(self._buildOptionalDecoder(fieldType))
+            elif FieldType.isFixedSize(fieldType):
+                if not run.canAdd(fieldType):
+                    flushRun(run)
+                    run = _FixedRun()
+                run.add(fieldType, None)
+            else:
+                flushRun(run)
+                run = _FixedRun()
+                decoders.append(lambda packet, values, fieldType=fieldType: values.append(_readVariableLengthData(packet, fieldType)))
+
+        flushRun(run)
+        return decoders
+
+    def _buildOptionalDecoder(self, fieldType):
+        def decodeOptional(packet, values):
+            if packet.getUnreadDataFromCursor() == 0:
+                values.append(None)
+            elif FieldType.isFixedSize(fieldType):
+                values.append(packet.unpack(FieldType.FIXED_STRUCTS[fieldType]))
+            else:
+                values.append(_readVariableLengthData(packet, fieldType))
+        return decodeOptional
+
+    # Values are in field order.
+    def encodeInto(self, packet, *values):
+        assert isinstance(packet, ByteBuffer)
+        if len(values) != self.field_count:
+            raise TypeError("Message [%s] has %d fields, %d values provided" % (self.name, self.field_count, len(values)))
+
+        for encoder in self.encoders:
+            encoder(packet, values)
+        return packet
+
+    def encode(self, *values):
+        return self.encodeInto(ByteBuffer(), *values)
+
+    def decode(self, packet):
+        assert isinstance(packet, ByteBuffer)
+        values = list()
+        for decoder in self.decoders:
+            decoder(packet, values)
+        return self.message_type._make(values)
+
+    def __str__(self):
+        return "{MessageSchema: [%s], op code: [%s]}" % (self.name, self.op_code)
+
+# Reads the op code of a packet, then decodes and dispatches it to the handler of that message.
+class MessageDispatcher(object):
+    def __init__(self, opCodeType=FieldType.UINT8):
+        super(MessageDispatcher, self).__init__()
+        self.op_code_struct = FieldType.FIXED_STRUCTS[opCodeType]
+        self.handlers = dict()
+
+    def register(self, schema, handlerFunc):
+        assert isinstance(schema, MessageSchema)
+        if schema.op_code in self.handlers:
+            raise ValueError("Op code [%d] already has a handler" % schema.op_code)
+        self.handlers[schema.op_code] = (schema, handlerFunc)
+
+    # Handler is called with (target, message), returns false if the op code is unknown.
+    def dispatch(self, target, packet):
+        assert isinstance(packet, ByteBuffer)
+        opCode = packet.unpack(self.op_code_struct)
+        entry = self.handlers.get(opCode)
+        if entry is None:
+            return False
+
+        schema, handlerFunc = entry
+        handlerFunc(target, schema.decode(packet))
+        return True
+
+
+class MessageSchemaTest(unittest.TestCase):
+    SCHEMA = MessageSchema("Sample", 15, [Field("name", FieldType.STRING),
+                                          Field("age", FieldType.UINT32),
+                                          Field("flag", FieldType.UINT8),
+                                          Field("latitude", FieldType.FLOAT),
+                                          Field("picture", FieldType.BYTES),
+                                          Field("payload", FieldType.HEX),
+                                          Field("magnitude", FieldType.UINT8, optional=True),
+                                          Field("expiry", FieldType.UINT32, optional=True)])
+
+    def buildManually(self, picture):
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(15)
+        packet.addString("Bob")
+        packet.addUnsignedInteger(25)
+        packet.addUnsignedInteger8(1)
+        packet.addFloat(1.5)
+        packet.addByteBuffer(picture)
+        packet.addString("\xab\xcd")
+        packet.addUnsignedInteger8(3)
+        return packet
+
+    def testMatchesByteBuffer(self):
+        picture = ByteBuffer.buildFromIterable("picture")
+        packet = MessageSchemaTest.SCHEMA.encode("Bob", 25, 1, 1.5, picture, "abcd", 3, None)
+        self.assertEquals(packet.convertToString(), self.buildManually(picture).convertToString())
+
+    def testRoundTrip(self):
+        picture = ByteBuffer.buildFromIterable("picture")
+        packet = MessageSchemaTest.SCHEMA.encode("Bob", 25, 1, 1.5, picture, "abcd", 3, 1000)
+        packet.cursor_position = 1
+
+        message = MessageSchemaTest.SCHEMA.decode(packet)
+        self.assertEquals(message.name, "Bob")
+        self.assertEquals(message.age, 25)
+        self.assertEquals(message.flag, 1)
+        self.assertEquals(message.latitude, 1.5)
+        self.assertEquals(message.picture.convertToString(), "picture")
+        self.assertEquals(message.payload, "abcd")
+        self.assertEquals(message.magnitude, 3)
+        self.assertEquals(message.expiry, 1000)
+
+    def testDispatch(self):
+        received = list()
+        dispatcher = MessageDispatcher()
+        dispatcher.register(MessageSchemaTest.SCHEMA, lambda target, message: received.append((target, message)))
+
+        picture = ByteBuffer.buildFromIterable("picture")
+        packet = MessageSchemaTest.SCHEMA.encode("Bob", 25, 1, 1.5, picture, "abcd", None, None)
+        packet.cursor_position = 0
+        self.assertTrue(dispatcher.dispatch("target", packet))
+        self.assertEquals(received[0][0], "target")
+        self.assertIsNone(received[0][1].magnitude)
+
+        self.assertFalse(dispatcher.dispatch("target", ByteBuffer.buildFromIterable("\x01")))
+
+    def testShortPacket(self):
+        schema = MessageSchema("Short", None, [Field("a", FieldType.UINT32), Field("b", FieldType.UINT32)])
+        message = schema.decode(ByteBuffer.buildFromIterable("\x01\x00\x00\x00\x02"))
+        self.assertEquals(message.a, 1)
+        self.assertEquals(message.b, DataConstants.ULONG_STRUCT.unpack("0000")[0])
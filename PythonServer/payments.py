@@ -43,7 +43,7 @@ class Payments(object):
         assert isinstance(transactionToVerify, ByteBuffer)
         assert isinstance(client, Client)
 
-        transactionToVerify = base64.b64encode(transactionToVerify.buffer)
+        transactionToVerify = base64.b64encode(transactionToVerify.getView()[:transactionToVerify.used_size].tobytes())
 
         return self.httpSession.post(self.url_for_verification, json={'receipt-data' : transactionToVerify})
 
@@ -1,6 +1,6 @@
 import struct
 import logging
-from twisted.protocols.basic import IntNStringReceiver
+from twisted.protocols.basic import IntNStringReceiver, StringTooLongError
 from byte_buffer import ByteBuffer
 from utility import DataConstants
 
@@ -51,9 +51,23 @@ class ClientTcp(IntNStringReceiver):
             if logger.isEnabledFor(logging.DEBUG):
                 logger.debug("Attribute error: %s" % unicode(e))
 
+    # Equivalent to sendString, but the prefix and data are handed to the transport
+    # separately rather than being concatenated into another copy of the packet.
     def sendByteBuffer(self, byteBuffer):
         assert isinstance(byteBuffer, ByteBuffer)
-        self.sendString(byteBuffer.convertToString())
+        dataSize = byteBuffer.used_size
+        if dataSize >= 2 ** (8 * self.prefixLength):
+            raise StringTooLongError("Try to send %s bytes whereas maximum is %s" % (dataSize, 2 ** (8 * self.prefixLength)))
+
+        self.transport.writeSequence([DataConstants.ULONG_STRUCT.pack(dataSize), byteBuffer.convertToString()])
+
+    # Sends a single packet made up of several already serialized parts, without joining them ourselves.
+    def sendParts(self, parts):
+        dataSize = sum(len(part) for part in parts)
+        if dataSize >= 2 ** (8 * self.prefixLength):
+            raise StringTooLongError("Try to send %s bytes whereas maximum is %s" % (dataSize, 2 ** (8 * self.prefixLength)))
+
+        self.transport.writeSequence([DataConstants.ULONG_STRUCT.pack(dataSize)] + parts)
 
     def formatAddress(self, addressTuple):
         return "%s:%s" % (addressTuple.host, addressTuple.port)
@@ -0,0 +1,388 @@
+from twisted.internet import reactor, protocol, task, stdio
+from twisted.protocols.basic import IntNStringReceiver
+from byte_buffer import ByteBuffer
+from utility import DataConstants, parseLogLevel, bindUdpSocket
+from batched_udp import isBatchedUdpSupported, listenBatchedUdp
+from forwarding_table import ForwardingTable
+from session_hash import SessionHashSigner
+import logging
+import argparse
+import socket
+import struct
+import sys
+import os
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+# Listen on a UDP port which is shared with other processes.
+def listenReusableUdp(port, datagramProtocol, batched=False):
+    sock = bindUdpSocket(port, reusePort=True)
+    if batched:
+        return listenBatchedUdp(sock, datagramProtocol)
+
+    try:
+        return reactor.adoptDatagramPort(sock.fileno(), socket.AF_INET, datagramProtocol)
+    finally:
+        # The reactor has its own copy of the file descriptor.
+        sock.close()
+
+# Local channel between the governor and its relay workers.
+# Packets are prefixed with their size, in the same way as client TCP connections.
+class RelayChannel(IntNStringReceiver):
+    structFormat = DataConstants.ULONG_FORMAT
+    prefixLength = struct.calcsize(structFormat)
+    MAX_LENGTH = 100000000
+
+    class OperationCodes:
+        # Governor -> worker.
+        OP_ADD_ROUTE = 1
+        OP_REMOVE_ROUTE = 2
+        OP_CLEAR_ROUTES = 3
+        OP_ADD_CONNECTION_ID = 6
+        OP_REMOVE_CONNECTION_ID = 7
+
+        # Worker -> governor.
+        OP_UNKNOWN_DATAGRAM = 4
+        OP_LOAD = 5
+
+        # Used by sharded governors, where the front process relays for its shards, see shard_worker.
+
+        # Shard -> front.
+        OP_SEND_DATAGRAM = 8
+        OP_SHARD_HELLO = 9
+        OP_SHARD_STATUS = 10
+        OP_CONNECTION_ADOPTED = 11
+        OP_HOLD_SESSION = 13
+        OP_RELEASE_SESSION = 14
+
+        # Front -> shard, a file descriptor is passed alongside.
+        OP_ADOPT_CONNECTION = 12
+
+        # Front -> shard, another shard has connected or gone away.
+        OP_SHARD_JOINED = 16
+        OP_SHARD_LEFT = 17
+
+        # Both ways, a message for other shards which the front passes on, see ShardFront.forwardShardMessage.
+        OP_SHARD_MESSAGE = 15
+
+        # Moving a connected client to another shard, see Shard.migrateClient. Shard -> front with the client's
+        # file descriptor passed alongside, front -> target shard in the same way, and front -> shard once the
+        # front holds its own descriptor.
+        OP_MIGRATE_CONNECTION = 18
+        OP_ADOPT_MIGRATED_CONNECTION = 19
+        OP_CONNECTION_MIGRATED = 20
+
+    def __init__(self, onPacketFunc):
+        self.on_packet_func = onPacketFunc
+
+    def stringReceived(self, data):
+        self.on_packet_func(ByteBuffer.buildFromIterable(data))
+
+    def sendByteBuffer(self, byteBuffer):
+        assert isinstance(byteBuffer, ByteBuffer)
+        self.sendString(byteBuffer.convertToString())
+
+    @staticmethod
+    def addAddress(packet, address):
+        packet.addString(address[0])
+        packet.addUnsignedInteger(address[1])
+
+    @staticmethod
+    def getAddress(packet):
+        host = packet.getString()
+        port = packet.getUnsignedInteger()
+        return host, port
+
+    @staticmethod
+    def buildRoutePacket(sourceAddress, peerAddress):
+        packet = ByteBuffer()
+        if peerAddress is not None:
+            packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_ADD_ROUTE)
+            RelayChannel.addAddress(packet, sourceAddress)
+            RelayChannel.addAddress(packet, peerAddress)
+        else:
+            packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_REMOVE_ROUTE)
+            RelayChannel.addAddress(packet, sourceAddress)
+        return packet
+
+    @staticmethod
+    def buildSessionPacket(udpHash, isHeld):
+        packet = ByteBuffer()
+        if isHeld:
+            packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_HOLD_SESSION)
+        else:
+            packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_RELEASE_SESSION)
+        packet.addString(udpHash)
+        return packet
+
+    @staticmethod
+    def buildConnectionIdPacket(connectionId, address):
+        packet = ByteBuffer()
+        if address is not None:
+            packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_ADD_CONNECTION_ID)
+            packet.addUnsignedInteger(connectionId)
+            RelayChannel.addAddress(packet, address)
+        else:
+            packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_REMOVE_CONNECTION_ID)
+            packet.addUnsignedInteger(connectionId)
+        return packet
+
+# Runs in a separate process, relaying datagrams of matched rooms which the kernel
+# delivered to this process' socket. Routes are pushed to us by the governor,
+# anything we cannot route is passed back to the governor to handle.
+class RelayWorker(protocol.DatagramProtocol):
+    LOAD_REPORT_FREQUENCY = 1.0
+
+    # Client.UdpOperationCodes.OP_UDP_HASH, the client module is too heavy to import here.
+    UDP_HASH_PREFIX = chr(4)
+
+    def __init__(self, sessionHashSigner):
+        assert isinstance(sessionHashSigner, SessionHashSigner)
+
+        self.routes = dict()
+        self.session_hash_signer = sessionHashSigner
+
+        # Connection ID -> UDP address the governor last saw it from.
+        self.connection_id_addresses = dict()
+
+        self.channel = RelayChannel(self.handleControlPacket)
+        self.bytes_relayed = 0
+        self.load_reporter = task.LoopingCall(self.reportLoad)
+
+    def startProtocol(self):
+        self.load_reporter.start(RelayWorker.LOAD_REPORT_FREQUENCY, now=False)
+
+    def stopProtocol(self):
+        if self.load_reporter.running:
+            self.load_reporter.stop()
+
+    def datagramReceived(self, data, remoteAddress):
+        if data[:1] == ForwardingTable.CONNECTION_ID_PREFIX:
+            # Only relay if the address is unchanged, otherwise the governor must move the route.
+            connectionId = ForwardingTable.parseConnectionId(data)
+            if connectionId is not None and self.connection_id_addresses.get(connectionId) == remoteAddress:
+                peerAddress = self.routes.get(remoteAddress)
+                if peerAddress is not None:
+                    self.bytes_relayed += len(data)
+                    self.transport.write(data[ForwardingTable.CONNECTION_ID_HEADER_SIZE:], peerAddress)
+                    return
+        else:
+            peerAddress = self.routes.get(remoteAddress)
+            if peerAddress is not None:
+                self.bytes_relayed += len(data)
+                self.transport.write(data, peerAddress)
+                return
+
+            # Forged session hashes are discarded here, rather than being passed on to the governor.
+            if data[:1] == RelayWorker.UDP_HASH_PREFIX and not self.isValidHashDatagram(data):
+                return
+
+        self.forwardUnknownDatagram(data, remoteAddress)
+
+    def forwardUnknownDatagram(self, data, remoteAddress):
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_UNKNOWN_DATAGRAM)
+        RelayChannel.addAddress(packet, remoteAddress)
+        packet.addString(data)
+        self.channel.sendByteBuffer(packet)
+
+    def isValidHashDatagram(self, data):
+        packet = ByteBuffer.buildFromIterable(data)
+        packet.getUnsignedInteger8()
+        return self.session_hash_signer.verifyHash(packet.getString(), checkExpiry=False)
+
+    def reportLoad(self):
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_LOAD)
+        packet.addUnsignedInteger(self.bytes_relayed)
+        self.bytes_relayed = 0
+        self.channel.sendByteBuffer(packet)
+
+    def handleControlPacket(self, packet):
+        assert isinstance(packet, ByteBuffer)
+
+        opCode = packet.getUnsignedInteger8()
+        if opCode == RelayChannel.OperationCodes.OP_ADD_ROUTE:
+            sourceAddress = RelayChannel.getAddress(packet)
+            peerAddress = RelayChannel.getAddress(packet)
+            self.routes[sourceAddress] = peerAddress
+        elif opCode == RelayChannel.OperationCodes.OP_REMOVE_ROUTE:
+            sourceAddress = RelayChannel.getAddress(packet)
+            self.routes.pop(sourceAddress, None)
+        elif opCode == RelayChannel.OperationCodes.OP_CLEAR_ROUTES:
+            self.routes.clear()
+            self.connection_id_addresses.clear()
+        elif opCode == RelayChannel.OperationCodes.OP_ADD_CONNECTION_ID:
+            connectionId = packet.getUnsignedInteger()
+            self.connection_id_addresses[connectionId] = RelayChannel.getAddress(packet)
+        elif opCode == RelayChannel.OperationCodes.OP_REMOVE_CONNECTION_ID:
+            connectionId = packet.getUnsignedInteger()
+            self.connection_id_addresses.pop(connectionId, None)
+        else:
+            logger.error("Unknown control packet received from governor, op code: %d" % opCode)
+
+class RelayWorkerStandardIO(protocol.Protocol):
+    def __init__(self, relayWorker):
+        self.relay_worker = relayWorker
+
+    def connectionMade(self):
+        self.relay_worker.channel.makeConnection(self.transport)
+
+    def dataReceived(self, data):
+        self.relay_worker.channel.dataReceived(data)
+
+    def connectionLost(self, reason):
+        # Governor has gone away, nothing more we can do.
+        logger.warn("Control channel with governor lost, stopping relay worker")
+        if reactor.running:
+            reactor.stop()
+
+# Governor side of a relay worker process.
+class RelayWorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, pool, workerIndex):
+        self.pool = pool
+        self.worker_index = workerIndex
+        self.channel = RelayChannel(self.handleControlPacket)
+        self.is_running = False
+
+    def connectionMade(self):
+        self.channel.makeConnection(self.transport)
+        self.is_running = True
+        self.pool.onWorkerStarted(self)
+
+    def outReceived(self, data):
+        self.channel.dataReceived(data)
+
+    def processEnded(self, reason):
+        self.is_running = False
+        self.pool.onWorkerEnded(self, reason)
+
+    def sendByteBuffer(self, packet):
+        if self.is_running:
+            self.channel.sendByteBuffer(packet)
+
+    def handleControlPacket(self, packet):
+        assert isinstance(packet, ByteBuffer)
+
+        opCode = packet.getUnsignedInteger8()
+        if opCode == RelayChannel.OperationCodes.OP_UNKNOWN_DATAGRAM:
+            remoteAddress = RelayChannel.getAddress(packet)
+            data = packet.getString()
+            self.pool.governor.datagramReceived(data, remoteAddress)
+        elif opCode == RelayChannel.OperationCodes.OP_LOAD:
+            self.pool.governor.bytes_received += packet.getUnsignedInteger()
+        else:
+            logger.error("Unknown control packet received from relay worker [%d], op code: %d" % (self.worker_index, opCode))
+
+    def __str__(self):
+        return "{RelayWorker: [%d]}" % self.worker_index
+
+# Spawns relay worker processes, which share the governor's UDP port, and keeps their
+# routes in sync with the house's forwarding table.
+#
+# The governor may also be the front process of a sharded governor, in which case the routes are
+# those of every shard, see ShardRelay. Either way, it is passed the datagrams which workers can't
+# relay, and the number of bytes they have relayed, through datagramReceived and bytes_received.
+class RelayWorkerPool(object):
+    RESTART_DELAY = 1
+
+    # routeSource is a ForwardingTable, or anything with the same listeners and getters.
+    def __init__(self, reactor, governor, routeSource, sessionHashSigner, udpPort, workerCount, logLevel, batchedUdp=False):
+        self.reactor = reactor
+        self.governor = governor
+        self.session_hash_signer = sessionHashSigner
+        self.udp_port = udpPort
+        self.worker_count = workerCount
+        self.log_level = logLevel
+        self.batched_udp = batchedUdp
+        self.workers = list()
+        self.forwarding_table = routeSource
+
+        self.forwarding_table.addListener(self.onRouteChange)
+        self.forwarding_table.addConnectionIdListener(self.onConnectionIdChange)
+
+    def start(self):
+        for workerIndex in range(self.worker_count):
+            self.spawnWorker(workerIndex)
+
+    def spawnWorker(self, workerIndex):
+        scriptPath = os.path.abspath(__file__)
+        if scriptPath.endswith('.pyc'):
+            scriptPath = scriptPath[:-1]
+
+        args = [sys.executable, scriptPath,
+                '--udp_port=%d' % self.udp_port,
+                '--log_level=%s' % self.log_level,
+                '--governor_name=%s' % self.governor.governor_name]
+        if self.batched_udp:
+            args.append('--batched_udp')
+
+        # Workers verify session hashes with the same secret, which may have been generated by us.
+        env = dict(os.environ)
+        env['HOLOGRAM_SESSION_SECRET'] = self.session_hash_signer.secret
+
+        worker = RelayWorkerProcess(self, workerIndex)
+        logger.info("Starting relay worker [%d]" % workerIndex)
+        self.reactor.spawnProcess(worker, sys.executable, args, env=env,
+                                  path=os.path.dirname(scriptPath), childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def onWorkerStarted(self, worker):
+        self.workers.append(worker)
+
+        # Bring the worker up to date with the rooms already in conversation.
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_CLEAR_ROUTES)
+        worker.sendByteBuffer(packet)
+
+        for sourceAddress, peerAddress in self.forwarding_table.getRoutes().iteritems():
+            worker.sendByteBuffer(RelayChannel.buildRoutePacket(sourceAddress, peerAddress))
+
+        for connectionId, address in self.forwarding_table.getConnectionIds().iteritems():
+            worker.sendByteBuffer(RelayChannel.buildConnectionIdPacket(connectionId, address))
+
+    def onWorkerEnded(self, worker, reason):
+        try:
+            self.workers.remove(worker)
+        except ValueError:
+            pass
+
+        logger.error("Relay worker [%d] ended, reason: [%s], restarting in %d seconds" % (worker.worker_index, reason.getErrorMessage(), RelayWorkerPool.RESTART_DELAY))
+        self.reactor.callLater(RelayWorkerPool.RESTART_DELAY, self.spawnWorker, worker.worker_index)
+
+    def _sendToWorkers(self, packet):
+        for worker in self.workers:
+            worker.sendByteBuffer(packet)
+
+    def onRouteChange(self, sourceAddress, peerAddress):
+        if len(self.workers) == 0:
+            return
+
+        self._sendToWorkers(RelayChannel.buildRoutePacket(sourceAddress, peerAddress))
+
+    def onConnectionIdChange(self, connectionId, address):
+        if len(self.workers) == 0:
+            return
+
+        self._sendToWorkers(RelayChannel.buildConnectionIdPacket(connectionId, address))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Relay Worker', argument_default=argparse.SUPPRESS)
+    parser.add_argument('--udp_port', help='UDP port shared with the governor')
+    parser.add_argument('--log_level', help="ERROR, WARN, INFO or DEBUG", default="INFO")
+    parser.add_argument('--governor_name', help='Name of the governor which started us, session hashes are signed with it')
+    parser.add_argument('--batched_udp', help='Receive and send datagrams in batches', action='store_true', default=False)
+    args = parser.parse_args()
+
+    logLevel = parseLogLevel(args.log_level)
+    logging.basicConfig(level = logLevel, stream = sys.stderr, format = '%(asctime)-30s %(name)-20s %(levelname)-8s %(message)s')
+
+    udpPort = int(args.udp_port)
+    logger.info("RELAY WORKER STARTED ON UDP PORT [%d]" % udpPort)
+
+    worker = RelayWorker(SessionHashSigner(SessionHashSigner.loadSecret(), args.governor_name))
+    stdio.StandardIO(RelayWorkerStandardIO(worker))
+    listenReusableUdp(udpPort, worker, batched=args.batched_udp and isBatchedUdpSupported())
+    reactor.run()
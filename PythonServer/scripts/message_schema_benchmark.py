@@ -0,0 +1,76 @@
+__author__ = 'pryormic'
+
+# Compares the compiled message schemas against building and parsing the same packets field by field.
+# Run from the PythonServer directory: python -m scripts.message_schema_benchmark
+import timeit
+from byte_buffer import ByteBuffer
+from client import TcpMessages
+
+ITERATIONS = 20000
+PICTURE = ByteBuffer.buildFromIterable("x" * 20000)
+
+def encodeMatchDetailsByteBuffer():
+    packet = ByteBuffer()
+    packet.addUnsignedInteger8(TcpMessages.ADVISE_MATCH_INFORMATION.op_code)
+    packet.addString("Michael")
+    packet.addUnsignedInteger(25)
+    packet.addUnsignedInteger(10)
+    packet.addUnsignedInteger(10)
+    packet.addUnsignedInteger(6)
+    packet.addUnsignedInteger(60)
+    packet.addUnsignedInteger(5)
+    packet.addString("Card text")
+    packet.addByteBuffer(PICTURE)
+    packet.addUnsignedInteger(1)
+    packet.addUnsignedInteger8(0)
+    packet.addUnsignedInteger8(1)
+    return packet
+
+def encodeMatchDetailsSchema():
+    return TcpMessages.ADVISE_MATCH_INFORMATION.encode("Michael", 25, 10, 10, 6, 60, 5, "Card text", PICTURE, 1, 0, 1)
+
+def buildLogon():
+    packet = ByteBuffer()
+    packet.addUnsignedInteger(6)
+    packet.addUnsignedInteger8(0)
+    packet.addString("persisted-id")
+    packet.addString("Michael Pryor")
+    packet.addString("Michael")
+    packet.addUnsignedInteger(25)
+    packet.addUnsignedInteger(1)
+    packet.addUnsignedInteger(2)
+    packet.addFloat(51.5)
+    packet.addFloat(-0.12)
+    packet.addByteBuffer(ByteBuffer())
+    packet.addString("Card text")
+    packet.addByteBuffer(PICTURE)
+    packet.addUnsignedInteger(1)
+    return ByteBuffer.buildFromIterable(packet.convertToString())
+
+LOGON = buildLogon()
+
+def decodeLogonByteBuffer():
+    LOGON.cursor_position = 0
+    return (LOGON.getUnsignedInteger(), LOGON.getUnsignedInteger8(), LOGON.getString(), LOGON.getString(), LOGON.getString(),
+            LOGON.getUnsignedInteger(), LOGON.getUnsignedInteger(), LOGON.getUnsignedInteger(), LOGON.getFloat(), LOGON.getFloat(),
+            LOGON.getByteBuffer(), LOGON.getString(), LOGON.getByteBuffer(), LOGON.getUnsignedInteger())
+
+def decodeLogonSchema():
+    LOGON.cursor_position = 0
+    return TcpMessages.LOGON.decode(LOGON)
+
+def normalise(values):
+    return tuple(value.convertToString() if isinstance(value, ByteBuffer) else value for value in values)
+
+def measure(func):
+    return min(timeit.repeat(func, number=ITERATIONS, repeat=3)) / ITERATIONS * 1000000
+
+if __name__ == '__main__':
+    assert encodeMatchDetailsByteBuffer().convertToString() == encodeMatchDetailsSchema().convertToString()
+    assert normalise(decodeLogonSchema()) == normalise(decodeLogonByteBuffer())
+
+    for name, byteBufferFunc, schemaFunc in [("Encode match details", encodeMatchDetailsByteBuffer, encodeMatchDetailsSchema),
+                                             ("Decode logon", decodeLogonByteBuffer, decodeLogonSchema)]:
+        byteBufferTime = measure(byteBufferFunc)
+        schemaTime = measure(schemaFunc)
+        print "%-25s ByteBuffer: %7.2f us, schema: %7.2f us (%.2fx)" % (name, byteBufferTime, schemaTime, byteBufferTime / schemaTime)
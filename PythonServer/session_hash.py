@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+import logging
+import os
+import unittest
+from utility import getEpoch
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+# Mints and verifies self validating UDP session hashes.
+#
+# Format: <nonce>.<identity>.<expiry>.<mac>
+# where identity is derived from the client's persisted ID, and mac is an HMAC
+# over the other fields and the governor's name. Any process knowing the secret
+# can verify a hash without access to the governor's in memory state.
+class SessionHashSigner(object):
+    # Sessions last this long, but a hash we still hold in memory is accepted beyond it.
+    LIFETIME = 60 * 60 * 24
+
+    NONCE_SIZE = 8
+    IDENTITY_SIZE = 16
+    MAC_SIZE = 32
+
+    SEPARATOR = '.'
+
+    def __init__(self, secret, governorName, lifetime=LIFETIME):
+        super(SessionHashSigner, self).__init__()
+        self.secret = str(secret)
+        self.governor_name = str(governorName)
+        self.lifetime = lifetime
+
+    # Secret shared by all processes of this governor, and across restarts. Kept apart from
+    # HOLOGRAM_PASSWORD, so that leaking one does not give away the other.
+    @staticmethod
+    def loadSecret():
+        secret = os.environ.get('HOLOGRAM_SESSION_SECRET')
+        if secret is None:
+            logger.warn("HOLOGRAM_SESSION_SECRET env variable not set, session hashes will not survive a restart")
+            secret = os.urandom(32).encode('hex')
+
+        return secret
+
+    @staticmethod
+    def getIdentity(persistedId):
+        return hashlib.sha1(unicode(persistedId).encode('utf8')).hexdigest()[:SessionHashSigner.IDENTITY_SIZE]
+
+    def _getMac(self, nonce, identity, expiry):
+        message = SessionHashSigner.SEPARATOR.join((nonce, identity, expiry, self.governor_name))
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()[:SessionHashSigner.MAC_SIZE]
+
+    def generateHash(self, persistedId):
+        nonce = os.urandom(SessionHashSigner.NONCE_SIZE).encode('hex')
+        identity = SessionHashSigner.getIdentity(persistedId)
+        expiry = str(getEpoch() + self.lifetime)
+        return SessionHashSigner.SEPARATOR.join((nonce, identity, expiry, self._getMac(nonce, identity, expiry)))
+
+    # Returns true if the hash was minted with our secret for this governor.
+    # If a persisted ID is provided, the hash must also have been minted for it.
+    def verifyHash(self, sessionHash, persistedId=None, checkExpiry=True):
+        if not isinstance(sessionHash, basestring):
+            return False
+
+        fields = str(sessionHash).split(SessionHashSigner.SEPARATOR)
+        if len(fields) != 4:
+            return False
+
+        nonce, identity, expiry, mac = fields
+        if not hmac.compare_digest(self._getMac(nonce, identity, expiry), mac):
+            return False
+
+        if persistedId is not None and identity != SessionHashSigner.getIdentity(persistedId):
+            return False
+
+        if checkExpiry:
+            try:
+                if int(expiry) < getEpoch():
+                    return False
+            except ValueError:
+                return False
+
+        return True
+
+
+class SessionHashSignerTest(unittest.TestCase):
+    def testVerify(self):
+        signer = SessionHashSigner("secret", "governor1")
+        sessionHash = signer.generateHash("persistedId")
+
+        self.assertTrue(signer.verifyHash(sessionHash))
+        self.assertTrue(signer.verifyHash(sessionHash, "persistedId"))
+        self.assertFalse(signer.verifyHash(sessionHash, "otherPersistedId"))
+
+        # Restarted governor with the same secret and name.
+        self.assertTrue(SessionHashSigner("secret", "governor1").verifyHash(sessionHash))
+
+        self.assertFalse(SessionHashSigner("secret", "governor2").verifyHash(sessionHash))
+        self.assertFalse(SessionHashSigner("other", "governor1").verifyHash(sessionHash))
+
+    def testTampered(self):
+        signer = SessionHashSigner("secret", "governor1")
+        nonce, identity, expiry, mac = signer.generateHash("persistedId").split('.')
+
+        self.assertFalse(signer.verifyHash('.'.join((nonce, identity, str(int(expiry) + 1), mac))))
+        self.assertFalse(signer.verifyHash("3c9f9d2e-7b0c-4c47-9d33-3f4b8f8f1f10"))
+        self.assertFalse(signer.verifyHash(None))
+
+    def testExpiry(self):
+        signer = SessionHashSigner("secret", "governor1", lifetime=-1)
+        sessionHash = signer.generateHash("persistedId")
+
+        self.assertFalse(signer.verifyHash(sessionHash))
+        self.assertTrue(signer.verifyHash(sessionHash, checkExpiry=False))
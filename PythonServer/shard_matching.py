@@ -0,0 +1,552 @@
+import logging
+import unittest
+from threading import RLock
+from byte_buffer import ByteBuffer
+from client import Client
+from handshaking import UdpConnectionLinker
+from house import House
+from message_schema import MessageSchema, MessageDispatcher, Field, FieldType
+from session_hash import SessionHashSigner
+from spatial_index import SpatialIndex
+from stat_tracker import PeriodMetrics
+from shard_worker import ALL_SHARDS
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+
+class ShardOperationCodes:
+    OP_WAITING = 1
+    OP_NOT_WAITING = 2
+    OP_MATCH_OFFER = 3
+    OP_MATCH_ACCEPTED = 4
+    OP_MATCH_DECLINED = 5
+    OP_HAND_OVER = 6
+
+
+# Messages between the shards of a sharded governor, which the front process passes on, see ShardMatchmaker.
+class ShardMessages:
+    WAITING = MessageSchema("Waiting", ShardOperationCodes.OP_WAITING, [Field("unique_id", FieldType.STRING),
+                                                                        Field("persisted_id", FieldType.STRING),
+                                                                        Field("gender", FieldType.UINT32),
+                                                                        Field("gender_wanted", FieldType.UINT32),
+                                                                        Field("longitude", FieldType.FLOAT),
+                                                                        Field("latitude", FieldType.FLOAT)])
+
+    NOT_WAITING = MessageSchema("NotWaiting", ShardOperationCodes.OP_NOT_WAITING, [Field("unique_id", FieldType.STRING)])
+
+    MATCH_OFFER = MessageSchema("MatchOffer", ShardOperationCodes.OP_MATCH_OFFER, [Field("offer_id", FieldType.UINT32),
+                                                                                   Field("unique_id", FieldType.STRING),
+                                                                                   Field("offering_unique_id", FieldType.STRING),
+                                                                                   Field("offering_persisted_id", FieldType.STRING)])
+
+    # Carries everything the offering shard needs to hold the client in a room, as it does offline clients.
+    MATCH_ACCEPTED = MessageSchema("MatchAccepted", ShardOperationCodes.OP_MATCH_ACCEPTED, [Field("offer_id", FieldType.UINT32),
+                                                                                            Field("unique_id", FieldType.STRING),
+                                                                                            Field("persisted_id", FieldType.STRING),
+                                                                                            Field("name", FieldType.STRING),
+                                                                                            Field("short_name", FieldType.STRING),
+                                                                                            Field("age", FieldType.UINT32),
+                                                                                            Field("gender", FieldType.UINT32),
+                                                                                            Field("interested_in", FieldType.UINT32),
+                                                                                            Field("longitude", FieldType.FLOAT),
+                                                                                            Field("latitude", FieldType.FLOAT),
+                                                                                            Field("card_text", FieldType.STRING),
+                                                                                            Field("profile_picture", FieldType.BYTES),
+                                                                                            Field("profile_picture_orientation", FieldType.UINT32),
+                                                                                            Field("karma", FieldType.UINT32)])
+
+    MATCH_DECLINED = MessageSchema("MatchDeclined", ShardOperationCodes.OP_MATCH_DECLINED, [Field("offer_id", FieldType.UINT32)])
+
+    HAND_OVER = MessageSchema("HandOver", ShardOperationCodes.OP_HAND_OVER, [Field("unique_id", FieldType.STRING),
+                                                                             Field("is_taken", FieldType.UINT8)])
+
+
+# Waiting client of another shard, as much of it as we need to decide whether to offer it a match.
+class RemoteWaitingClient(object):
+    def __init__(self, shardIndex, loginDetails):
+        super(RemoteWaitingClient, self).__init__()
+        self.shard_index = shardIndex
+        self.login_details = loginDetails
+
+    def __str__(self):
+        return "{Remote client: [%s], shard: [%d]}" % (self.login_details.unique_id, self.shard_index)
+
+
+# Matches the waiting clients of the shards of a sharded governor with each other, each shard only holding its own.
+#
+# Shards tell each other which of their clients are waiting, so that each holds an index of the other shards'
+# waiting clients. A client left unmatched by a matchmaking pass is offered the nearest suitable waiting client of a
+# higher shard, only higher so that two shards never offer their clients to each other. Both clients stop waiting
+# until the offer is answered, the other shard accepting if its client is still waiting and sending its profile back.
+#
+# The offering shard then holds the accepted client in a room in the same way as an offline client, so that it holds
+# its session. Once told so, the other shard moves the accepted client's TCP connection over to it through the front,
+# and the offering shard takes the client over in place of the offline one, see Shard.migrateClient. If the connection
+# can't be moved, it is dropped instead, and the client reconnects with its session hash, which the front routes to
+# the shard holding the session, see ShardFront.
+#
+# Offers and acceptances left unanswered by a shard which goes away are abandoned, and their clients wait again.
+class ShardMatchmaker(object):
+    # A declined client isn't offered again for a while, it may be unable to match at all.
+    DECLINED_SECONDS = 10
+
+    def __init__(self, house, shardIndex, sendToShardFunc, migrateClientFunc):
+        super(ShardMatchmaker, self).__init__()
+        assert isinstance(house, House)
+
+        self.house = house
+        self.shard_index = shardIndex
+        self.send_to_shard_func = sendToShardFunc
+        self.migrate_client_func = migrateClientFunc
+
+        # Unique ID -> waiting client of another shard, and the same by location, bucketed as the house's waiting index.
+        self.remote_waiting_by_key = dict()
+        self.remote_waiting_index = SpatialIndex()
+
+        # Offer ID -> (our client, remote client it was offered), until answered.
+        self.offers = dict()
+        self.next_offer_id = 0
+
+        # Unique IDs of remote clients which have been offered a match, or declined one recently.
+        self.offered_keys = set()
+        self.declined_keys = set()
+
+        # (shard index, unique ID) -> our client accepted by an offer of that shard, until handed over.
+        self.accepted_clients = dict()
+
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.register(ShardMessages.WAITING, self.onRemoteWaiting)
+        self.dispatcher.register(ShardMessages.NOT_WAITING, self.onRemoteNotWaiting)
+        self.dispatcher.register(ShardMessages.MATCH_OFFER, self.onMatchOffer)
+        self.dispatcher.register(ShardMessages.MATCH_ACCEPTED, self.onMatchAccepted)
+        self.dispatcher.register(ShardMessages.MATCH_DECLINED, self.onMatchDeclined)
+        self.dispatcher.register(ShardMessages.HAND_OVER, self.onHandOver)
+
+        self.period_metrics = PeriodMetrics('offered', 'accepted', 'handed_over', 'reconnected')
+
+    def handleShardMessage(self, shardIndex, packet):
+        assert isinstance(packet, ByteBuffer)
+        if not self.dispatcher.dispatch(shardIndex, packet):
+            logger.error("Unknown message received from shard [%d]" % shardIndex)
+
+    # Called with the house lock held, see House._addToWaitingList.
+    def onWaitingChange(self, client, isWaiting):
+        if isWaiting:
+            packet = self._buildWaitingPacket(client)
+        else:
+            packet = ShardMessages.NOT_WAITING.encode(client.login_details.unique_id)
+        self.send_to_shard_func(ALL_SHARDS, packet)
+
+    @staticmethod
+    def _buildWaitingPacket(client):
+        loginDetails = client.login_details
+        gender, genderWanted = House._getWaitingIndexBucket(client)
+        return ShardMessages.WAITING.encode(loginDetails.unique_id, loginDetails.persisted_unique_id, gender, genderWanted,
+                                            loginDetails.longitude, loginDetails.latitude)
+
+    def isWaitingRemotely(self, uniqueId):
+        return uniqueId in self.remote_waiting_by_key
+
+    def onShardJoined(self, shardIndex):
+        self.house.house_lock.acquire()
+        try:
+            packets = [ShardMatchmaker._buildWaitingPacket(client) for client in self.house.waiting_keys_by_client]
+        finally:
+            self.house.house_lock.release()
+
+        for packet in packets:
+            self.send_to_shard_func(shardIndex, packet)
+
+    # Its clients are no longer waiting, and it won't answer offers or hand over clients.
+    def onShardLeft(self, shardIndex):
+        for uniqueId, remoteClient in self.remote_waiting_by_key.items():
+            if remoteClient.shard_index == shardIndex:
+                self._removeRemoteWaiting(uniqueId)
+
+        for offerId, (client, remoteClient) in self.offers.items():
+            if remoteClient.shard_index == shardIndex:
+                del self.offers[offerId]
+                self.offered_keys.discard(remoteClient.login_details.unique_id)
+                self.house.addToMatchmaking(client)
+
+        for key, client in self.accepted_clients.items():
+            if key[0] == shardIndex:
+                del self.accepted_clients[key]
+                self.house.addToMatchmaking(client)
+
+    def onRemoteWaiting(self, shardIndex, message):
+        self._removeRemoteWaiting(message.unique_id)
+
+        loginDetails = Client.LoginDetails(message.unique_id, message.persisted_id, None, None, None, message.gender,
+                                           message.gender_wanted, message.longitude, message.latitude, None, None, None)
+        remoteClient = RemoteWaitingClient(shardIndex, loginDetails)
+        self.remote_waiting_by_key[message.unique_id] = remoteClient
+        self.remote_waiting_index.add(remoteClient, (message.gender, message.gender_wanted), message.longitude, message.latitude)
+
+    def onRemoteNotWaiting(self, shardIndex, message):
+        self._removeRemoteWaiting(message.unique_id)
+
+    def _removeRemoteWaiting(self, uniqueId):
+        remoteClient = self.remote_waiting_by_key.pop(uniqueId, None)
+        if remoteClient is not None:
+            self.remote_waiting_index.remove(remoteClient)
+
+    # Returns true if the client, left unmatched by this shard, has been offered to a client of another shard.
+    def offerMatch(self, client):
+        if len(self.remote_waiting_by_key) == 0 or client.karma_rating == 0:
+            return False
+
+        remoteClient = self._findCandidate(client)
+        if remoteClient is None:
+            return False
+
+        self.house.house_lock.acquire()
+        try:
+            if not self.house._isWaiting(client) or not self.house._isLookingForMatch(client) or client in self.house.offline_searches:
+                return False
+
+            # Not matched here until the offer is answered.
+            self.house._removeFromWaitingList(client, removeOfflineFromDatabase=False)
+            self.house.matchmaking_clients.pop(client, None)
+
+            offerId = self.next_offer_id
+            self.next_offer_id = (self.next_offer_id + 1) % (2 ** 32)
+            self.offers[offerId] = (client, remoteClient)
+        finally:
+            self.house.house_lock.release()
+
+        self.offered_keys.add(remoteClient.login_details.unique_id)
+        self.period_metrics.offered += 1
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Offering client [%s] to waiting client [%s]" % (client, remoteClient))
+
+        loginDetails = client.login_details
+        self.send_to_shard_func(remoteClient.shard_index, ShardMessages.MATCH_OFFER.encode(offerId, remoteClient.login_details.unique_id,
+                                                                                           loginDetails.unique_id, loginDetails.persisted_unique_id))
+        return True
+
+    # Nearest waiting client of a higher shard which both would match with, in the same way as House.findOnlinePairs.
+    def _findCandidate(self, client):
+        loginDetails = client.login_details
+        bucket = House._getWaitingIndexBucket(client)
+        buckets = House._getCandidateBuckets(client, self.remote_waiting_index.cells_by_bucket.keys())
+
+        candidateCount = 0
+        for remoteClient, distance in self.remote_waiting_index.iterateNearest(loginDetails.longitude, loginDetails.latitude, buckets):
+            candidateCount += 1
+            if candidateCount > House.MAX_ONLINE_CANDIDATES:
+                break
+
+            uniqueId = remoteClient.login_details.unique_id
+            if remoteClient.shard_index < self.shard_index or uniqueId in self.offered_keys or uniqueId in self.declined_keys:
+                continue
+
+            # Same person on a different connection.
+            if remoteClient.login_details.persisted_unique_id == loginDetails.persisted_unique_id:
+                continue
+
+            if bucket not in House._getCandidateBuckets(remoteClient, [bucket]):
+                continue
+
+            # Our client's relations cover both sides, the other shard checks its client's as well.
+            if not self.house.didRecentlySkip(client, remoteClient) and not self.house.didBlock(client, remoteClient):
+                return remoteClient
+
+        return None
+
+    def onMatchOffer(self, shardIndex, message):
+        loginDetails = Client.LoginDetails(message.offering_unique_id, message.offering_persisted_id, None, None, None,
+                                           None, None, None, None, None, None, None)
+        offeringClient = RemoteWaitingClient(shardIndex, loginDetails)
+
+        self.house.house_lock.acquire()
+        try:
+            client = self.house.waiting_clients_by_key.get(message.unique_id)
+            isAccepted = client is not None and self.house._isWaiting(client) and self.house._isLookingForMatch(client) and \
+                         client not in self.house.offline_searches and client.karma_rating > 0 and \
+                         not self.house.didRecentlySkip(client, offeringClient) and not self.house.didBlock(client, offeringClient)
+
+            # Not matched here until handed over.
+            if isAccepted:
+                self.house._removeFromWaitingList(client, removeOfflineFromDatabase=False)
+                self.house.matchmaking_clients.pop(client, None)
+                self.accepted_clients[(shardIndex, message.unique_id)] = client
+        finally:
+            self.house.house_lock.release()
+
+        if not isAccepted:
+            self.send_to_shard_func(shardIndex, ShardMessages.MATCH_DECLINED.encode(message.offer_id))
+            return
+
+        self.period_metrics.accepted += 1
+
+        loginDetails = client.login_details
+        self.send_to_shard_func(shardIndex, ShardMessages.MATCH_ACCEPTED.encode(message.offer_id, loginDetails.unique_id, loginDetails.persisted_unique_id,
+                                                                                loginDetails.name, loginDetails.short_name, loginDetails.age,
+                                                                                loginDetails.gender, loginDetails.interested_in,
+                                                                                loginDetails.longitude, loginDetails.latitude,
+                                                                                loginDetails.card_text, loginDetails.profile_picture,
+                                                                                loginDetails.profile_picture_orientation, client.karma_rating))
+
+    def onMatchAccepted(self, shardIndex, message):
+        offer = self.offers.pop(message.offer_id, None)
+
+        isTaken = False
+        if offer is not None:
+            client, remoteClient = offer
+            self.offered_keys.discard(remoteClient.login_details.unique_id)
+
+            clientMatch = self._synthesizeClient(message)
+            self.house.house_lock.acquire()
+            try:
+                # Session may be held here already, e.g. by an offline match made meanwhile.
+                isTaken = self.house._isLookingForMatch(client) and not self.house.udp_connection_linker.isSessionHeld(clientMatch.udp_hash)
+                if isTaken:
+                    self.house.takeRoom(client, clientMatch)
+            finally:
+                self.house.house_lock.release()
+
+            if not isTaken:
+                self.house.addToMatchmaking(client)
+
+        # Sent once the room holds the accepted client's session, so that it can be moved here.
+        self.send_to_shard_func(shardIndex, ShardMessages.HAND_OVER.encode(message.unique_id, 1 if isTaken else 0))
+
+    # Held in the room in the same way as an offline client, until it is moved or reconnects here, see Matching.synthesizeClient.
+    def _synthesizeClient(self, message):
+        client = self.house.build_offline_client_func()
+        client.login_details = Client.LoginDetails(message.unique_id, message.persisted_id, message.name, message.short_name, message.age,
+                                                   message.gender, message.interested_in, message.longitude, message.latitude,
+                                                   message.card_text, message.profile_picture, message.profile_picture_orientation)
+        client.login_details.encodeCard()
+        client.udp_hash = client.login_details.unique_id
+        client.karma_rating = message.karma
+        return client
+
+    def onMatchDeclined(self, shardIndex, message):
+        offer = self.offers.pop(message.offer_id, None)
+        if offer is None:
+            return
+
+        client, remoteClient = offer
+        uniqueId = remoteClient.login_details.unique_id
+        self.offered_keys.discard(uniqueId)
+        self.declined_keys.add(uniqueId)
+        self.house.timing_wheel.callLater(ShardMatchmaker.DECLINED_SECONDS, self.declined_keys.discard, uniqueId)
+
+        self.house.addToMatchmaking(client)
+
+    def onHandOver(self, shardIndex, message):
+        client = self.accepted_clients.pop((shardIndex, message.unique_id), None)
+        if client is None:
+            return
+
+        if not message.is_taken:
+            self.house.addToMatchmaking(client)
+        elif client.connection_status == Client.ConnectionStatus.CONNECTED and self.migrate_client_func(shardIndex, client):
+            self.period_metrics.handed_over += 1
+        else:
+            # Reconnects with its session hash, which the other shard now holds.
+            self.period_metrics.reconnected += 1
+            client.closeConnection()
+
+    def reportStatistics(self):
+        period = self.period_metrics.take()
+        logger.info("Cross shard matching: remote waiting clients [%d], offers pending [%d], made [%d], accepted [%d], handed over [%d], reconnected [%d]" %
+                    (len(self.remote_waiting_by_key), len(self.offers), period['offered'], period['accepted'], period['handed_over'], period['reconnected']))
+
+
+class ShardMatchmakerTest(unittest.TestCase):
+    # Holds waiting clients and rooms in memory, without a database.
+    class FakeHouse(House):
+        def __init__(self, test):
+            self.house_lock = RLock()
+            self.udp_connection_linker = UdpConnectionLinker(dict(), SessionHashSigner("secret", "governor"))
+            self.build_offline_client_func = ShardMatchmakerTest.FakeClient
+            self.room_participant = dict()
+            self.waiting_clients_by_key = dict()
+            self.waiting_keys_by_client = dict()
+            self.waiting_index = SpatialIndex()
+            self.offline_searches = set()
+            self.matchmaking_clients = dict()
+            self.remote_matchmaker = None
+            self.timing_wheel = test
+
+        def removeMatch(self, client):
+            pass
+
+        def takeRoom(self, clientA, clientB):
+            self._removeFromWaitingList(clientA)
+            self.room_participant[clientA] = clientB
+            self.room_participant[clientB] = clientA
+
+        def didRecentlySkip(self, skipperClient, skippedClient):
+            return False
+
+        def didBlock(self, blockerClient, blockedClient, checkBothSides=True):
+            return False
+
+    class FakeClient(object):
+        def __init__(self, uniqueId=None, longitude=0.0):
+            self.login_details = Client.LoginDetails(uniqueId, "persisted_%s" % uniqueId, "Name", "Short", 25, 1, 3, longitude, 0.0,
+                                                     "Card", ByteBuffer.buildFromIterable("picture"), 0)
+            self.connection_status = Client.ConnectionStatus.CONNECTED
+            self.state = Client.State.MATCHING
+            self.waiting_for_rating_task = None
+            self.should_notify_on_match_accept = False
+            self.karma_rating = 5
+            self.udp_hash = uniqueId
+            self.is_closed = False
+
+        def closeConnection(self):
+            self.is_closed = True
+
+    def setUp(self):
+        # (from shard, to shard, packet) not yet delivered, and clients each shard was asked to migrate.
+        self.sent = []
+        self.migrated = []
+        self.migrate_result = True
+        self.calls_later = []
+        self.matchmakers = [self.buildMatchmaker(shardIndex) for shardIndex in range(2)]
+
+    def buildMatchmaker(self, shardIndex):
+        house = ShardMatchmakerTest.FakeHouse(self)
+        matchmaker = ShardMatchmaker(house, shardIndex,
+                                     lambda targetIndex, packet: self.sent.append((shardIndex, targetIndex, packet.convertToString())),
+                                     lambda targetIndex, client: self.migrate(shardIndex, targetIndex, client))
+        house.remote_matchmaker = matchmaker
+        return matchmaker
+
+    def migrate(self, shardIndex, targetIndex, client):
+        self.migrated.append((shardIndex, targetIndex, client))
+        return self.migrate_result
+
+    # Timing wheel of the houses.
+    def callLater(self, delay, func, *args):
+        self.calls_later.append((delay, func, args))
+
+    # Passes the messages between the shards, as the front does, including those sent in answer.
+    def deliver(self):
+        while len(self.sent) > 0:
+            shardIndex, targetIndex, data = self.sent.pop(0)
+            for matchmaker in self.matchmakers:
+                if matchmaker.shard_index != shardIndex and targetIndex in (ALL_SHARDS, matchmaker.shard_index):
+                    matchmaker.handleShardMessage(shardIndex, ByteBuffer.buildFromIterable(data))
+
+    def addWaiting(self, shardIndex, uniqueId, longitude=0.0):
+        client = ShardMatchmakerTest.FakeClient(uniqueId, longitude)
+        self.matchmakers[shardIndex].house._addToWaitingList(client)
+        self.deliver()
+        return client
+
+    def testOffer(self):
+        clientA = self.addWaiting(0, "a")
+        clientB = self.addWaiting(1, "b")
+        self.assertTrue(self.matchmakers[0].isWaitingRemotely("b"))
+        self.assertTrue(self.matchmakers[1].isWaitingRemotely("a"))
+
+        # Only offered to higher shards.
+        self.assertFalse(self.matchmakers[1].offerMatch(clientB))
+        self.assertTrue(self.matchmakers[0].offerMatch(clientA))
+        self.assertEquals(self.matchmakers[0].offers.values(), [(clientA, self.matchmakers[0].remote_waiting_by_key["b"])])
+        self.assertNotIn(clientA, self.matchmakers[0].house.waiting_keys_by_client)
+
+        # Not offered twice while the offer is pending, and no longer waiting as far as the other shard knows.
+        self.assertEquals([(0, 1), (0, ALL_SHARDS)], sorted((shardIndex, targetIndex) for shardIndex, targetIndex, data in self.sent))
+        self.sent = [message for message in self.sent if message[1] == ALL_SHARDS]
+        self.deliver()
+        self.assertFalse(self.matchmakers[1].isWaitingRemotely("a"))
+        self.assertIn("b", self.matchmakers[0].offered_keys)
+
+    def testAcceptAndHandOver(self):
+        clientA = self.addWaiting(0, "a")
+        clientB = self.addWaiting(1, "b")
+        self.assertTrue(self.matchmakers[0].offerMatch(clientA))
+        self.deliver()
+
+        # Shard 0 holds B in a room with A, and shard 1 moves B's connection over.
+        houseA = self.matchmakers[0].house
+        synthB = houseA.room_participant[clientA]
+        self.assertEquals(synthB.login_details.unique_id, "b")
+        self.assertEquals(synthB.login_details.card_text, "Card")
+        self.assertEquals(synthB.karma_rating, 5)
+        self.assertIs(houseA.room_participant[synthB], clientA)
+        self.assertEquals(self.migrated, [(1, 0, clientB)])
+        self.assertFalse(clientB.is_closed)
+
+        self.assertEquals(self.matchmakers[0].offers, dict())
+        self.assertEquals(self.matchmakers[1].accepted_clients, dict())
+        self.assertNotIn(clientB, self.matchmakers[1].house.waiting_keys_by_client)
+        self.assertNotIn(clientB, self.matchmakers[1].house.matchmaking_clients)
+        self.assertEquals(self.matchmakers[1].period_metrics.handed_over, 1)
+
+    def testHandOverFallsBackToReconnect(self):
+        clientA = self.addWaiting(0, "a")
+        clientB = self.addWaiting(1, "b")
+        self.migrate_result = False
+        self.matchmakers[0].offerMatch(clientA)
+        self.deliver()
+
+        self.assertTrue(clientB.is_closed)
+        self.assertEquals(self.matchmakers[1].period_metrics.reconnected, 1)
+
+    def testHandOverNotTaken(self):
+        clientA = self.addWaiting(0, "a")
+        clientB = self.addWaiting(1, "b")
+        self.matchmakers[0].offerMatch(clientA)
+
+        # A is matched elsewhere before the acceptance arrives, so B waits again.
+        clientA.state = Client.State.MATCHED
+        self.deliver()
+
+        self.assertEquals(self.migrated, [])
+        self.assertIn(clientB, self.matchmakers[1].house.matchmaking_clients)
+        self.assertEquals(self.matchmakers[0].house.room_participant, dict())
+
+    def testDecline(self):
+        clientA = self.addWaiting(0, "a")
+        clientB = self.addWaiting(1, "b")
+        self.assertTrue(self.matchmakers[0].offerMatch(clientA))
+
+        # B stops waiting before the offer arrives.
+        self.matchmakers[1].house._removeFromWaitingList(clientB)
+        self.deliver()
+
+        self.assertIn(clientA, self.matchmakers[0].house.matchmaking_clients)
+        self.assertEquals(self.matchmakers[0].offers, dict())
+        self.assertEquals(self.matchmakers[0].declined_keys, set(["b"]))
+        self.assertEquals(self.matchmakers[0].house.room_participant, dict())
+
+        # Not offered again until the decline expires.
+        self.addWaiting(1, "b")
+        self.assertFalse(self.matchmakers[0].offerMatch(clientA))
+        delay, func, args = self.calls_later[0]
+        self.assertEquals(delay, ShardMatchmaker.DECLINED_SECONDS)
+        func(*args)
+        self.assertEquals(self.matchmakers[0].declined_keys, set())
+
+    def testShardLeft(self):
+        clientA = self.addWaiting(0, "a")
+        clientB = self.addWaiting(1, "b")
+        self.assertTrue(self.matchmakers[0].offerMatch(clientA))
+
+        # Offer reaches shard 1, which accepts, but shard 0 goes away before the acceptance arrives.
+        shardIndex, targetIndex, data = [message for message in self.sent if message[1] == 1][0]
+        self.sent = []
+        self.matchmakers[1].handleShardMessage(shardIndex, ByteBuffer.buildFromIterable(data))
+        self.assertEquals(self.matchmakers[1].accepted_clients.values(), [clientB])
+
+        self.matchmakers[1].onShardLeft(0)
+        self.assertIn(clientB, self.matchmakers[1].house.matchmaking_clients)
+        self.assertEquals(self.matchmakers[1].accepted_clients, dict())
+        self.assertFalse(self.matchmakers[1].isWaitingRemotely("a"))
+
+        # Shard 1 goes away from shard 0's point of view, with the offer unanswered.
+        self.matchmakers[0].onShardLeft(1)
+        self.assertIn(clientA, self.matchmakers[0].house.matchmaking_clients)
+        self.assertEquals(self.matchmakers[0].offers, dict())
+        self.assertEquals(self.matchmakers[0].offered_keys, set())
+        self.assertFalse(self.matchmakers[0].isWaitingRemotely("b"))
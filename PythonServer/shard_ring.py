@@ -0,0 +1,102 @@
+import bisect
+import hashlib
+import struct
+import unittest
+
+# Consistent hash ring, deciding which shard of a sharded governor owns each client.
+#
+# Each shard is placed at many points on the ring, a key belongs to the shard at the first point after
+# the key's own hash. When a shard leaves (e.g. its process has crashed) only its keys move to other
+# shards, and they move back when it returns.
+class ConsistentHashRing(object):
+    VIRTUAL_NODES = 100
+
+    def __init__(self, virtualNodes=VIRTUAL_NODES):
+        super(ConsistentHashRing, self).__init__()
+        self.virtual_nodes = virtualNodes
+
+        # Sorted hashes of each point, and the node at each point.
+        self.points = []
+        self.nodes_by_point = dict()
+
+        self.nodes = set()
+
+    @staticmethod
+    def getHash(key):
+        return struct.unpack_from(">Q", hashlib.md5(str(key)).digest())[0]
+
+    def addNode(self, node):
+        if node in self.nodes:
+            return
+
+        self.nodes.add(node)
+        for replica in range(self.virtual_nodes):
+            point = ConsistentHashRing.getHash("%s:%d" % (node, replica))
+
+            # Hash collisions between points are vanishingly rare, the earlier node keeps the point.
+            if point in self.nodes_by_point:
+                continue
+
+            self.nodes_by_point[point] = node
+            bisect.insort(self.points, point)
+
+    def removeNode(self, node):
+        if node not in self.nodes:
+            return
+
+        self.nodes.discard(node)
+        self.points = [point for point in self.points if self.nodes_by_point[point] != node]
+        for point in self.nodes_by_point.keys():
+            if self.nodes_by_point[point] == node:
+                del self.nodes_by_point[point]
+
+    # Returns None if there are no nodes.
+    def getNode(self, key):
+        if len(self.points) == 0:
+            return None
+
+        index = bisect.bisect(self.points, ConsistentHashRing.getHash(key))
+        if index == len(self.points):
+            index = 0
+
+        return self.nodes_by_point[self.points[index]]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class ConsistentHashRingTest(unittest.TestCase):
+    def testDistribution(self):
+        ring = ConsistentHashRing()
+        self.assertIsNone(ring.getNode("a"))
+
+        for node in range(4):
+            ring.addNode(node)
+
+        counts = dict()
+        for key in range(10000):
+            node = ring.getNode("key%d" % key)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEquals(sorted(counts.keys()), [0, 1, 2, 3])
+        for count in counts.itervalues():
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def testOnlyKeysOfRemovedNodeMove(self):
+        ring = ConsistentHashRing()
+        for node in range(4):
+            ring.addNode(node)
+
+        keys = ["key%d" % key for key in range(1000)]
+        before = dict((key, ring.getNode(key)) for key in keys)
+
+        ring.removeNode(2)
+        self.assertEquals(len(ring), 3)
+        for key in keys:
+            if before[key] != 2:
+                self.assertEquals(ring.getNode(key), before[key])
+            else:
+                self.assertNotEquals(ring.getNode(key), 2)
+
+        ring.addNode(2)
+        self.assertEquals(dict((key, ring.getNode(key)) for key in keys), before)
@@ -0,0 +1,1041 @@
+from twisted.internet import reactor, protocol, task
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from twisted.python.failure import Failure
+from zope.interface import implementer
+from byte_buffer import ByteBuffer
+from protocol_client import ClientTcp
+from relay_worker import RelayChannel, RelayWorker
+from forwarding_table import ForwardingTable
+from session_hash import SessionHashSigner
+from shard_ring import ConsistentHashRing
+from stat_tracker import StatTracker, PeriodMetrics
+from utility import DataConstants, parseLogLevel
+import logging
+import argparse
+import socket
+import struct
+import sys
+import os
+import unittest
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+# Target of a message between shards which is for every other shard, see ShardFront.forwardShardMessage.
+ALL_SHARDS = 0xFFFFFFFF
+
+# Clients are owned by the shard which the identity of their persisted ID hashes to. Reconnecting clients
+# present a session hash, which carries the same identity, see SessionHashSigner.
+def getSessionHashIdentity(sessionHash):
+    fields = str(sessionHash).split(SessionHashSigner.SEPARATOR)
+    if len(fields) != 4:
+        return None
+
+    return fields[1]
+
+# Returns (session hash, identity) of the client sending a logon packet, see Client.handleLogon and TcpMessages.LOGON
+# (the client module is too heavy to import here), or (None, None) if the packet is malformed. The session hash is
+# None unless the client is reconnecting. Reconnecting clients send their persisted ID too, which we use so that
+# a stale session hash can't move them.
+def getLogonSession(packet):
+    assert isinstance(packet, ByteBuffer)
+
+    try:
+        sessionHash = None
+        if packet.getUnsignedInteger8() > 0:
+            sessionHash = packet.getString()
+
+        packet.getUnsignedInteger() # version
+        packet.getUnsignedInteger8() # is new ID
+        persistedId = packet.getString()
+    except Exception as e:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Malformed logon packet: %s" % e)
+        return None, None
+
+    if persistedId is None:
+        return None, None
+
+    return sessionHash, SessionHashSigner.getIdentity(persistedId)
+
+# True if data written to a TCP transport is still buffered, Twisted has no public way of asking, see FileDescriptor.doWrite.
+def hasPendingWrites(tcpTransport):
+    return len(tcpTransport.dataBuffer) > tcpTransport.offset or tcpTransport._tempDataLen > 0
+
+# Reads the first packet of a client's TCP connection, so that the connection can be handed to its shard.
+class ShardDispatchProtocol(protocol.Protocol):
+    def __init__(self, front):
+        self.front = front
+        self.received = []
+        self.received_size = 0
+        self.packet_size = None
+        self.is_dispatched = False
+
+    def dataReceived(self, data):
+        # Reading stops once dispatched, but data may already be on its way to us.
+        if self.is_dispatched:
+            return
+
+        self.received.append(data)
+        self.received_size += len(data)
+
+        if self.packet_size is None:
+            if self.received_size < ClientTcp.prefixLength:
+                return
+
+            self.received = [''.join(self.received)]
+            self.packet_size = struct.unpack_from(ClientTcp.structFormat, self.received[0])[0]
+            if self.packet_size > ClientTcp.MAX_LENGTH:
+                self.transport.loseConnection()
+                return
+
+        if self.received_size < ClientTcp.prefixLength + self.packet_size:
+            return
+
+        # Everything received is replayed by the shard.
+        received = ''.join(self.received)
+        self.received = []
+        self.is_dispatched = True
+
+        packet = ByteBuffer.buildFromIterable(received[ClientTcp.prefixLength:ClientTcp.prefixLength + self.packet_size])
+        sessionHash, identity = getLogonSession(packet)
+        self.front.dispatchConnection(self.transport, sessionHash, identity, received)
+
+# Front process UDP, relays datagrams of matched rooms using the routes pushed by every shard, and passes
+# anything else to the shard which owns the client.
+#
+# Relay workers may share the port with us, we keep their routes in sync with those of every shard in the same
+# way as a ForwardingTable does for a governor's workers, see RelayWorkerPool.
+class ShardRelay(RelayWorker):
+    def __init__(self, front, sessionHashSigner):
+        RelayWorker.__init__(self, sessionHashSigner)
+        self.front = front
+
+        # Shard index -> source addresses of the routes it added, and the same for connection IDs,
+        # so that a shard's routes can be removed when it goes away.
+        self.routes_by_shard = dict()
+        self.connection_ids_by_shard = dict()
+
+        # UDP address -> index of the shard which registered a connection ID for it, and the same by connection ID,
+        # which a client keeps when moved to another shard, see Shard.migrateClient.
+        self.shards_by_address = dict()
+        self.shards_by_connection_id = dict()
+
+        self.bytes_forwarded = 0
+
+        # Called with (source address, peer address or None) and (connection ID, address or None) on each change.
+        self.route_listeners = []
+        self.connection_id_listeners = []
+
+    def addListener(self, listenerFunc):
+        self.route_listeners.append(listenerFunc)
+
+    def addConnectionIdListener(self, listenerFunc):
+        self.connection_id_listeners.append(listenerFunc)
+
+    def _notifyRouteListeners(self, sourceAddress, peerAddress):
+        for listenerFunc in self.route_listeners:
+            listenerFunc(sourceAddress, peerAddress)
+
+    def _notifyConnectionIdListeners(self, connectionId, address):
+        for listenerFunc in self.connection_id_listeners:
+            listenerFunc(connectionId, address)
+
+    def getRoutes(self):
+        return dict(self.routes)
+
+    def getConnectionIds(self):
+        return dict(self.connection_id_addresses)
+
+    # The front reports load to the commander itself.
+    def startProtocol(self):
+        pass
+
+    def stopProtocol(self):
+        pass
+
+    def getShardOfDatagram(self, data, remoteAddress):
+        connectionId = ForwardingTable.parseConnectionId(data)
+        if connectionId is not None:
+            return self.front.getShardOfConnectionId(connectionId)
+
+        if data[:1] == RelayWorker.UDP_HASH_PREFIX:
+            packet = ByteBuffer.buildFromIterable(data)
+            packet.getUnsignedInteger8()
+            sessionHash = packet.getString()
+            return self.front.getShardOfSession(sessionHash, getSessionHashIdentity(sessionHash))
+
+        shardIndex = self.shards_by_address.get(remoteAddress)
+        if shardIndex is None:
+            return None
+        return self.front.links.get(shardIndex)
+
+    def forwardUnknownDatagram(self, data, remoteAddress):
+        link = self.getShardOfDatagram(data, remoteAddress)
+        if link is None:
+            return
+
+        self.bytes_forwarded += len(data)
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_UNKNOWN_DATAGRAM)
+        RelayChannel.addAddress(packet, remoteAddress)
+        packet.addString(data)
+        link.sendByteBuffer(packet)
+
+    # Route changes of a shard, see RelayWorkerPool.
+    def handleShardPacket(self, link, packet):
+        assert isinstance(packet, ByteBuffer)
+
+        shardIndex = link.shard_index
+        opCode = packet.getUnsignedInteger8()
+        if opCode == RelayChannel.OperationCodes.OP_CLEAR_ROUTES:
+            self.clearShard(shardIndex)
+        elif opCode == RelayChannel.OperationCodes.OP_ADD_ROUTE:
+            sourceAddress = RelayChannel.getAddress(packet)
+            peerAddress = RelayChannel.getAddress(packet)
+            self.routes_by_shard.setdefault(shardIndex, set()).add(sourceAddress)
+            self.routes[sourceAddress] = peerAddress
+            self._notifyRouteListeners(sourceAddress, peerAddress)
+        elif opCode == RelayChannel.OperationCodes.OP_REMOVE_ROUTE:
+            sourceAddress = RelayChannel.getAddress(packet)
+            self.routes_by_shard.get(shardIndex, set()).discard(sourceAddress)
+            self.routes.pop(sourceAddress, None)
+            self._notifyRouteListeners(sourceAddress, None)
+        elif opCode == RelayChannel.OperationCodes.OP_ADD_CONNECTION_ID:
+            connectionId = packet.getUnsignedInteger()
+            address = RelayChannel.getAddress(packet)
+            self.connection_ids_by_shard.setdefault(shardIndex, set()).add(connectionId)
+            self.shards_by_connection_id[connectionId] = shardIndex
+            self.shards_by_address[address] = shardIndex
+            self.connection_id_addresses[connectionId] = address
+            self._notifyConnectionIdListeners(connectionId, address)
+        elif opCode == RelayChannel.OperationCodes.OP_REMOVE_CONNECTION_ID:
+            # A shard moving a client removes its connection ID before the move, so this never
+            # arrives after the other shard has added it.
+            connectionId = packet.getUnsignedInteger()
+            self.connection_ids_by_shard.get(shardIndex, set()).discard(connectionId)
+            self._forgetAddressOfConnectionId(connectionId, shardIndex)
+            self.connection_id_addresses.pop(connectionId, None)
+            self._notifyConnectionIdListeners(connectionId, None)
+        else:
+            logger.error("Unknown route change received from shard [%d], op code: %d" % (shardIndex, opCode))
+
+    def _forgetAddressOfConnectionId(self, connectionId, shardIndex):
+        if self.shards_by_connection_id.get(connectionId) == shardIndex:
+            del self.shards_by_connection_id[connectionId]
+
+        address = self.connection_id_addresses.get(connectionId)
+        if address is not None and self.shards_by_address.get(address) == shardIndex:
+            del self.shards_by_address[address]
+
+    def clearShard(self, shardIndex):
+        for sourceAddress in self.routes_by_shard.pop(shardIndex, set()):
+            self.routes.pop(sourceAddress, None)
+            self._notifyRouteListeners(sourceAddress, None)
+
+        for connectionId in self.connection_ids_by_shard.pop(shardIndex, set()):
+            self._forgetAddressOfConnectionId(connectionId, shardIndex)
+            self.connection_id_addresses.pop(connectionId, None)
+            self._notifyConnectionIdListeners(connectionId, None)
+
+# Front side of the channel with a shard, over a UNIX socket so that client connections can be passed along it.
+@implementer(IFileDescriptorReceiver)
+class ShardLink(RelayChannel):
+    def __init__(self, front):
+        RelayChannel.__init__(self, self.handleShardPacket)
+        self.front = front
+
+        # Known once the shard has introduced itself.
+        self.shard_index = None
+
+        self.is_overloaded = False
+
+        # Handoff ID -> TCP transport of a client connection which the shard is adopting, or our descriptor
+        # of a connection moved from another shard. We hold the connection open until then.
+        self.pending_handoffs = dict()
+        self.next_handoff_id = 0
+
+        # Descriptors of client connections which the shard is moving, received ahead of the packets which describe them.
+        self.file_descriptors = []
+
+    def fileDescriptorReceived(self, descriptor):
+        self.file_descriptors.append(descriptor)
+
+    def handleShardPacket(self, packet):
+        assert isinstance(packet, ByteBuffer)
+
+        opCode = packet.getUnsignedIntegerAtPosition8(packet.cursor_position)
+        if self.shard_index is None:
+            if opCode != RelayChannel.OperationCodes.OP_SHARD_HELLO:
+                logger.error("Shard sent op code [%d] before introducing itself, disconnecting" % opCode)
+                self.transport.loseConnection()
+                return
+
+            packet.getUnsignedInteger8()
+            self.shard_index = packet.getUnsignedInteger()
+            self.front.onShardConnected(self)
+        elif opCode == RelayChannel.OperationCodes.OP_SEND_DATAGRAM:
+            packet.getUnsignedInteger8()
+            address = RelayChannel.getAddress(packet)
+            self.front.relay.transport.write(packet.getString(), address)
+        elif opCode == RelayChannel.OperationCodes.OP_SHARD_STATUS:
+            packet.getUnsignedInteger8()
+            self.is_overloaded = packet.getUnsignedInteger8() > 0
+        elif opCode == RelayChannel.OperationCodes.OP_CONNECTION_ADOPTED:
+            packet.getUnsignedInteger8()
+            handoffId = packet.getUnsignedInteger()
+            isAdopted = packet.getUnsignedInteger8() > 0
+            self.onConnectionAdopted(handoffId, isAdopted)
+        elif opCode == RelayChannel.OperationCodes.OP_HOLD_SESSION or opCode == RelayChannel.OperationCodes.OP_RELEASE_SESSION:
+            packet.getUnsignedInteger8()
+            self.front.onSessionChange(self, packet.getString(), opCode == RelayChannel.OperationCodes.OP_HOLD_SESSION)
+        elif opCode == RelayChannel.OperationCodes.OP_SHARD_MESSAGE:
+            packet.getUnsignedInteger8()
+            targetIndex = packet.getUnsignedInteger()
+            self.front.forwardShardMessage(self, targetIndex, packet.getString())
+        elif opCode == RelayChannel.OperationCodes.OP_MIGRATE_CONNECTION:
+            packet.getUnsignedInteger8()
+            migrationId = packet.getUnsignedInteger()
+            targetIndex = packet.getUnsignedInteger()
+            details = packet.getString()
+            self.front.migrateConnection(self, migrationId, targetIndex, self.file_descriptors.pop(0), details)
+        else:
+            self.front.relay.handleShardPacket(self, packet)
+
+    def handOff(self, tcpTransport, received):
+        self._handOff(RelayChannel.OperationCodes.OP_ADOPT_CONNECTION, tcpTransport.fileno(), tcpTransport, received)
+
+    # Connection of a client which another shard is moving to this one, see Shard.migrateClient.
+    def handOffMigrated(self, descriptor, details):
+        self._handOff(RelayChannel.OperationCodes.OP_ADOPT_MIGRATED_CONNECTION, descriptor, descriptor, details)
+
+    def _handOff(self, opCode, descriptor, pending, payload):
+        handoffId = self.next_handoff_id
+        self.next_handoff_id = (self.next_handoff_id + 1) % (2 ** (8 * DataConstants.ULONG_SIZE))
+        self.pending_handoffs[handoffId] = pending
+
+        # The descriptor is sent along with the next write.
+        self.transport.sendFileDescriptor(descriptor)
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(opCode)
+        packet.addUnsignedInteger(handoffId)
+        packet.addString(payload)
+        self.sendByteBuffer(packet)
+
+    def onConnectionAdopted(self, handoffId, isAdopted):
+        pending = self.pending_handoffs.pop(handoffId, None)
+        if pending is not None:
+            ShardLink._releaseHandOff(pending, isAdopted)
+
+    @staticmethod
+    def _releaseHandOff(pending, isAdopted):
+        # Moved from another shard, which has closed its descriptor already. Ours is the last one
+        # unless the shard adopted the connection, so closing it closes the connection otherwise.
+        if isinstance(pending, (int, long)):
+            os.close(pending)
+            return
+
+        if not isAdopted:
+            pending.loseConnection()
+            return
+
+        # The shard holds its own descriptor now, loseConnection would shut the connection down
+        # for the shard as well, so we only stop watching and close ours.
+        pending.stopWriting()
+        pending.socket.close()
+
+    def connectionLost(self, reason):
+        RelayChannel.connectionLost(self, reason)
+
+        # Clients will reconnect, to the shard which takes over their identities.
+        for pending in self.pending_handoffs.itervalues():
+            ShardLink._releaseHandOff(pending, False)
+        self.pending_handoffs.clear()
+
+        for descriptor in self.file_descriptors:
+            os.close(descriptor)
+        self.file_descriptors = []
+
+        self.front.onShardDisconnected(self, reason)
+
+    def __str__(self):
+        return "{Shard: [%s]}" % self.shard_index
+
+class ShardLinkFactory(protocol.ServerFactory):
+    def __init__(self, front):
+        self.front = front
+
+    def buildProtocol(self, addr):
+        return ShardLink(self.front)
+
+# Front side of a shard process.
+class ShardProcess(protocol.ProcessProtocol):
+    def __init__(self, front, shardIndex):
+        self.front = front
+        self.shard_index = shardIndex
+
+    def processEnded(self, reason):
+        self.front.onShardProcessEnded(self.shard_index, reason)
+
+# Front process of a sharded governor, in place of a Governor.
+#
+# A Governor keeps all its state in one process, so is limited to one core. Here each shard process runs its
+# own Governor and House, owning the clients whose identities hash to it on a consistent hash ring. We accept
+# TCP connections, read the first (logon) packet to find the client's shard and pass the connection's file
+# descriptor to it, after which the shard talks to the client directly.
+#
+# All UDP traffic arrives here, or at relay workers sharing our port, datagrams of matched rooms are relayed using
+# the routes pushed by the shards, see ShardRelay. Towards the commander we appear as a single governor.
+#
+# Shards report the sessions they hold, so that a reconnecting client, and the UDP hash datagrams of its session,
+# reach the shard holding its session. That may not be the shard its identity hashes to now, e.g. while shards
+# are still connecting, or once a shard which was down has returned. Only sessions no shard holds go by the ring.
+#
+# Shards share the governor's waiting list in the database, and match their waiting clients with each other's
+# through us, see ShardMatchmaker. We only pass their messages on, and tell them when other shards come and go.
+class ShardFront(protocol.ServerFactory):
+    RESTART_DELAY = 1
+
+    def __init__(self, reactor, governorName, shardCount, socketPath, logLevel, writeBehindSpool):
+        assert shardCount > 0
+
+        self.reactor = reactor
+        self.governor_name = governorName
+        self.shard_count = shardCount
+        self.log_level = logLevel
+        self.write_behind_spool = writeBehindSpool
+
+        if socketPath is None:
+            socketPath = "hologram_%s.sock" % governorName
+        self.socket_path = os.path.abspath(socketPath)
+
+        self.session_hash_signer = SessionHashSigner(SessionHashSigner.loadSecret(), governorName)
+        self.relay = ShardRelay(self, self.session_hash_signer)
+
+        # Shards which are connected, by index, and on the ring.
+        self.links = dict()
+        self.ring = ConsistentHashRing()
+
+        # Session hash -> index of the shard holding it, and the session hashes held by each shard.
+        self.shards_by_session = dict()
+        self.sessions_by_shard = dict()
+
+        # Track kilobytes per second averaged over last 30 seconds.
+        self.kilobyte_per_second_tracker = StatTracker(1,30)
+
+        # Bytes relayed by relay workers sharing our UDP port, since the load was last calculated, see RelayWorkerPool.
+        self.bytes_received = 0
+
+        self.period_metrics = PeriodMetrics('handed_off', 'migrated', 'dropped')
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.reactor.listenUNIX(self.socket_path, ShardLinkFactory(self))
+
+        for shardIndex in range(self.shard_count):
+            self.spawnShard(shardIndex)
+
+    def spawnShard(self, shardIndex):
+        scriptPath = os.path.abspath(__file__)
+        if scriptPath.endswith('.pyc'):
+            scriptPath = scriptPath[:-1]
+
+        args = [sys.executable, scriptPath,
+                '--shard_index=%d' % shardIndex,
+                '--shard_count=%d' % self.shard_count,
+                '--shard_socket=%s' % self.socket_path,
+                '--governor_name=%s' % self.governor_name,
+                '--log_level=%s' % self.log_level,
+                '--write_behind_spool=%s' % self.write_behind_spool]
+
+        # Shards sign session hashes with the same secret, so that we can verify them.
+        env = dict(os.environ)
+        env['HOLOGRAM_SESSION_SECRET'] = self.session_hash_signer.secret
+
+        logger.info("Starting shard [%d]" % shardIndex)
+        self.reactor.spawnProcess(ShardProcess(self, shardIndex), sys.executable, args, env=env,
+                                  path=os.path.dirname(scriptPath), childFDs={0: 'w', 1: 1, 2: 2})
+
+    def onShardProcessEnded(self, shardIndex, reason):
+        logger.error("Shard [%d] ended, reason: [%s], restarting in %d seconds" % (shardIndex, reason.getErrorMessage(), ShardFront.RESTART_DELAY))
+        self.reactor.callLater(ShardFront.RESTART_DELAY, self.spawnShard, shardIndex)
+
+    def onShardConnected(self, link):
+        logger.info("Shard [%d] connected" % link.shard_index)
+
+        existingLink = self.links.get(link.shard_index)
+        if existingLink is not None:
+            self.relay.clearShard(link.shard_index)
+            self.clearSessions(link.shard_index)
+            self.broadcastShardChange(RelayChannel.OperationCodes.OP_SHARD_LEFT, link.shard_index, existingLink)
+
+        self.links[link.shard_index] = link
+        self.ring.addNode(link.shard_index)
+
+        # Shards tell each other about their waiting clients, see ShardMatchmaker.
+        for otherLink in self.links.values():
+            if otherLink is not link:
+                otherLink.sendByteBuffer(ShardFront.buildShardChangePacket(RelayChannel.OperationCodes.OP_SHARD_JOINED, link.shard_index))
+                link.sendByteBuffer(ShardFront.buildShardChangePacket(RelayChannel.OperationCodes.OP_SHARD_JOINED, otherLink.shard_index))
+
+    def onShardDisconnected(self, link, reason):
+        if link.shard_index is None or self.links.get(link.shard_index) is not link:
+            return
+
+        # Its clients are taken over by the other shards until it returns.
+        logger.warn("Shard [%d] disconnected, reason: [%s]" % (link.shard_index, reason.getErrorMessage()))
+        del self.links[link.shard_index]
+        self.ring.removeNode(link.shard_index)
+        self.relay.clearShard(link.shard_index)
+        self.clearSessions(link.shard_index)
+        self.broadcastShardChange(RelayChannel.OperationCodes.OP_SHARD_LEFT, link.shard_index, link)
+
+    @staticmethod
+    def buildShardChangePacket(opCode, shardIndex):
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(opCode)
+        packet.addUnsignedInteger(shardIndex)
+        return packet
+
+    def broadcastShardChange(self, opCode, shardIndex, exceptLink):
+        packet = ShardFront.buildShardChangePacket(opCode, shardIndex)
+        for otherLink in self.links.values():
+            if otherLink is not exceptLink:
+                otherLink.sendByteBuffer(packet)
+
+    # Passes a message on to the target shard, or to every other shard.
+    def forwardShardMessage(self, link, targetIndex, payload):
+        # Shard has been replaced, its messages are stale.
+        if self.links.get(link.shard_index) is not link:
+            return
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_SHARD_MESSAGE)
+        packet.addUnsignedInteger(link.shard_index)
+        packet.addString(payload)
+
+        if targetIndex == ALL_SHARDS:
+            for otherLink in self.links.values():
+                if otherLink is not link:
+                    otherLink.sendByteBuffer(packet)
+            return
+
+        # Dropped if the shard has gone away, the sender is told so separately.
+        targetLink = self.links.get(targetIndex)
+        if targetLink is not None and targetLink is not link:
+            targetLink.sendByteBuffer(packet)
+
+    # A shard is moving a client's connection to another shard, which holds its session, see Shard.migrateClient.
+    def migrateConnection(self, link, migrationId, targetIndex, descriptor, details):
+        # We hold our own descriptor, so the shard can close its one.
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_CONNECTION_MIGRATED)
+        packet.addUnsignedInteger(migrationId)
+        link.sendByteBuffer(packet)
+
+        targetLink = self.links.get(targetIndex)
+        if targetLink is None or targetLink is link:
+            # Closing the last descriptor closes the connection, the client reconnects.
+            self.period_metrics.dropped += 1
+            os.close(descriptor)
+            return
+
+        targetLink.handOffMigrated(descriptor, details)
+        self.period_metrics.migrated += 1
+
+    def onSessionChange(self, link, sessionHash, isHeld):
+        shardIndex = link.shard_index
+        previousIndex = self.shards_by_session.get(sessionHash)
+        if isHeld:
+            # Taken over, e.g. the client reconnected to another shard before the old session expired.
+            if previousIndex is not None and previousIndex != shardIndex:
+                self.sessions_by_shard.get(previousIndex, set()).discard(sessionHash)
+
+            self.shards_by_session[sessionHash] = shardIndex
+            self.sessions_by_shard.setdefault(shardIndex, set()).add(sessionHash)
+        else:
+            self.sessions_by_shard.get(shardIndex, set()).discard(sessionHash)
+            if previousIndex == shardIndex:
+                del self.shards_by_session[sessionHash]
+
+    def clearSessions(self, shardIndex):
+        for sessionHash in self.sessions_by_shard.pop(shardIndex, set()):
+            if self.shards_by_session.get(sessionHash) == shardIndex:
+                del self.shards_by_session[sessionHash]
+
+    def getShard(self, identity):
+        shardIndex = self.ring.getNode(identity)
+        if shardIndex is None:
+            return None
+        return self.links.get(shardIndex)
+
+    # Shard holding the session, or the shard of the identity if none is.
+    def getShardOfSession(self, sessionHash, identity):
+        if sessionHash is not None:
+            link = self.links.get(self.shards_by_session.get(sessionHash))
+            if link is not None:
+                return link
+
+        if identity is None:
+            return None
+        return self.getShard(identity)
+
+    # Shard which registered the connection ID, or the shard of its partition if none has yet.
+    def getShardOfConnectionId(self, connectionId):
+        shardIndex = self.relay.shards_by_connection_id.get(connectionId)
+        if shardIndex is None:
+            shardIndex = ForwardingTable.getConnectionIdPartition(connectionId, self.shard_count)
+        return self.links.get(shardIndex)
+
+    def buildProtocol(self, addr):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('TCP connection initiated with new client [%s]' % addr)
+        return ShardDispatchProtocol(self)
+
+    def dispatchConnection(self, tcpTransport, sessionHash, identity, received):
+        if identity is None:
+            self.period_metrics.dropped += 1
+            tcpTransport.loseConnection()
+            return
+
+        link = self.getShardOfSession(sessionHash, identity)
+        if link is None:
+            logger.warn("No shards are connected, dropping client connection")
+            self.period_metrics.dropped += 1
+            tcpTransport.loseConnection()
+            return
+
+        tcpTransport.stopReading()
+        link.handOff(tcpTransport, received)
+        self.period_metrics.handed_off += 1
+
+    # Datagram which a relay worker could not relay, see RelayWorkerPool.
+    def datagramReceived(self, data, remoteAddress):
+        self.relay.forwardUnknownDatagram(data, remoteAddress)
+
+    # See Governor.getLoad, we and our relay workers see all UDP traffic of our shards.
+    def getLoad(self):
+        bytesReceived = self.relay.bytes_relayed + self.relay.bytes_forwarded + self.bytes_received
+        self.relay.bytes_relayed = 0
+        self.relay.bytes_forwarded = 0
+        self.bytes_received = 0
+        self.kilobyte_per_second_tracker.tick(float(bytesReceived) / 1024.0)
+        return self.kilobyte_per_second_tracker.average_tick_rate
+
+    def isOverloaded(self):
+        if len(self.links) == 0:
+            return True
+
+        return any(link.is_overloaded for link in self.links.itervalues())
+
+    # Shards report their own statistics, see Shard.
+    def reportStatistics(self):
+        try:
+            receiveRate, sendRate, droppedCount = self.relay.transport.getTransportStatistics()
+            logger.info("UDP packets per system call, receiving: [%.2f], sending: [%.2f], dropped: [%d]" % (receiveRate, sendRate, droppedCount))
+        except AttributeError:
+            pass
+
+        overloadedShards = sorted(link.shard_index for link in self.links.itervalues() if link.is_overloaded)
+        period = self.period_metrics.take()
+        logger.info("Shards connected: [%d/%d], overloaded: %s, connections handed off: [%d], migrated: [%d], dropped: [%d], routes: [%d], sessions: [%d]" %
+                    (len(self.links), self.shard_count, overloadedShards, period['handed_off'], period['migrated'], period['dropped'],
+                     len(self.relay.routes), len(self.shards_by_session)))
+
+# Shard side of the channel with the front process.
+@implementer(IFileDescriptorReceiver)
+class ShardChannel(RelayChannel):
+    def __init__(self, shard):
+        RelayChannel.__init__(self, shard.handleFrontPacket)
+        self.shard = shard
+
+        # Descriptors of client connections, received ahead of the packets which describe them.
+        self.file_descriptors = []
+
+    def fileDescriptorReceived(self, descriptor):
+        self.file_descriptors.append(descriptor)
+
+    def connectionMade(self):
+        self.shard.onConnectedToFront(self)
+
+    def connectionLost(self, reason):
+        RelayChannel.connectionLost(self, reason)
+        self.shard.onFrontLost(reason)
+
+class ShardChannelFactory(protocol.ClientFactory):
+    def __init__(self, shard):
+        self.shard = shard
+
+    def buildProtocol(self, addr):
+        return ShardChannel(self.shard)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.shard.onFrontLost(reason)
+
+# Datagrams written by the shard's governor are sent from the front process, which owns the UDP port.
+class ShardUdpTransport(object):
+    def __init__(self, shard):
+        self.shard = shard
+
+    def write(self, data, address):
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_SEND_DATAGRAM)
+        RelayChannel.addAddress(packet, address)
+        packet.addString(data)
+        self.shard.sendToFront(packet)
+
+# Runs in a shard process, holding a governor which owns the clients that the front hands to us.
+# Routes of the governor's rooms are pushed to the front in the same way as to relay workers.
+class Shard(protocol.Factory):
+    # Same as the commander ping.
+    STATUS_FREQUENCY = 5
+
+    def __init__(self, reactor, governor, shardIndex, shardCount, buildMatchmakerFunc):
+        self.reactor = reactor
+        self.governor = governor
+        self.shard_index = shardIndex
+        self.channel = None
+
+        # Matches our waiting clients with those of other shards, see ShardMatchmaker.
+        self.matchmaker = buildMatchmakerFunc(governor.house, shardIndex, self.sendToShard, self.migrateClient)
+        governor.house.remote_matchmaker = self.matchmaker
+
+        self.forwarding_table = governor.house.forwarding_table
+        self.forwarding_table.setConnectionIdPartition(shardIndex, shardCount)
+        self.forwarding_table.addListener(self.onRouteChange)
+        self.forwarding_table.addConnectionIdListener(self.onConnectionIdChange)
+
+        self.udp_connection_linker = governor.udp_connection_linker
+        self.udp_connection_linker.addSessionListener(self.onSessionChange)
+
+        governor.transport = ShardUdpTransport(self)
+
+        # Protocol built for the connection being adopted.
+        self.adopted_protocol = None
+
+        # Migration ID -> TCP transport of a client connection moving to another shard, until the front
+        # holds its own descriptor of it.
+        self.pending_migrations = dict()
+        self.next_migration_id = 0
+
+        self.status_reporter = task.LoopingCall(self.reportStatus)
+
+    def sendToFront(self, packet):
+        if self.channel is not None:
+            self.channel.sendByteBuffer(packet)
+
+    def sendToShard(self, shardIndex, packet):
+        message = ByteBuffer()
+        message.addUnsignedInteger8(RelayChannel.OperationCodes.OP_SHARD_MESSAGE)
+        message.addUnsignedInteger(shardIndex)
+        message.addString(packet.convertToString())
+        self.sendToFront(message)
+
+    def onConnectedToFront(self, channel):
+        logger.info("Connected to front process as shard [%d]" % self.shard_index)
+        self.channel = channel
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_SHARD_HELLO)
+        packet.addUnsignedInteger(self.shard_index)
+        self.sendToFront(packet)
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_CLEAR_ROUTES)
+        self.sendToFront(packet)
+
+        for sourceAddress, peerAddress in self.forwarding_table.getRoutes().iteritems():
+            self.sendToFront(RelayChannel.buildRoutePacket(sourceAddress, peerAddress))
+
+        for connectionId, address in self.forwarding_table.getConnectionIds().iteritems():
+            self.sendToFront(RelayChannel.buildConnectionIdPacket(connectionId, address))
+
+        for udpHash in self.udp_connection_linker.getHeldSessions():
+            self.sendToFront(RelayChannel.buildSessionPacket(udpHash, True))
+
+        self.status_reporter.start(Shard.STATUS_FREQUENCY, now=False)
+
+    def onFrontLost(self, reason):
+        # Front has gone away, our clients can't reach us any more.
+        logger.warn("Channel with front process lost, reason: [%s], stopping shard" % reason.getErrorMessage())
+        self.channel = None
+        if reactor.running:
+            reactor.stop()
+
+    def onRouteChange(self, sourceAddress, peerAddress):
+        self.sendToFront(RelayChannel.buildRoutePacket(sourceAddress, peerAddress))
+
+    def onConnectionIdChange(self, connectionId, address):
+        self.sendToFront(RelayChannel.buildConnectionIdPacket(connectionId, address))
+
+    def onSessionChange(self, udpHash, isHeld):
+        self.sendToFront(RelayChannel.buildSessionPacket(udpHash, isHeld))
+
+    def reportStatus(self):
+        self.governor.reportStatistics()
+        self.matchmaker.reportStatistics()
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_SHARD_STATUS)
+        packet.addUnsignedInteger8(1 if self.governor.isOverloaded() else 0)
+        self.sendToFront(packet)
+
+    def handleFrontPacket(self, packet):
+        assert isinstance(packet, ByteBuffer)
+
+        opCode = packet.getUnsignedInteger8()
+        if opCode == RelayChannel.OperationCodes.OP_UNKNOWN_DATAGRAM:
+            remoteAddress = RelayChannel.getAddress(packet)
+            data = packet.getString()
+            self.governor.datagramReceived(data, remoteAddress)
+        elif opCode == RelayChannel.OperationCodes.OP_ADOPT_CONNECTION:
+            handoffId = packet.getUnsignedInteger()
+            received = packet.getString()
+            self.adoptConnection(handoffId, received)
+        elif opCode == RelayChannel.OperationCodes.OP_ADOPT_MIGRATED_CONNECTION:
+            handoffId = packet.getUnsignedInteger()
+            details = ByteBuffer.buildFromIterable(packet.getString())
+            udpHash = details.getString()
+            udpAddress = RelayChannel.getAddress(details)
+            connectionId = details.getUnsignedInteger()
+            usesConnectionId = details.getUnsignedInteger8() > 0
+            received = details.getString()
+            self.adoptConnection(handoffId, received, (udpHash, udpAddress, connectionId, usesConnectionId))
+        elif opCode == RelayChannel.OperationCodes.OP_CONNECTION_MIGRATED:
+            self.onConnectionMigrated(packet.getUnsignedInteger())
+        elif opCode == RelayChannel.OperationCodes.OP_SHARD_MESSAGE:
+            shardIndex = packet.getUnsignedInteger()
+            self.matchmaker.handleShardMessage(shardIndex, ByteBuffer.buildFromIterable(packet.getString()))
+        elif opCode == RelayChannel.OperationCodes.OP_SHARD_JOINED:
+            self.matchmaker.onShardJoined(packet.getUnsignedInteger())
+        elif opCode == RelayChannel.OperationCodes.OP_SHARD_LEFT:
+            self.matchmaker.onShardLeft(packet.getUnsignedInteger())
+        else:
+            logger.error("Unknown control packet received from front process, op code: %d" % opCode)
+
+    # migration is (UDP hash, UDP address, connection ID, uses connection ID) of a connected client
+    # moved from another shard, or None for a new connection.
+    def adoptConnection(self, handoffId, received, migration=None):
+        descriptor = self.channel.file_descriptors.pop(0)
+        self.adopted_protocol = None
+        try:
+            self.reactor.adoptStreamConnection(descriptor, socket.AF_INET, self)
+        except Exception as e:
+            logger.error("Failed to adopt client connection from front process: %s" % e)
+        finally:
+            # The reactor has its own copy of the file descriptor.
+            os.close(descriptor)
+
+        isAdopted = self.adopted_protocol is not None
+        if isAdopted and migration is not None:
+            udpHash, udpAddress, connectionId, usesConnectionId = migration
+            isAdopted = self.governor.adoptMigratedClient(self.adopted_protocol.parent, udpHash, udpAddress, connectionId, usesConnectionId)
+            if not isAdopted:
+                # It reconnects, to whichever shard holds its session.
+                self.adopted_protocol.transport.loseConnection()
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_CONNECTION_ADOPTED)
+        packet.addUnsignedInteger(handoffId)
+        packet.addUnsignedInteger8(1 if isAdopted else 0)
+        self.sendToFront(packet)
+
+        # The front read the client's first packets, so they are replayed.
+        if isAdopted:
+            self.adopted_protocol.dataReceived(received)
+
+    def buildProtocol(self, addr):
+        self.adopted_protocol = self.governor.buildProtocol(addr)
+        return self.adopted_protocol
+
+    # Moves the TCP connection of a connected client to another shard, which holds its session already, see
+    # ShardMatchmaker.onHandOver. The front passes the connection's descriptor on, as it does for new connections,
+    # and the other shard takes the client over where we left off, so the client doesn't notice. Returns false
+    # if it can't be moved, e.g. while data we sent it is still buffered here, as it would be overtaken.
+    def migrateClient(self, shardIndex, client):
+        if self.channel is None or client.tcp is None or client.udp is None:
+            return False
+
+        tcpTransport = client.tcp.transport
+        if hasPendingWrites(tcpTransport):
+            return False
+
+        tcpTransport.stopReading()
+
+        details = ByteBuffer()
+        details.addString(client.udp_hash)
+        RelayChannel.addAddress(details, client.udp.remote_address)
+        details.addUnsignedInteger(client.connection_id or 0)
+        details.addUnsignedInteger8(1 if client.uses_connection_id else 0)
+
+        # Received but not yet processed, replayed by the other shard.
+        details.addString(client.tcp.recvd)
+
+        # Removes the client's connection ID at the front ahead of the move.
+        self.governor.detachClient(client)
+
+        migrationId = self.next_migration_id
+        self.next_migration_id = (self.next_migration_id + 1) % (2 ** (8 * DataConstants.ULONG_SIZE))
+        self.pending_migrations[migrationId] = tcpTransport
+
+        # The descriptor is sent along with the next write.
+        self.channel.transport.sendFileDescriptor(tcpTransport.fileno())
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(RelayChannel.OperationCodes.OP_MIGRATE_CONNECTION)
+        packet.addUnsignedInteger(migrationId)
+        packet.addUnsignedInteger(shardIndex)
+        packet.addString(details.convertToString())
+        self.sendToFront(packet)
+        return True
+
+    def onConnectionMigrated(self, migrationId):
+        tcpTransport = self.pending_migrations.pop(migrationId, None)
+        if tcpTransport is None:
+            return
+
+        # The front holds its own descriptor, so we only stop watching and close ours, see ShardLink.onConnectionAdopted.
+        tcpTransport.stopWriting()
+        tcpTransport.socket.close()
+
+
+class ShardFrontTest(unittest.TestCase):
+    class FakeLink(object):
+        def __init__(self, shardIndex):
+            self.shard_index = shardIndex
+            self.sent = []
+
+        def sendByteBuffer(self, packet):
+            self.sent.append(packet.convertToString())
+
+    def setUp(self):
+        self.front = ShardFront(None, "governor", 2, "governor.sock", "INFO", "write_behind.spool")
+        self.links = [ShardFrontTest.FakeLink(shardIndex) for shardIndex in range(2)]
+        for link in self.links:
+            self.front.onShardConnected(link)
+
+    # Identity which the ring places on the shard, and a session hash carrying it.
+    def getIdentityOfShard(self, shardIndex):
+        for persistedId in range(1000):
+            identity = SessionHashSigner.getIdentity(persistedId)
+            if self.front.ring.getNode(identity) == shardIndex:
+                return identity, self.front.session_hash_signer.generateHash(persistedId)
+
+    @staticmethod
+    def buildLogonPacket(sessionHash, persistedId):
+        packet = ByteBuffer()
+        if sessionHash is None:
+            packet.addUnsignedInteger8(0)
+        else:
+            packet.addUnsignedInteger8(1)
+            packet.addString(sessionHash)
+        packet.addUnsignedInteger(1) # version
+        packet.addUnsignedInteger8(0) # is new ID
+        if persistedId is not None:
+            packet.addString(persistedId)
+        return packet
+
+    def getLogonSession(self, packet):
+        return getLogonSession(ByteBuffer.buildFromIterable(packet.convertToString()))
+
+    def testSessionTakeover(self):
+        identity, sessionHash = self.getIdentityOfShard(1)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[1])
+
+        # Held by the other shard, e.g. in a room as an offline client.
+        self.front.onSessionChange(self.links[0], sessionHash, True)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[0])
+
+        self.front.onSessionChange(self.links[1], sessionHash, True)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[1])
+        self.assertNotIn(sessionHash, self.front.sessions_by_shard[0])
+
+        # Released by the shard which it was taken from, after the takeover.
+        self.front.onSessionChange(self.links[0], sessionHash, False)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[1])
+
+        self.front.onSessionChange(self.links[1], sessionHash, False)
+        self.assertNotIn(sessionHash, self.front.shards_by_session)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[1])
+
+    def testSessionsOfLeavingShard(self):
+        identity, sessionHash = self.getIdentityOfShard(1)
+        self.front.onSessionChange(self.links[0], sessionHash, True)
+
+        # Replaced by a new connection of the same shard, which holds nothing yet.
+        newLink = ShardFrontTest.FakeLink(0)
+        self.front.onShardConnected(newLink)
+        self.assertNotIn(sessionHash, self.front.shards_by_session)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[1])
+
+        self.front.onSessionChange(newLink, sessionHash, True)
+        self.front.onShardDisconnected(newLink, Failure(ConnectionDone()))
+        self.assertNotIn(sessionHash, self.front.shards_by_session)
+        self.assertIs(self.front.getShardOfSession(sessionHash, identity), self.links[1])
+
+    def testShardOfUnknownSession(self):
+        identity, sessionHash = self.getIdentityOfShard(0)
+        self.assertIs(self.front.getShardOfSession(None, identity), self.links[0])
+        self.assertIsNone(self.front.getShardOfSession(sessionHash, None))
+
+        self.front.onSessionChange(self.links[1], sessionHash, True)
+        self.assertIs(self.front.getShardOfSession(sessionHash, None), self.links[1])
+
+    def testLogonSession(self):
+        identity = SessionHashSigner.getIdentity("persisted")
+        sessionHash = self.front.session_hash_signer.generateHash("persisted")
+        self.assertEquals(self.getLogonSession(ShardFrontTest.buildLogonPacket(None, "persisted")), (None, identity))
+        self.assertEquals(self.getLogonSession(ShardFrontTest.buildLogonPacket(sessionHash, "persisted")), (sessionHash, identity))
+
+    def testMalformedLogonSession(self):
+        self.assertEquals(self.getLogonSession(ByteBuffer()), (None, None))
+        self.assertEquals(self.getLogonSession(ShardFrontTest.buildLogonPacket("hash", None)), (None, None))
+
+        # Fields cut short.
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(1)
+        packet.addString("hash")
+        self.assertEquals(self.getLogonSession(packet), (None, None))
+
+        complete = ShardFrontTest.buildLogonPacket(None, "persisted").convertToString()
+        self.assertEquals(self.getLogonSession(ByteBuffer.buildFromIterable(complete[:-1])), (None, None))
+
+        packet = ByteBuffer()
+        packet.addUnsignedInteger8(1)
+        packet.addUnsignedInteger(1000)
+        self.assertEquals(self.getLogonSession(packet), (None, None))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Governor Shard', argument_default=argparse.SUPPRESS)
+    parser.add_argument('--shard_index', help='Index of this shard')
+    parser.add_argument('--shard_count', help='Number of shards of the governor')
+    parser.add_argument('--shard_socket', help='Path of the UNIX socket of the front process')
+    parser.add_argument('--governor_name', help='Name of the governor which started us')
+    parser.add_argument('--log_level', help="ERROR, WARN, INFO or DEBUG", default="INFO")
+    parser.add_argument('--write_behind_spool', help='Database write journal of the governor, each shard has its own', default="write_behind.spool")
+    args = parser.parse_args()
+
+    logLevel = parseLogLevel(args.log_level)
+    logging.basicConfig(level = logLevel, stream = sys.stderr, format = '%(asctime)-30s %(name)-20s %(levelname)-8s %(message)s')
+
+    shardIndex = int(args.shard_index)
+    shardCount = int(args.shard_count)
+    governorName = args.governor_name
+    logger.info("SHARD [%d] OF GOVERNOR [%s] STARTED" % (shardIndex, governorName))
+
+    # Imported here, the governor module imports this one.
+    from governor import buildGovernor
+    from shard_matching import ShardMatchmaker
+
+    # Shards share the governor's waiting list, each matching its own clients with those of the others.
+    governor = buildGovernor(governorName, "%s.%d" % (args.write_behind_spool, shardIndex))
+
+    shard = Shard(reactor, governor, shardIndex, shardCount, ShardMatchmaker)
+    reactor.connectUNIX(args.shard_socket, ShardChannelFactory(shard))
+    reactor.run()
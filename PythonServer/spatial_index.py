@@ -0,0 +1,269 @@
+import heapq
+import logging
+import math
+import random
+import unittest
+from geography import distanceBetweenPoints, EARTH_RADIUS_KM
+
+__author__ = 'pryormic'
+
+logger = logging.getLogger(__name__)
+
+# In memory index of items by location, used to find the nearest waiting clients without a database round trip.
+#
+# Items are bucketed by a caller supplied key (e.g. gender and gender wanted), and within each bucket
+# by a grid cell of latitude and longitude. Searches visit cells in rings of increasing distance from
+# the search point, so items are produced nearest first and lazily, and a search which stops early
+# only looks at the cells around the search point.
+class SpatialIndex(object):
+    CELL_SIZE_DEGREES = 1.0
+
+    def __init__(self, cellSizeDegrees=CELL_SIZE_DEGREES):
+        super(SpatialIndex, self).__init__()
+        self.cell_size = float(cellSizeDegrees)
+        self.rows = int(math.ceil(180.0 / self.cell_size))
+        self.columns = int(math.ceil(360.0 / self.cell_size))
+
+        # Every cell is within this ring of any other.
+        self.max_ring = max(self.rows, self.columns // 2)
+
+        # Bucket key -> cell -> set of items.
+        self.cells_by_bucket = dict()
+
+        # Item -> (bucket key, cell, longitude, latitude).
+        self.entries = dict()
+
+    def _getCell(self, longitude, latitude):
+        row = min(max(int((latitude + 90.0) / self.cell_size), 0), self.rows - 1)
+        column = int((longitude + 180.0) / self.cell_size) % self.columns
+        return row, column
+
+    # Number of cells between two cells, longitude wraps around.
+    def _getRing(self, cellA, cellB):
+        columnDistance = abs(cellA[1] - cellB[1])
+        return max(abs(cellA[0] - cellB[0]), min(columnDistance, self.columns - columnDistance))
+
+    # Cells of a ring around a cell, latitude does not wrap around.
+    def _getRingCells(self, cell, ring):
+        if ring == 0:
+            return [cell]
+
+        row, column = cell
+        cells = set()
+        for ringRow in xrange(max(row - ring, 0), min(row + ring, self.rows - 1) + 1):
+            if abs(ringRow - row) == ring:
+                ringColumns = xrange(column - ring, column + ring + 1)
+            else:
+                ringColumns = (column - ring, column + ring)
+
+            for ringColumn in ringColumns:
+                ringCell = (ringRow, ringColumn % self.columns)
+                if self._getRing(cell, ringCell) == ring:
+                    cells.add(ringCell)
+
+        return cells
+
+    # Lower bound of the arc (in radians) between the search point and any point in a cell of this ring,
+    # or of any ring further out.
+    def _getRingLowerBound(self, longitude, latitude, ring):
+        if ring == 0:
+            return 0.0
+
+        row, column = self._getCell(longitude, latitude)
+
+        # Cells of inner rings form a block around the search point, cells of this ring are beyond
+        # its edges in latitude, or in longitude, by at least these many degrees.
+        rowOffset = min(max((latitude + 90.0) / self.cell_size - row, 0.0), 1.0)
+        latitudeGap = float('inf')
+        if row - ring >= 0:
+            latitudeGap = (ring - 1 + rowOffset) * self.cell_size
+        if row + ring < self.rows:
+            latitudeGap = min(latitudeGap, (ring - rowOffset) * self.cell_size)
+
+        columnOffset = (longitude + 180.0) / self.cell_size
+        columnOffset -= math.floor(columnOffset)
+        longitudeBound = float('inf')
+        if ring <= self.columns // 2:
+            longitudeGap = math.radians(min((ring - 1 + min(columnOffset, 1.0 - columnOffset)) * self.cell_size, 90.0))
+
+            # Arc from the search point to the meridian at that longitude, which only depends on the search
+            # point's latitude, so grows with each ring. Beyond 90 degrees the nearest point is a pole.
+            longitudeBound = math.asin(min(1.0, math.cos(math.radians(latitude)) * math.sin(longitudeGap)))
+
+        return min(math.radians(min(latitudeGap, 180.0)), longitudeBound)
+
+    def add(self, item, bucketKey, longitude, latitude):
+        self.remove(item)
+
+        cell = self._getCell(longitude, latitude)
+        self.cells_by_bucket.setdefault(bucketKey, dict()).setdefault(cell, set()).add(item)
+        self.entries[item] = (bucketKey, cell, longitude, latitude)
+
+    def remove(self, item):
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return False
+
+        bucketKey, cell, longitude, latitude = entry
+        cells = self.cells_by_bucket[bucketKey]
+        items = cells[cell]
+        items.discard(item)
+        if len(items) == 0:
+            del cells[cell]
+            if len(cells) == 0:
+                del self.cells_by_bucket[bucketKey]
+
+        return True
+
+    # Generates (ring, item sets in cells of that ring) in order of ring, for rings with items in any of the buckets.
+    def _iterateRings(self, searchCell, bucketKeys):
+        bucketCells = [self.cells_by_bucket[bucketKey] for bucketKey in bucketKeys if bucketKey in self.cells_by_bucket]
+        occupiedCount = sum(len(cells) for cells in bucketCells)
+
+        visitedCount = 0
+        for ring in xrange(self.max_ring + 1):
+            ringCells = self._getRingCells(searchCell, ring)
+
+            # Having visited as many cells as are occupied, it is cheaper to place the occupied cells which
+            # remain into their rings than to keep visiting empty cells.
+            visitedCount += len(ringCells)
+            if visitedCount > occupiedCount:
+                itemsByRing = dict()
+                for cells in bucketCells:
+                    for cell, items in cells.iteritems():
+                        cellRing = self._getRing(searchCell, cell)
+                        if cellRing >= ring:
+                            itemsByRing.setdefault(cellRing, list()).append(items)
+
+                for cellRing in sorted(itemsByRing):
+                    yield cellRing, itemsByRing[cellRing]
+                return
+
+            ringItems = [cells[cell] for cells in bucketCells for cell in ringCells if cell in cells]
+            if len(ringItems) > 0:
+                yield ring, ringItems
+
+    # Generates (item, distance in km) of items in any of the buckets, nearest first.
+    def iterateNearest(self, longitude, latitude, bucketKeys):
+        # Arc from the search point -> item, items are copied out of their cells so that
+        # callers can modify the index while iterating.
+        nearest = []
+        for ring, ringItems in self._iterateRings(self._getCell(longitude, latitude), bucketKeys):
+            for items in ringItems:
+                for item in list(items):
+                    entry = self.entries.get(item)
+                    if entry is not None:
+                        heapq.heappush(nearest, (distanceBetweenPoints(longitude, latitude, entry[2], entry[3]), id(item), item))
+
+            # Anything closer than the nearest possible item of rings further out is ready.
+            lowerBound = self._getRingLowerBound(longitude, latitude, ring + 1)
+            while len(nearest) > 0 and nearest[0][0] <= lowerBound:
+                arc, itemId, item = heapq.heappop(nearest)
+                if item in self.entries:
+                    yield item, arc * EARTH_RADIUS_KM
+
+        while len(nearest) > 0:
+            arc, itemId, item = heapq.heappop(nearest)
+            if item in self.entries:
+                yield item, arc * EARTH_RADIUS_KM
+
+    def __contains__(self, item):
+        return item in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SpatialIndexTest(unittest.TestCase):
+    LONDON = (-0.127758, 51.507351)
+    WATFORD = (-0.396018, 51.656489)
+    PARIS = (2.352222, 48.856614)
+    NEW_YORK = (-74.005941, 40.712784)
+    TOKYO = (139.691706, 35.689487)
+    FIJI = (179.9, -17.7)
+    SAMOA = (-179.9, -17.7)
+
+    def testNearestFirst(self):
+        index = SpatialIndex()
+        places = {'watford': SpatialIndexTest.WATFORD, 'paris': SpatialIndexTest.PARIS,
+                  'new york': SpatialIndexTest.NEW_YORK, 'tokyo': SpatialIndexTest.TOKYO,
+                  'london': SpatialIndexTest.LONDON}
+        for name, location in places.iteritems():
+            index.add(name, 'bucket', location[0], location[1])
+
+        results = list(index.iterateNearest(SpatialIndexTest.LONDON[0], SpatialIndexTest.LONDON[1], ['bucket']))
+        self.assertEquals([name for name, distance in results], ['london', 'watford', 'paris', 'new york', 'tokyo'])
+        self.assertEquals(results[0][1], 0)
+        self.assertEquals([distance for name, distance in results], sorted(distance for name, distance in results))
+
+    def testBuckets(self):
+        index = SpatialIndex()
+        index.add('a', (1, 2), SpatialIndexTest.LONDON[0], SpatialIndexTest.LONDON[1])
+        index.add('b', (2, 1), SpatialIndexTest.WATFORD[0], SpatialIndexTest.WATFORD[1])
+        index.add('c', (2, 3), SpatialIndexTest.PARIS[0], SpatialIndexTest.PARIS[1])
+
+        self.assertEquals([name for name, distance in index.iterateNearest(0, 51, [(2, 1), (2, 3)])], ['b', 'c'])
+        self.assertEquals(list(index.iterateNearest(0, 51, [(1, 1)])), [])
+
+        # Moving an item replaces its old location and bucket.
+        index.add('a', (2, 3), SpatialIndexTest.TOKYO[0], SpatialIndexTest.TOKYO[1])
+        self.assertEquals(len(index), 3)
+        self.assertEquals([name for name, distance in index.iterateNearest(0, 51, [(2, 3)])], ['c', 'a'])
+
+        self.assertTrue(index.remove('a'))
+        self.assertFalse(index.remove('a'))
+        self.assertNotIn('a', index)
+        self.assertEquals(sorted(index.cells_by_bucket.keys()), [(2, 1), (2, 3)])
+
+    def testWrapAround(self):
+        index = SpatialIndex()
+        index.add('samoa', 'bucket', SpatialIndexTest.SAMOA[0], SpatialIndexTest.SAMOA[1])
+        index.add('tokyo', 'bucket', SpatialIndexTest.TOKYO[0], SpatialIndexTest.TOKYO[1])
+
+        self.assertEquals([name for name, distance in index.iterateNearest(SpatialIndexTest.FIJI[0], SpatialIndexTest.FIJI[1], ['bucket'])], ['samoa', 'tokyo'])
+
+    def testMatchesSortedDistance(self):
+        rand = random.Random(1)
+        index = SpatialIndex(cellSizeDegrees=5)
+        locations = dict()
+        for item in xrange(500):
+            locations[item] = (rand.uniform(-180, 180), rand.uniform(-90, 90))
+            index.add(item, 'bucket', locations[item][0], locations[item][1])
+
+        for searchLocation in [(0, 0), (10, 89.5), (-179, -80), (45, 60)]:
+            distances = [distance for item, distance in index.iterateNearest(searchLocation[0], searchLocation[1], ['bucket'])]
+            self.assertEquals(len(distances), 500)
+            self.assertEquals(distances, sorted(distances))
+
+    def testRemoveWhileIterating(self):
+        index = SpatialIndex()
+        index.add('london', 'bucket', SpatialIndexTest.LONDON[0], SpatialIndexTest.LONDON[1])
+        index.add('watford', 'bucket', SpatialIndexTest.WATFORD[0], SpatialIndexTest.WATFORD[1])
+
+        names = []
+        for name, distance in index.iterateNearest(SpatialIndexTest.LONDON[0], SpatialIndexTest.LONDON[1], ['bucket']):
+            names.append(name)
+            index.remove('watford')
+        self.assertEquals(names, ['london'])
+
+    def testRingLowerBound(self):
+        rand = random.Random(2)
+        index = SpatialIndex(cellSizeDegrees=5)
+        for attempt in xrange(2000):
+            searchLocation = (rand.uniform(-180, 180), rand.uniform(-90, 90))
+            location = (rand.uniform(-180, 180), rand.uniform(-90, 90))
+            ring = index._getRing(index._getCell(*searchLocation), index._getCell(*location))
+            arc = distanceBetweenPoints(searchLocation[0], searchLocation[1], location[0], location[1])
+            self.assertLessEqual(index._getRingLowerBound(searchLocation[0], searchLocation[1], ring), arc + 1e-9)
+
+    def testDenseCluster(self):
+        rand = random.Random(3)
+        index = SpatialIndex()
+        for item in xrange(2000):
+            index.add(item, 'bucket', SpatialIndexTest.LONDON[0] + rand.uniform(-1.5, 1.5), SpatialIndexTest.LONDON[1] + rand.uniform(-1.5, 1.5))
+        for item in xrange(2000, 2100):
+            index.add(item, 'bucket', rand.uniform(-180, 180), rand.uniform(-90, 90))
+
+        distances = [distance for item, distance in index.iterateNearest(SpatialIndexTest.LONDON[0], SpatialIndexTest.LONDON[1], ['bucket'])]
+        self.assertEquals(len(distances), 2100)
+        self.assertEquals(distances, sorted(distances))
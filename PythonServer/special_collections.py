@@ -1,6 +1,7 @@
 __author__ = 'pryormic'
 
 import collections
+import unittest
 
 class OrderedSet(collections.MutableSet):
     def __init__(self, iterable=None):
@@ -57,4 +58,57 @@ class OrderedSet(collections.MutableSet):
     def __eq__(self, other):
         if isinstance(other, OrderedSet):
             return len(self) == len(other) and list(self) == list(other)
-        return set(self) == set(other)
\ No newline at end of file
+        return set(self) == set(other)
+
+
+# Dictionary holding at most max_size items, the least recently used item is evicted first.
+class LruCache(object):
+    def __init__(self, maxSize):
+        super(LruCache, self).__init__()
+        self.max_size = maxSize
+        self.items = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class LruCacheTest(unittest.TestCase):
+    def testEviction(self):
+        cache = LruCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+
+        # a is now more recently used than b.
+        self.assertEquals(cache.get("a"), 1)
+        cache.put("c", 3)
+
+        self.assertEquals(len(cache), 2)
+        self.assertNotIn("b", cache)
+        self.assertIsNone(cache.get("b"))
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("c"), 3)
+
+        cache.discard("a")
+        self.assertEquals(cache.get("a", 0), 0)
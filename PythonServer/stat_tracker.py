@@ -2,6 +2,8 @@ from utility import getEpoch
 from random import randint
 from time import sleep
 from threading import RLock
+import bisect
+import unittest
 
 # Weighted average of tick rate.
 class StatTracker(object):
@@ -42,6 +44,136 @@ class StatTracker(object):
             self._lock.release()
 
 
+# Counts, totals and maxima over a reporting period, which are read and reset together each time they are
+# reported. Each is an attribute named as given, starting at 0.
+class PeriodMetrics(object):
+    def __init__(self, *names):
+        super(PeriodMetrics, self).__init__()
+        self.names = names
+        self.reset()
+
+    def reset(self):
+        for name in self.names:
+            setattr(self, name, 0)
+
+    def recordMax(self, name, value):
+        if value > getattr(self, name):
+            setattr(self, name, value)
+
+    # Returns the values of the period by name, and starts a new period.
+    def take(self):
+        values = dict((name, getattr(self, name)) for name in self.names)
+        self.reset()
+        return values
+
+    @staticmethod
+    def getAverage(total, count):
+        if count == 0:
+            return 0.0
+        return float(total) / count
+
+
+# Counts of latencies in exponentially sized buckets, so that percentiles can be estimated without keeping every sample.
+class LatencyHistogram(object):
+    # Upper bounds of buckets in milliseconds, the last bucket holds anything slower.
+    BUCKET_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+    def __init__(self, bucketBoundsMs = BUCKET_BOUNDS_MS):
+        super(LatencyHistogram, self).__init__()
+        self.bucket_bounds = list(bucketBoundsMs)
+        self._lock = RLock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.bucket_counts = [0] * (len(self.bucket_bounds) + 1)
+            self.count = 0
+            self.total_ms = 0.0
+            self.max_ms = 0.0
+        finally:
+            self._lock.release()
+
+    def record(self, seconds):
+        milliseconds = seconds * 1000.0
+        self._lock.acquire()
+        try:
+            self.bucket_counts[bisect.bisect_left(self.bucket_bounds, milliseconds)] += 1
+            self.count += 1
+            self.total_ms += milliseconds
+            if milliseconds > self.max_ms:
+                self.max_ms = milliseconds
+        finally:
+            self._lock.release()
+
+    # Upper bound of the bucket holding the percentile (0 to 100), never more than the slowest latency.
+    def getPercentile(self, percentile):
+        self._lock.acquire()
+        try:
+            if self.count == 0:
+                return 0.0
+
+            rank = self.count * percentile / 100.0
+            seen = 0
+            for bound, bucketCount in zip(self.bucket_bounds, self.bucket_counts):
+                seen += bucketCount
+                if seen >= rank and seen > 0:
+                    return min(float(bound), self.max_ms)
+
+            return self.max_ms
+        finally:
+            self._lock.release()
+
+    def getAverage(self):
+        if self.count == 0:
+            return 0.0
+        return self.total_ms / self.count
+
+    def __str__(self):
+        return "count [%d], average [%.1fms], p50 [%.1fms], p90 [%.1fms], p99 [%.1fms], max [%.1fms]" % \
+               (self.count, self.getAverage(), self.getPercentile(50), self.getPercentile(90), self.getPercentile(99), self.max_ms)
+
+
+class PeriodMetricsTest(unittest.TestCase):
+    def testTakeResets(self):
+        metrics = PeriodMetrics('count', 'max')
+        metrics.count += 2
+        metrics.recordMax('max', 5)
+        metrics.recordMax('max', 3)
+
+        self.assertEquals(metrics.take(), {'count': 2, 'max': 5})
+        self.assertEquals(metrics.take(), {'count': 0, 'max': 0})
+        self.assertEquals(PeriodMetrics.getAverage(3, 2), 1.5)
+        self.assertEquals(PeriodMetrics.getAverage(3, 0), 0.0)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def testPercentiles(self):
+        histogram = LatencyHistogram()
+        self.assertEquals(histogram.getPercentile(50), 0.0)
+
+        for n in range(0, 90):
+            histogram.record(0.003)
+        for n in range(0, 9):
+            histogram.record(0.150)
+        histogram.record(45)
+
+        self.assertEquals(histogram.count, 100)
+        self.assertEquals(histogram.getPercentile(50), 5.0)
+        self.assertEquals(histogram.getPercentile(90), 5.0)
+        self.assertEquals(histogram.getPercentile(95), 200.0)
+        self.assertEquals(histogram.getPercentile(100), 45000.0)
+        self.assertAlmostEquals(histogram.getAverage(), (90 * 3 + 9 * 150 + 45000) / 100.0)
+
+        histogram.reset()
+        self.assertEquals(histogram.count, 0)
+        self.assertEquals(histogram.max_ms, 0.0)
+
+    def testPercentileCappedBySlowest(self):
+        histogram = LatencyHistogram()
+        histogram.record(0.0012)
+        self.assertAlmostEquals(histogram.getPercentile(99), 1.2)
+
 
 if __name__ == '__main__':
     tracker = StatTracker(60)
@@ -0,0 +1,326 @@
+import logging
+import math
+import time
+import unittest
+from threading import Lock
+from twisted.internet import task
+from twisted.internet.error import AlreadyCalled, AlreadyCancelled
+from stat_tracker import PeriodMetrics
+
+logger = logging.getLogger(__name__)
+
+# Timer scheduled with a TimingWheel, which behaves like a twisted DelayedCall.
+class Timer(object):
+    __slots__ = ('wheel', 'deadline_tick', 'func', 'args', 'kwargs', 'slot', 'called', 'cancelled')
+
+    def __init__(self, wheel, deadlineTick, func, args, kwargs):
+        super(Timer, self).__init__()
+        self.wheel = wheel
+        self.deadline_tick = deadlineTick
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+        # Set of timers in the wheel which this timer is held in.
+        self.slot = None
+
+        self.called = False
+        self.cancelled = False
+
+    # Seconds since the epoch at which the timer fires.
+    def getTime(self):
+        return self.wheel.getTimeOfTick(self.deadline_tick)
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def _ensureActive(self):
+        if self.called:
+            raise AlreadyCalled()
+        if self.cancelled:
+            raise AlreadyCancelled()
+
+    def cancel(self):
+        self._ensureActive()
+        self.wheel.remove(self)
+
+    # Fires the timer delay seconds from now, rather than when it was due to.
+    def reset(self, delay):
+        self._ensureActive()
+        self.wheel.reschedule(self, delay)
+
+
+# Governor wide timers, for the expiries and checks held by each client.
+#
+# Time advances in ticks of TICK_SECONDS, driven by a single LoopingCall. Timers are held in levels of
+# SLOTS_PER_LEVEL slots, each level covering SLOTS_PER_LEVEL times the ticks of the level below. Timers due
+# within SLOTS_PER_LEVEL ticks are held in the first level, in the slot of the tick they are due. Further
+# out they are held by a coarser level, and moved down a level each time that level's slot comes round.
+# This makes scheduling, resetting and cancelling O(1), whereas the reactor keeps its timers in a heap.
+#
+# Timers fire up to one tick late, which is fine for timeouts of seconds.
+#
+# Also caches the time at each tick, for code which wants the time often but not precisely.
+class TimingWheel(object):
+    TICK_SECONDS = 0.1
+    SLOTS_PER_LEVEL = 256
+    LEVELS = 4
+
+    def __init__(self, tickSeconds=TICK_SECONDS, slotsPerLevel=SLOTS_PER_LEVEL, levels=LEVELS, clock=time.time):
+        super(TimingWheel, self).__init__()
+        self.tick_seconds = tickSeconds
+        self.slots_per_level = slotsPerLevel
+        self.clock = clock
+
+        # Ticks covered by a slot of each level.
+        self.ticks_per_slot = [slotsPerLevel ** level for level in range(levels)]
+        self.max_ticks = slotsPerLevel ** levels - 1
+
+        self.levels = [[set() for slot in range(slotsPerLevel)] for level in range(levels)]
+
+        self.start_time = clock()
+        self.current_tick = 0
+
+        # Cached time, updated each tick.
+        self.now = self.start_time
+
+        self.timer_count = 0
+        self.lock = Lock()
+        self.ticker = None
+
+        self.period_metrics = PeriodMetrics('fired', 'cancelled', 'ticks', 'total_lag', 'max_lag')
+
+    def start(self, reactor):
+        self.ticker = task.LoopingCall(self.advance)
+        self.ticker.clock = reactor
+        self.ticker.start(self.tick_seconds, now=False)
+
+    def stop(self):
+        if self.ticker is not None and self.ticker.running:
+            self.ticker.stop()
+
+    def getTimeOfTick(self, tick):
+        return self.start_time + tick * self.tick_seconds
+
+    # Same as reactor.callLater.
+    def callLater(self, delay, func, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            timer = Timer(self, self._getDeadlineTick(delay), func, args, kwargs)
+            self._insert(timer)
+            self.timer_count += 1
+            return timer
+        finally:
+            self.lock.release()
+
+    def remove(self, timer):
+        self.lock.acquire()
+        try:
+            self._discard(timer)
+            timer.cancelled = True
+            self.timer_count -= 1
+            self.period_metrics.cancelled += 1
+        finally:
+            self.lock.release()
+
+    def reschedule(self, timer, delay):
+        self.lock.acquire()
+        try:
+            self._discard(timer)
+            timer.deadline_tick = self._getDeadlineTick(delay)
+            self._insert(timer)
+        finally:
+            self.lock.release()
+
+    # Timers always fire on a later tick, so that they never fire while being scheduled.
+    def _getDeadlineTick(self, delay):
+        return self.current_tick + max(1, int(math.ceil(delay / self.tick_seconds)))
+
+    def _insert(self, timer):
+        # Timers beyond the last level are held as far out as we can, and reinserted from there.
+        deadlineTick = min(timer.deadline_tick, self.current_tick + self.max_ticks)
+        ticksRemaining = deadlineTick - self.current_tick
+
+        level = 0
+        while level + 1 < len(self.levels) and ticksRemaining >= self.ticks_per_slot[level + 1]:
+            level += 1
+
+        slot = self.levels[level][(deadlineTick // self.ticks_per_slot[level]) % self.slots_per_level]
+        slot.add(timer)
+        timer.slot = slot
+
+    # Timers which are due are taken out of their slot before they are fired, see advance.
+    def _discard(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+
+    # Moves timers from the slots of coarser levels which are now due into lower levels.
+    def _cascade(self):
+        for level in range(1, len(self.levels)):
+            if self.current_tick % self.ticks_per_slot[level] != 0:
+                break
+
+            slot = self.levels[level][(self.current_tick // self.ticks_per_slot[level]) % self.slots_per_level]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+
+    # Fires timers of every tick which has passed.
+    #
+    # Each timer is only marked called as it is fired, so timers which are due in the same tick can still
+    # be cancelled or reset by those fired before them.
+    def advance(self):
+        now = self.clock()
+        self.now = now
+
+        targetTick = int((now - self.start_time) / self.tick_seconds)
+        if targetTick <= self.current_tick:
+            return
+
+        # How long after it was due the first tick is processed.
+        lag = now - self.getTimeOfTick(self.current_tick + 1)
+        self.period_metrics.ticks += 1
+        self.period_metrics.total_lag += lag
+        self.period_metrics.recordMax('max_lag', lag)
+
+        while self.current_tick < targetTick:
+            self.lock.acquire()
+            try:
+                self.current_tick += 1
+                self._cascade()
+
+                slot = self.levels[0][self.current_tick % self.slots_per_level]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    timer.slot = None
+            finally:
+                self.lock.release()
+
+            for timer in timers:
+                self.lock.acquire()
+                try:
+                    # Cancelled or reset by a timer fired before it.
+                    if timer.cancelled or timer.slot is not None:
+                        continue
+
+                    timer.called = True
+                    self.timer_count -= 1
+                    self.period_metrics.fired += 1
+                finally:
+                    self.lock.release()
+
+                try:
+                    timer.func(*timer.args, **timer.kwargs)
+                except Exception:
+                    logger.exception("Timer [%s] failed" % getattr(timer.func, '__name__', timer.func))
+
+    # Returns metrics since they were last reported, and starts a new reporting period.
+    def getMetrics(self):
+        period = self.period_metrics.take()
+        return {'timers': self.timer_count,
+                'fired': period['fired'],
+                'cancelled': period['cancelled'],
+                'average_lag_ms': PeriodMetrics.getAverage(period['total_lag'], period['ticks']) * 1000,
+                'max_lag_ms': period['max_lag'] * 1000}
+
+    def reportMetrics(self):
+        metrics = self.getMetrics()
+        logger.info("Timers, scheduled: [%(timers)d], fired: [%(fired)d], cancelled: [%(cancelled)d], "
+                    "tick lag: [%(average_lag_ms).2fms] average, [%(max_lag_ms).2fms] max" % metrics)
+
+
+class TimingWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.time = 1000.0
+        self.fired = []
+
+    def buildWheel(self, slotsPerLevel=4, levels=3):
+        return TimingWheel(tickSeconds=1.0, slotsPerLevel=slotsPerLevel, levels=levels, clock=lambda: self.time)
+
+    def advanceTo(self, wheel, seconds):
+        self.time = 1000.0 + seconds
+        wheel.advance()
+
+    def testFiresAcrossLevels(self):
+        wheel = self.buildWheel()
+        for delay in [0, 1, 3, 4, 5, 17, 63, 64, 200]:
+            wheel.callLater(delay, self.fired.append, delay)
+        self.assertEquals(wheel.timer_count, 9)
+
+        for seconds in range(1, 201):
+            self.advanceTo(wheel, seconds)
+            for delay in self.fired:
+                self.assertEquals(max(delay, 1), seconds)
+            self.fired = []
+
+        self.assertEquals(wheel.timer_count, 0)
+        self.assertEquals(wheel.now, 1200.0)
+
+    def testCancelAndReset(self):
+        wheel = self.buildWheel()
+        cancelled = wheel.callLater(10, self.fired.append, 'cancelled')
+        reset = wheel.callLater(10, self.fired.append, 'reset')
+        self.assertEquals(reset.getTime(), 1010.0)
+
+        self.advanceTo(wheel, 5)
+        cancelled.cancel()
+        self.assertRaises(AlreadyCancelled, cancelled.cancel)
+        reset.reset(20)
+        self.assertEquals(reset.getTime(), 1025.0)
+
+        self.advanceTo(wheel, 24)
+        self.assertEquals(self.fired, [])
+        wheel.getMetrics()
+
+        # Ticks missed by a slow reactor are caught up on.
+        self.advanceTo(wheel, 30)
+        self.assertEquals(self.fired, ['reset'])
+        self.assertFalse(reset.active())
+        self.assertRaises(AlreadyCalled, reset.cancel)
+        self.assertEquals(wheel.getMetrics()['max_lag_ms'], 5000.0)
+
+    def testBeyondLastLevel(self):
+        wheel = self.buildWheel(levels=2)
+        wheel.callLater(40, self.fired.append, 40)
+        self.advanceTo(wheel, 39)
+        self.assertEquals(self.fired, [])
+        self.advanceTo(wheel, 40)
+        self.assertEquals(self.fired, [40])
+
+    def testCancelledBySameTick(self):
+        wheel = self.buildWheel()
+        timers = dict()
+
+        def fire(name, other):
+            self.fired.append(name)
+            if not timers[other].active():
+                return
+            if other == 'reset':
+                timers[other].reset(2)
+            else:
+                timers[other].cancel()
+
+        timers['first'] = wheel.callLater(3, fire, 'first', 'second')
+        timers['second'] = wheel.callLater(3, fire, 'second', 'first')
+        timers['reset'] = wheel.callLater(5, self.fired.append, 'reset')
+        timers['resetter'] = wheel.callLater(5, fire, 'resetter', 'reset')
+
+        # Whichever fires first cancels the other.
+        self.advanceTo(wheel, 3)
+        self.assertEquals(len(self.fired), 1)
+        self.assertFalse(timers['first'].active())
+        self.assertFalse(timers['second'].active())
+        self.assertEquals(wheel.timer_count, 2)
+
+        del self.fired[:]
+        self.advanceTo(wheel, 5)
+        self.assertIn('resetter', self.fired)
+        if self.fired == ['resetter']:
+            self.assertEquals(timers['reset'].getTime(), 1007.0)
+            self.advanceTo(wheel, 7)
+            self.assertEquals(self.fired, ['resetter', 'reset'])
+        self.assertEquals(wheel.timer_count, 0)
+        self.assertEquals(wheel.getMetrics()['cancelled'], 1)
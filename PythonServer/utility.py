@@ -1,4 +1,3 @@
-import calendar
 import time
 import struct
 import socket
@@ -11,17 +10,21 @@ class DataConstants:
     # Little endian, 4 bytes.
     ULONG_FORMAT = "<L"
     ULONG_SIZE = 4
+    ULONG_STRUCT = struct.Struct(ULONG_FORMAT)
 
     # Big endian, 4 bytes (or network byte order)
     FLOAT_FORMAT = ">f"
     FLOAT_SIZE = 4
+    FLOAT_STRUCT = struct.Struct(FLOAT_FORMAT)
 
     UBYTE_FORMAT = "B"
     UBYTE_SIZE = 1
+    UBYTE_STRUCT = struct.Struct(UBYTE_FORMAT)
 
-# Shuold be in UTC.
+# Shuold be in UTC, time.time() is seconds since the epoch in UTC, the same as calendar.timegm(time.gmtime())
+# without building a struct_time each call.
 def getEpoch():
-    return calendar.timegm(time.gmtime())
+    return int(time.time())
 
 def getRemainingTimeOnAction(action):
     return action.getTime() - getEpoch()
@@ -45,6 +48,20 @@ def inet_addr(address):
 def htons(port):
     return socket.htons(port)
 
+# Not exposed by the socket module on all platforms, this is the Linux value.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# Non blocking UDP socket, if reusePort is set then multiple processes can bind to
+# the same port, and the kernel distributes datagrams between them by source address.
+def bindUdpSocket(port, reusePort=False, host=""):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reusePort:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind((host, port))
+    return sock
+
 class ThrottleDecorator(object):
     def __init__(self,func,interval):
         self.func = func